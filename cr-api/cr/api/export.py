@@ -0,0 +1,137 @@
+"""
+Streaming dataset export.
+
+Each format is a generator of output strings over
+``Dataset.iter_row_chunks()``, so an export holds one storage chunk of each
+selected column in memory at a time, however big the dataset.
+
+csv
+    A header row, then one row per dataset row. Missing values are empty.
+ndjson
+    One JSON object per row, keyed by header, missing values null. A column
+    that repeats an earlier header (multiple response columns) is keyed
+    '<header>:<column index>'.
+binary
+    A compact columnar stream, see ``binary_export()``.
+"""
+import csv
+import json
+import struct
+from cStringIO import StringIO
+
+import numpy as np
+
+from cr.db.columnar import OBJECT, pack_bitmap
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'binary': 'application/octet-stream',
+}
+
+BINARY_MAGIC = 'CRX1'
+
+
+def has_labels(column_type):
+    return hasattr(column_type, 'decode')
+
+
+def _iter_chunks(dataset, indexes, start, stop, labels):
+    column_types = [dataset.column_types[i] for i in indexes]
+    for row_start, arrays in dataset.iter_row_chunks(indexes, start, stop):
+        if labels:
+            arrays = [column_type.decode(array)
+                      if has_labels(column_type) and array.dtype != object
+                      else array
+                      for column_type, array in zip(column_types, arrays)]
+        yield row_start, arrays
+
+
+def _cell(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, float):
+        return repr(value)
+    return value
+
+
+def csv_export(dataset, indexes, start=0, stop=None, labels=False):
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([_cell(dataset.headers[i]) for i in indexes])
+    yield buf.getvalue()
+    for _, arrays in _iter_chunks(dataset, indexes, start, stop, labels):
+        buf = StringIO()
+        writer = csv.writer(buf)
+        columns = [array.tolist() for array in arrays]
+        writer.writerows([['' if value is None else _cell(value)
+                           for value in row] for row in zip(*columns)])
+        yield buf.getvalue()
+
+
+def _json_keys(dataset, indexes):
+    keys = []
+    for i in indexes:
+        header = dataset.headers[i]
+        keys.append(header if header not in keys
+                    else '{}:{}'.format(header, i))
+    return keys
+
+
+def ndjson_export(dataset, indexes, start=0, stop=None, labels=False):
+    keys = _json_keys(dataset, indexes)
+    for _, arrays in _iter_chunks(dataset, indexes, start, stop, labels):
+        columns = [array.tolist() for array in arrays]
+        yield ''.join(json.dumps(dict(zip(keys, row))) + '\n'
+                      for row in zip(*columns))
+
+
+def _binary_dtype(dataset, i, labels):
+    dtype = dataset.dtype(i)
+    if dtype == object or labels and has_labels(dataset.column_types[i]):
+        return OBJECT
+    return dtype.str
+
+
+def binary_export(dataset, indexes, start=0, stop=None, labels=False):
+    """
+    Stream a compact columnar format. All integers are little endian.
+
+    - The magic string 'CRX1'.
+    - A uint32 byte length and a JSON header:
+      {"columns": [{"header": ..., "dtype": NumPy dtype string or "O"}],
+       "start": first row, "num_rows": rows}
+    - One frame per storage chunk: a uint32 row count, then for each column
+      a packed validity bitmap (1 = present, first row in the high bit)
+      followed by the values. Fixed width values fill every row slot
+      (missing rows hold 0). Object values are a uint32 byte length and a
+      JSON list of the present values.
+    """
+    dtypes = [_binary_dtype(dataset, i, labels) for i in indexes]
+    stop = dataset.num_rows if stop is None else min(stop, dataset.num_rows)
+    start = max(start, 0)
+    header = json.dumps({
+        'columns': [{'header': dataset.headers[i], 'dtype': dtype}
+                    for i, dtype in zip(indexes, dtypes)],
+        'start': start,
+        'num_rows': max(stop - start, 0),
+    })
+    yield BINARY_MAGIC + struct.pack('<I', len(header)) + header
+    for _, arrays in _iter_chunks(dataset, indexes, start, stop, labels):
+        parts = [struct.pack('<I', len(arrays[0]))]
+        for dtype, array in zip(dtypes, arrays):
+            mask = np.ma.getmaskarray(array)
+            parts.append(pack_bitmap(~mask))
+            if dtype == OBJECT:
+                data = json.dumps(array.compressed().tolist())
+                parts.append(struct.pack('<I', len(data)) + data)
+            else:
+                parts.append(array.filled(0).astype(dtype).tobytes())
+        yield ''.join(parts)
+
+
+EXPORTERS = {
+    'csv': csv_export,
+    'ndjson': ndjson_export,
+    'binary': binary_export,
+}
@@ -0,0 +1,137 @@
+"""
+On-demand profiling of single API requests.
+
+A request is profiled when either:
+
+- it carries an ``X-Cr-Profile`` header whose value matches the
+  ``profile_token`` setting (the admin secret), or
+- its path matches the ``profile_once`` setting; the setting is cleared once
+  that request has been profiled.
+
+The handler is then run under cProfile, and the peak resident set size of
+the process is read before and after with ``resource.getrusage()``. There
+are no per-line allocation deltas: ``tracemalloc`` does not exist on Python
+2. The peak only grows when the request pushed memory past the previous
+high-water mark, so a growth of 0 does not mean the request allocated
+nothing. The report is saved to the ``profiles`` collection and can be
+downloaded from ``/profiles`` with the same header.
+
+Streamed responses, such as ``/distances/within`` and
+``/datasets/<id>/export``, are only profiled while the handler creates
+their body generator. The rows are produced after the report is saved, as
+the body is consumed, so that work is not in the report.
+
+When neither setting applies, the only cost per request is a header lookup.
+"""
+import cProfile
+import datetime
+import hmac
+import pstats
+import time
+from cStringIO import StringIO
+
+import cherrypy
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PROFILE_HEADER = 'X-Cr-Profile'
+
+# How many functions to keep in a report
+REPORT_LIMIT = 60
+
+
+def is_admin_request(settings):
+    """Does the current request carry the admin profiling token?"""
+    token = settings.get('profile_token')
+    supplied = cherrypy.request.headers.get(PROFILE_HEADER)
+    if not token or not supplied:
+        return False
+    return hmac.compare_digest(str(token), str(supplied))
+
+
+def _should_profile(settings):
+    profile_once = settings.get('profile_once')
+    if profile_once and cherrypy.request.path_info == profile_once:
+        settings['profile_once'] = None
+        return True
+    return is_admin_request(settings)
+
+
+def max_rss():
+    """Peak resident set size of the process in KiB, or None"""
+    if resource is None:
+        return None
+    # KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def profile_call(func):
+    """
+    Call func() under the profilers.
+    Return (result, report) where report is a dict ready to be saved.
+    """
+    profiler = cProfile.Profile()
+    rss_before = max_rss()
+    start = time.time()
+    try:
+        result = profiler.runcall(func)
+    finally:
+        elapsed = time.time() - start
+        rss_after = max_rss()
+
+    stream = StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats('cumulative').print_stats(REPORT_LIMIT)
+    report = {
+        'elapsed': elapsed,
+        'stats': stream.getvalue(),
+        'max_rss_before': rss_before,
+        'max_rss_after': rss_after,
+    }
+    return result, report
+
+
+def _profile_handler():
+    request = cherrypy.request
+    root = request.app.root
+    if request.handler is None or not _should_profile(root.settings):
+        return
+    handler = request.handler
+
+    def profiled_handler(*args, **kwargs):
+        result, report = profile_call(lambda: handler(*args, **kwargs))
+        report.update({
+            'path': request.path_info,
+            'method': request.method,
+            'query_string': request.query_string,
+            'created': datetime.datetime.utcnow(),
+        })
+        profile_id = root.db.profiles.insert(report)
+        cherrypy.response.headers[PROFILE_HEADER + '-Id'] = str(profile_id)
+        return result
+
+    request.handler = profiled_handler
+
+cherrypy.tools.profile = cherrypy.Tool('before_handler', _profile_handler,
+                                       priority=90)
+
+
+def format_report(report):
+    """Render a stored profile report as plain text."""
+    lines = [
+        '{} {}{}'.format(report['method'], report['path'],
+                         '?' + report['query_string']
+                         if report.get('query_string') else ''),
+        'created: {}'.format(report['created']),
+        'elapsed: {:.6f}s'.format(report['elapsed']),
+        '',
+        report['stats'],
+    ]
+    if report.get('max_rss_after') is not None:
+        lines.insert(3, 'peak RSS: {} KiB (grew by {} KiB)'.format(
+            report['max_rss_after'],
+            report['max_rss_after'] - report['max_rss_before']))
+    return '\n'.join(lines)
@@ -1,17 +1,208 @@
+import binascii
 import cherrypy
+import datetime
+import hashlib
 import json
+import os
 import sys
+import threading
+import time
+
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import DuplicateKeyError
+
+from cr.api import export, profiling
+from cr.db import distances, metrics, proximity
+from cr.db.dataset import open_dataset
+from cr.db.indexes import ensure_indexes
+from cr.db.moves import MoveWriter, MAX_STALENESS
+from cr.db.positions import PositionStore
 from cr.db.store import global_settings as settings, connect
+from cr.db.users import (
+    find_user,
+    login_taken,
+    prepare_user,
+    user_location,
+)
+
+# Most pairs GET /distances/closest returns
+MAX_CLOSEST_PAIRS = 10000
+
+# Sessions expire this long after login; the sessions TTL index (see
+# cr.db.indexes) then deletes them
+SESSION_LIFETIME = datetime.timedelta(days=1)
+
+
+def password_hash(password):
+    """Return the stored hash of a password, 400 if it is not a string"""
+    if not isinstance(password, basestring):
+        raise cherrypy.HTTPError(400, 'The password must be a string')
+    return hashlib.sha1(password.encode('utf-8')).hexdigest()
+
+
+class RequestMetricsTool(cherrypy.Tool):
+    """Record per-endpoint request latency into cr.db.metrics"""
+
+    def __init__(self):
+        cherrypy.Tool.__init__(self, 'on_start_resource', self._start)
+
+    def _setup(self):
+        cherrypy.Tool._setup(self)
+        cherrypy.request.hooks.attach('on_end_request', self._record)
+
+    def _start(self):
+        if metrics.is_enabled():
+            cherrypy.request.metrics_start = time.time()
+
+    def _record(self):
+        request = cherrypy.request
+        start = getattr(request, 'metrics_start', None)
+        if start is None:
+            return
+        # Label by the first path segment to keep the series count bounded
+        endpoint = '/' + request.path_info.lstrip('/').split('/', 1)[0]
+        metrics.observe('cr_http_request_seconds', time.time() - start,
+                        endpoint=endpoint, method=request.method)
+
+cherrypy.tools.request_metrics = RequestMetricsTool()
+
 
 class Root(object):
 
+    _cp_config = {'tools.request_metrics.on': True,
+                  'tools.profile.on': True}
+
     def __init__(self, settings):
+        self.settings = settings
         self.db = connect(settings)
+        ensure_indexes(self.db)
+        self._positions = None
+        self._positions_lock = threading.Lock()
+        self._distance_summaries = distances.SummaryCache()
+        self.move_writer = MoveWriter(
+            self.db.users,
+            float(settings.get('position_max_staleness', MAX_STALENESS)))
+        self.move_writer.subscribe(self._moved)
+        self.move_writer.start()
+        cherrypy.engine.subscribe('stop', self.move_writer.stop)
+
+    def positions(self):
+        """Return the user PositionStore, loading it on first use"""
+        with self._positions_lock:
+            if self._positions is None:
+                positions = PositionStore()
+                positions.load(self.db)
+                self._positions = positions
+        return self._positions
+
+    def _moved(self, changes):
+        """Apply the positions MoveWriter wrote to the PositionStore"""
+        with self._positions_lock:
+            positions = self._positions
+        if positions is not None:
+            positions.update((user_id, latitude, longitude)
+                             for user_id, (latitude, longitude)
+                             in changes.iteritems())
 
     def index(self):
         return 'Welcome to Crunch.  Please <a href="/login">login</a>.'
     index.exposed = True
 
+    def metrics(self):
+        """
+        Expose the process metrics in the Prometheus text format. Metrics are
+        only collected when the settings contain "metrics": true.
+        """
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        return metrics.render()
+    metrics.exposed = True
+
+    def profiles(self, profile_id=None):
+        """
+        GET /profiles lists the stored request profiles as json.
+        GET /profiles/<id> downloads one report as plain text.
+
+        Admin only: requires the X-Cr-Profile header to match the
+        profile_token setting.
+        """
+        if not profiling.is_admin_request(self.settings):
+            raise cherrypy.HTTPError(403)
+        if profile_id is None:
+            listing = self.db.profiles.find(
+                {}, {'path': True, 'method': True, 'created': True,
+                     'elapsed': True}).sort('created', -1)
+            cherrypy.response.headers['Content-Type'] = 'application/json'
+            return json.dumps({'profiles': [
+                {'id': str(p['_id']),
+                 'path': p['path'],
+                 'method': p['method'],
+                 'created': p['created'].isoformat(),
+                 'elapsed': p['elapsed']} for p in listing]})
+        try:
+            report = self.db.profiles.find_one({'_id': ObjectId(profile_id)})
+        except InvalidId:
+            report = None
+        if report is None:
+            raise cherrypy.NotFound()
+        cherrypy.response.headers['Content-Type'] = 'text/plain'
+        return profiling.format_report(report)
+    profiles.exposed = True
+
+    def datasets(self, dataset_id=None, action=None, format='csv',
+                 columns=None, start=None, stop=None, labels=None):
+        """
+        GET /datasets/<id>/export streams a stored dataset.
+
+        format:
+            csv (default), ndjson or binary, see cr.api.export.
+        columns:
+            Comma separated column indexes or headers. Default: all.
+        start, stop:
+            Row range, stop exclusive. Default: all rows.
+        labels:
+            1 to decode category codes back to their labels.
+
+        The output is sent with chunked transfer encoding, gzipped when the
+        client accepts it, and is read from storage one chunk at a time.
+        """
+        if cherrypy.request.method != 'GET':
+            raise cherrypy.HTTPError(405)
+        if dataset_id is None or action != 'export':
+            raise cherrypy.NotFound()
+        try:
+            dataset = open_dataset(self.db, dataset_id)
+        except (InvalidId, KeyError):
+            raise cherrypy.NotFound()
+        if format not in export.EXPORTERS:
+            raise cherrypy.HTTPError(400, 'Unknown format: ' + format)
+        try:
+            if columns:
+                indexes = [int(key) if key.isdigit()
+                           else dataset.column_index(key)
+                           for key in columns.split(',')]
+            else:
+                indexes = range(len(dataset.headers))
+            start = int(start) if start else 0
+            stop = int(stop) if stop else None
+        except ValueError as exc:
+            raise cherrypy.HTTPError(400, str(exc))
+        if any(not 0 <= i < len(dataset.headers) for i in indexes):
+            raise cherrypy.HTTPError(400, 'Column index out of range')
+
+        response = cherrypy.response
+        response.headers['Content-Type'] = export.FORMATS[format]
+        response.headers['Content-Disposition'] = (
+            'attachment; filename="{}.{}"'.format(dataset_id, format))
+        return export.EXPORTERS[format](dataset, indexes, start, stop,
+                                        labels=labels == '1')
+    datasets.exposed = True
+    datasets._cp_config = {
+        'response.stream': True,
+        'tools.gzip.on': True,
+        'tools.gzip.mime_types': export.FORMATS.values(),
+    }
+
     def users(self):
         """
         for GET: update this to return a json stream defining a listing of the users
@@ -22,11 +213,53 @@ class Root(object):
 
         note: Always return the appropriate response for the action requested.
         """
-        return json.dumps({'users': [u for u in self.db.users.find()]})
+        if cherrypy.request.method == 'POST':
+            return self._add_user()
+        # default=str for the ObjectId of users added without an _id
+        return json.dumps({'users': [u for u in self.db.users.find()]},
+                          default=str)
 
     users.exposed = True
 
-    def login(self):
+    def _add_user(self):
+        """
+        Add the user of a json request body, with at least an email, and
+        optionally a username and password. Return 409 when the email or
+        username is taken: the unique indexes reject the insert, after a
+        login_taken() check that spares the write in the common case.
+        """
+        try:
+            user = json.loads(cherrypy.request.body.read())
+            if not isinstance(user, dict) or not user.get('email'):
+                raise ValueError('An email is required')
+        except ValueError as exc:
+            raise cherrypy.HTTPError(400, str(exc))
+        user.pop('_id', None)
+        if login_taken(self.db, user.get('username'), user['email']):
+            raise cherrypy.HTTPError(409, 'Username or email taken')
+        password = user.pop('password', None)
+        if password is not None:
+            user['hash'] = password_hash(password)
+        try:
+            user_id = self.db.users.insert_one(prepare_user(user)).inserted_id
+        except DuplicateKeyError:
+            # Taken by a concurrent request since the check
+            raise cherrypy.HTTPError(409, 'Username or email taken')
+        cherrypy.response.status = 201
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps({'_id': str(user_id)})
+
+    def _session_user_id(self):
+        """Return the user id of the request's session, or None"""
+        cookie = cherrypy.request.cookie.get('session')
+        if cookie is None:
+            return None
+        session = self.db.sessions.find_one(
+            {'_id': cookie.value,
+             'expires': {'$gt': datetime.datetime.utcnow()}})
+        return None if session is None else session['user_id']
+
+    def login(self, login=None, password=None):
         """
         a GET to this endpoint should provide the user login/logout capabilities
 
@@ -36,6 +269,30 @@ class Root(object):
         hint: this is how the admin's password was generated:
               import hashlib; hashlib.sha1('123456').hexdigest()
         """
+        if cherrypy.request.method == 'GET':
+            user_id = self._session_user_id()
+            cherrypy.response.headers['Content-Type'] = 'application/json'
+            return json.dumps(
+                {'user_id': None if user_id is None else str(user_id)})
+        if cherrypy.request.method != 'POST':
+            raise cherrypy.HTTPError(405)
+        if password is None:
+            raise cherrypy.HTTPError(401)
+        hashed = password_hash(password)
+        user = find_user(self.db, login) if login else None
+        if user is None or user.get('hash') != hashed:
+            raise cherrypy.HTTPError(401)
+        token = binascii.hexlify(os.urandom(20))
+        self.db.sessions.insert_one({
+            '_id': token,
+            'user_id': user['_id'],
+            'expires': datetime.datetime.utcnow() + SESSION_LIFETIME,
+        })
+        cherrypy.response.cookie['session'] = token
+        cherrypy.response.cookie['session']['httponly'] = True
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps({'user_id': str(user['_id'])})
+    login.exposed = True
 
     def logout(self):
         """
@@ -43,15 +300,181 @@ class Root(object):
         should redirect the user to the login page.
         """
 
-    def distances(self):
+    def _pair_summary(self, edges):
+        positions = self.positions()
+
+        def compute(edges):
+            _, latitudes, longitudes = positions.snapshot()
+            return distances.pair_summary(latitudes, longitudes, edges)
+        return self._distance_summaries.get(positions.version, edges,
+                                            compute)
+
+    def _pairs_within(self, km, offset, limit):
+        """Yield the ndjson lines of the pairs within km, see distances()"""
+        ids, latitudes, longitudes = self.positions().snapshot()
+        pairs = proximity.iter_pairs_within(latitudes, longitudes, km)
+        for i, j, pair_km in pairs:
+            for a, b, d in zip(i.tolist(), j.tolist(), pair_km.tolist()):
+                if offset:
+                    offset -= 1
+                    continue
+                if limit is not None:
+                    if not limit:
+                        return
+                    limit -= 1
+                yield json.dumps({'users': [str(ids[a]), str(ids[b])],
+                                  'km': d}) + '\n'
+
+    def distances(self, action=None, bins=None, low=None, high=None,
+                  log=None, edges=None, k=None, km=None, offset=None,
+                  limit=None):
+        """
+        GET /distances returns the min, max, mean and standard deviation of
+        the great circle distance, in km, between every pair of users, as
+        json: {"users", "pairs", "min", "max", "mean", "std", "unit"}.
+
+        GET /distances/histogram adds "histogram": {"edges", "counts",
+        "cumulative", "under", "over"}, the pair counts per distance bin.
+        cumulative answers "how many pairs are within x km" for each upper
+        bin edge x.
+
+        edges:
+            Comma separated bin edges in km, e.g. 0,10,100,1000,20016.
+        bins, low, high, log:
+            Else, bins bins (default 20) from low to high km (default 0
+            to half the earth's circumference); with log=1, equal on a log
+            scale from low (default 1 km), plus a bin from 0 to low.
+
+        GET /distances/closest?k=10 returns the k closest pairs of users,
+        closest first: {"pairs": [{"users": [id, id], "km"}, ...], "unit"}.
+        k is at most MAX_CLOSEST_PAIRS.
+
+        GET /distances/within?km=5 streams every pair of users at most km
+        apart as ndjson, one {"users": [id, id], "km"} line per pair, in no
+        particular order. The order is the same between requests while no
+        position changes, so offset and limit page through it.
+
+        Positions come from the in-memory PositionStore rather than the
+        user documents, and the pairs are visited in bounded tiles, see
+        cr.db.distances. Both the statistics and the histogram come from
+        one pass, cached until a user position changes. The closest and
+        within queries only compare users in neighbouring grid cells, see
+        cr.db.proximity.
+        """
+        if cherrypy.request.method != 'GET':
+            raise cherrypy.HTTPError(405)
+        if action not in (None, 'histogram', 'closest', 'within'):
+            raise cherrypy.NotFound()
+        if action == 'closest':
+            try:
+                k = int(k) if k else 10
+            except ValueError as exc:
+                raise cherrypy.HTTPError(400, str(exc))
+            if not 0 < k <= MAX_CLOSEST_PAIRS:
+                raise cherrypy.HTTPError(
+                    400, 'k must be 1 to {}'.format(MAX_CLOSEST_PAIRS))
+            ids, latitudes, longitudes = self.positions().snapshot()
+            i, j, pair_km = proximity.closest_pairs(latitudes, longitudes, k)
+            pairs = [{'users': [str(ids[a]), str(ids[b])], 'km': d}
+                     for a, b, d in zip(i.tolist(), j.tolist(),
+                                        pair_km.tolist())]
+            cherrypy.response.headers['Content-Type'] = 'application/json'
+            return json.dumps({'pairs': pairs, 'unit': 'km'})
+        if action == 'within':
+            try:
+                km = float(km)
+                offset = int(offset) if offset else 0
+                limit = int(limit) if limit else None
+            except (TypeError, ValueError):
+                raise cherrypy.HTTPError(400, 'km, offset and limit must be '
+                                              'numbers')
+            if not km >= 0 or offset < 0 or (limit is not None and limit < 0):
+                raise cherrypy.HTTPError(400, 'km, offset and limit must not '
+                                              'be negative')
+            response = cherrypy.response
+            response.headers['Content-Type'] = export.FORMATS['ndjson']
+            response.stream = True
+            return self._pairs_within(km, offset, limit)
+        bin_edges = None
+        if action == 'histogram':
+            try:
+                if edges:
+                    bin_edges = distances.PairHistogram(
+                        [float(edge) for edge in edges.split(',')]).edges
+                else:
+                    bin_edges = distances.histogram_edges(
+                        int(bins) if bins else distances.DEFAULT_BINS,
+                        float(low) if low else None,
+                        float(high) if high else distances.MAX_DISTANCE_KM,
+                        log == '1')
+            except ValueError as exc:
+                raise cherrypy.HTTPError(400, str(exc))
+        result = dict(self._pair_summary(bin_edges))
+        result['unit'] = 'km'
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps(result)
+    distances.exposed = True
+
+    def _user_ids(self, keys):
+        """
+        Return {key: user _id} for user id strings, which stand for either
+        a string _id or an ObjectId. Raise 400 for unknown users.
+        """
+        candidates = {}
+        for key in keys:
+            candidates[key] = key
+            if ObjectId.is_valid(key):
+                candidates[ObjectId(key)] = key
+        positions = self.positions()
+        user_ids = dict((key, user_id) for user_id, key
+                        in candidates.iteritems() if user_id in positions)
+        # Users without a position yet are not in the store
+        unknown = [user_id for user_id, key in candidates.iteritems()
+                   if key not in user_ids]
+        if unknown:
+            for user in self.db.users.find({'_id': {'$in': unknown}},
+                                           {'_id': True}):
+                user_ids[candidates[user['_id']]] = user['_id']
+        if len(user_ids) < len(keys):
+            raise cherrypy.HTTPError(400, 'Unknown user')
+        return user_ids
+
+    def moves(self):
         """
-        Each user has a lat/lon associated with them.  Using only numpy, determine the distance
-        between each user pair, and provide the min/max/average/std as a json response.
-        This should be GET only.
+        POST /moves reports new user positions, as a json object or list
+        of objects: {"user_id", "latitude", "longitude"}. They are written
+        together with the other reports of the next few seconds (at most
+        the position_max_staleness setting), and only the latest position
+        of each user is written. Returns 202 and {"accepted": n}. user_id
+        is the user's _id, as is or the hex string of an ObjectId.
 
-        Don't code, but explain how would you scale this to 1,000,000 users, considering users
-        changing position every few minutes?
+        GET /distances and the other position queries see the new
+        positions once they are written, see cr.db.moves.
         """
+        if cherrypy.request.method != 'POST':
+            raise cherrypy.HTTPError(405)
+        try:
+            reports = json.loads(cherrypy.request.body.read())
+            if isinstance(reports, dict):
+                reports = [reports]
+            moves = [(report['user_id'], report['latitude'],
+                      report['longitude']) for report in reports]
+            if not all(isinstance(user_id, basestring)
+                       for user_id, _, _ in moves):
+                raise TypeError('user_id must be a string')
+        except (ValueError, TypeError, KeyError):
+            raise cherrypy.HTTPError(400, 'Expected [{"user_id", "latitude", '
+                                          '"longitude"}, ...]')
+        if any(user_location({'latitude': latitude, 'longitude': longitude})
+               is None for _, latitude, longitude in moves):
+            raise cherrypy.HTTPError(400, 'Invalid position')
+        user_ids = self._user_ids(set(user_id for user_id, _, _ in moves))
+        for user_id, latitude, longitude in moves:
+            self.move_writer.move(user_ids[user_id], latitude, longitude)
+        cherrypy.response.status = 202
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps({'accepted': len(moves)})
+    moves.exposed = True
 
 def run():
     settings.update(json.load(file(sys.argv[1])))
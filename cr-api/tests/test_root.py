@@ -1,4 +1,21 @@
+import csv
+import json
+import os
+import struct
+from cStringIO import StringIO
+
 from base import TestBase
+import cherrypy
+import numpy as np
+
+from cr.api import server
+from cr.db import metrics
+from cr.db.distances import pair_statistics
+from cr.db.dataset import open_dataset
+from cr.db.loader import load_dataset
+from cr.db.store import global_settings as settings, connect
+
+_data = os.path.join(os.path.dirname(__file__), '../../cr-db/tests/data')
 
 
 class TestRoot(TestBase):
@@ -10,4 +27,199 @@ class TestRoot(TestBase):
     def test_index(self):
         resp = self.app.get('/')
         assert resp.status_int == 200
-        assert 'Welcome to Crunch.' in resp
\ No newline at end of file
+        assert 'Welcome to Crunch.' in resp
+
+    def test_metrics(self):
+        metrics.reset()
+        metrics.enable()
+        try:
+            self.app.get('/')
+            resp = self.app.get('/metrics')
+        finally:
+            metrics.enable(False)
+        assert resp.status_int == 200
+        assert resp.content_type == 'text/plain'
+        assert 'cr_http_request_seconds_count{endpoint="/",method="GET"} 1' in resp
+
+    def test_profile_request(self):
+        settings['profile_token'] = 'sekrit'
+        try:
+            resp = self.app.get('/', headers={'X-Cr-Profile': 'sekrit'})
+            profile_id = resp.headers['X-Cr-Profile-Id']
+            self.app.get('/profiles', status=403)
+            resp = self.app.get('/profiles/' + profile_id,
+                                headers={'X-Cr-Profile': 'sekrit'})
+            assert resp.content_type == 'text/plain'
+            assert 'GET /' in resp
+            assert 'function calls' in resp
+            assert 'peak RSS:' in resp
+            resp = self.app.get('/', headers={'X-Cr-Profile': 'wrong'})
+            assert 'X-Cr-Profile-Id' not in resp.headers
+        finally:
+            settings['profile_token'] = None
+
+    def test_export_dataset(self):
+        db = connect(settings)
+        ds_id = load_dataset(os.path.join(_data, 'S-O-1k.csv'), db,
+                             chunk_rows=100)
+        dataset = open_dataset(db, ds_id)
+        url = '/datasets/{}/export'.format(ds_id)
+
+        resp = self.app.get(url, {'columns': 'PronounceGIF,SalaryAdjusted',
+                                  'start': '150', 'stop': '420'})
+        assert resp.content_type == 'text/csv'
+        rows = list(csv.reader(StringIO(resp.body)))
+        assert rows[0] == ['PronounceGIF', 'SalaryAdjusted']
+        assert len(rows) == 1 + 270
+        salary = dataset.column('SalaryAdjusted')[150:420].tolist()
+        assert [float(row[1]) if row[1] else None
+                for row in rows[1:]] == salary
+
+        resp = self.app.get(url, {'format': 'ndjson', 'labels': '1',
+                                  'columns': 'Combined Gender',
+                                  'stop': '10'})
+        records = [json.loads(line) for line in resp.body.splitlines()]
+        gender = dataset.column_type('Combined Gender')
+        assert records == [
+            {'Combined Gender': None if code is None else gender[code]}
+            for code in dataset.column('Combined Gender')[:10].tolist()]
+
+        resp = self.app.get(url, {'format': 'binary',
+                                  'columns': 'SalaryAdjusted'},
+                            headers={'Accept-Encoding': 'gzip'})
+        # webtest gunzips the body for us
+        assert resp.headers['Vary'] == 'Accept-Encoding'
+        body = resp.body
+        assert body[:4] == 'CRX1'
+        length, = struct.unpack('<I', body[4:8])
+        header = json.loads(body[8:8 + length])
+        assert header['num_rows'] == dataset.num_rows
+        assert header['columns'] == [{'header': 'SalaryAdjusted',
+                                      'dtype': '<f8'}]
+
+        self.app.get(url, {'format': 'xml'}, status=400)
+        self.app.get(url, {'columns': 'No such column'}, status=400)
+        self.app.get('/datasets/0123456789ab0123456789ab/export', status=404)
+
+    def test_distances(self):
+        resp = self.app.get('/distances')
+        assert resp.content_type == 'application/json'
+        result = resp.json
+        db = connect(settings)
+        users = list(db.users.find())
+        expected = pair_statistics(
+            np.array([float(user['latitude']) for user in users]),
+            np.array([float(user['longitude']) for user in users]))
+        assert result['users'] == len(users) == 10
+        assert result['pairs'] == 45
+        assert result['min'] == 0.0
+        assert np.isclose(result['mean'], expected['mean'])
+        assert np.isclose(result['std'], expected['std'])
+        self.app.post('/distances', status=405)
+
+        resp = self.app.get('/distances/histogram',
+                            {'edges': '0,10,100,1000,20016'})
+        histogram = resp.json['histogram']
+        assert resp.json['mean'] == result['mean']
+        assert histogram['edges'] == [0, 10, 100, 1000, 20016]
+        assert histogram['cumulative'][-1] == 45
+        assert sum(histogram['counts']) + histogram['over'] == 45
+        # At least the pair of users sharing a position is within 10km
+        assert histogram['counts'][0] >= 1
+
+        resp = self.app.get('/distances/histogram', {'bins': '5', 'log': '1'})
+        assert len(resp.json['histogram']['counts']) == 6
+        self.app.get('/distances/histogram', {'edges': '10,0'}, status=400)
+        self.app.get('/distances/histogram', {'bins': 'x'}, status=400)
+        self.app.get('/distances/nope', status=404)
+
+        resp = self.app.get('/distances/closest', {'k': '3'})
+        closest = resp.json['pairs']
+        assert len(closest) == 3
+        assert closest[0]['km'] == 0.0
+        assert [pair['km'] for pair in closest] == sorted(
+            pair['km'] for pair in closest)
+        self.app.get('/distances/closest', {'k': '0'}, status=400)
+
+        resp = self.app.get('/distances/within', {'km': '20016'})
+        assert resp.content_type == 'application/x-ndjson'
+        within = [json.loads(line) for line in resp.text.splitlines()]
+        assert len(within) == 45
+        assert min(pair['km'] for pair in within) == 0.0
+        resp = self.app.get('/distances/within',
+                            {'km': '20016', 'offset': '40', 'limit': '10'})
+        assert [json.loads(line) for line in resp.text.splitlines()] == \
+            within[40:]
+        self.app.get('/distances/within', status=400)
+        self.app.get('/distances/within', {'km': '-1'}, status=400)
+
+    def test_moves(self):
+        root = cherrypy.tree.apps[''].root
+        positions = root.positions()
+        user_id = '985076770cb0173a5b015c32'
+        resp = self.app.post_json('/moves', [
+            {'user_id': user_id, 'latitude': 1.5, 'longitude': 2},
+            {'user_id': user_id, 'latitude': 3.5, 'longitude': 4}])
+        assert resp.status_int == 202
+        assert resp.json == {'accepted': 2}
+        root.move_writer.flush()
+        assert positions.get(user_id) == (3.5, 4.0)
+        user = connect(settings).users.find_one({'_id': user_id})
+        assert user['location']['coordinates'] == [4.0, 3.5]
+
+        self.app.post('/moves', 'x', content_type='application/json',
+                      status=400)
+        self.app.post_json('/moves', {'user_id': user_id}, status=400)
+        self.app.post_json('/moves', {'user_id': user_id, 'latitude': 100,
+                                      'longitude': 0}, status=400)
+        self.app.post_json('/moves', {'user_id': 'nobody', 'latitude': 0,
+                                      'longitude': 0}, status=400)
+        self.app.get('/moves', status=405)
+
+        # Users added without an _id have an ObjectId
+        object_id = connect(settings).users.insert_one(
+            {'email': 'moving@crunch.io'}).inserted_id
+        self.app.post_json('/moves', {'user_id': str(object_id),
+                                      'latitude': 5, 'longitude': 6},
+                           status=202)
+        root.move_writer.flush()
+        assert positions.get(object_id) == (5.0, 6.0)
+        connect(settings).users.delete_one({'_id': object_id})
+
+    def test_users_and_login(self):
+        resp = self.app.post_json('/users', {'email': 'new@crunch.io',
+                                             'username': 'new',
+                                             'password': 'secret'},
+                                  status=201)
+        user_id = resp.json['_id']
+        self.app.post_json('/users', {'email': 'other@crunch.io',
+                                      'username': 'new'}, status=409)
+        self.app.post_json('/users', {'username': 'nomail'}, status=400)
+        self.app.post_json('/users', {'email': 'num@crunch.io',
+                                      'password': 123456}, status=400)
+        resp = self.app.post_json('/users', {'email': u'uni@crunch.io',
+                                             'password': u'p\xe4ss'},
+                                  status=201)
+        self.app.post('/login', {'login': 'uni@crunch.io',
+                                 'password': u'p\xe4ss'.encode('utf-8')})
+
+        # The unique index rejects a user that got in after the check
+        users = connect(settings).users
+        login_taken = server.login_taken
+        server.login_taken = lambda *args: False
+        try:
+            self.app.post_json('/users', {'email': 'new@crunch.io'},
+                               status=409)
+        finally:
+            server.login_taken = login_taken
+
+        self.app.post('/login', {'login': 'new', 'password': 'wrong'},
+                      status=401)
+        resp = self.app.post('/login', {'login': 'new@crunch.io',
+                                        'password': 'secret'})
+        assert resp.json == {'user_id': user_id}
+        assert self.app.get('/login').json == {'user_id': user_id}
+        self.app.reset()
+        assert self.app.get('/login').json == {'user_id': None}
+        users.delete_many({'email': {'$in': ['new@crunch.io',
+                                             'uni@crunch.io']}})
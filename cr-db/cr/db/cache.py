@@ -0,0 +1,154 @@
+"""
+Process-wide cache of decoded dataset columns.
+
+``Dataset.column()`` keeps the NumPy arrays it decodes here, keyed by
+(dataset id, dataset version, column index), so repeated queries on the
+same hot columns are served from memory instead of being fetched and
+decoded again. Entries are evicted least recently used first once the
+cached arrays exceed the byte budget, ``column_cache_bytes`` in the
+settings passed to ``cr.db.store.connect()``. A budget of 0 turns caching
+off.
+
+The stored rows of a dataset are never changed in place: loading the
+data again stores a new dataset under a new id, and ``delete_dataset()``
+drops the cached columns of the old one with ``invalidate()``. The catalog
+version is part of the key all the same, so a writer that changed rows in
+place would only need to bump it.
+
+Hits, misses and evictions are counted on the cache and, when metrics are
+enabled, in ``cr.db.metrics``.
+"""
+from collections import OrderedDict
+import sys
+import threading
+
+import numpy as np
+
+from cr.db import metrics
+
+DEFAULT_BUDGET = 256 * 1024 * 1024
+
+
+def array_bytes(array):
+    """
+    Return the memory held by a (masked) array, including the distinct
+    objects (such as strings) an object array points to.
+    """
+    size = array.nbytes
+    if array.dtype == object:
+        values = np.ma.getdata(array).ravel().tolist()
+        objects = dict(zip(map(id, values), values))
+        size += sum(sys.getsizeof(value) for value in objects.itervalues())
+    mask = getattr(array, 'mask', None)
+    if mask is not None and mask.shape:
+        size += mask.nbytes
+    return size
+
+
+class ColumnCache(object):
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # {key: (array, bytes)}
+
+    def get(self, key):
+        """Return the cached array, or None"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                metrics.inc('cr_column_cache_misses_total')
+                return None
+            # Most recently used last
+            self._entries[key] = entry
+            self.hits += 1
+        metrics.inc('cr_column_cache_hits_total')
+        return entry[0]
+
+    def put(self, key, array):
+        """
+        Cache an array, evicting the least recently used ones to stay under
+        budget. Arrays larger than the whole budget are not cached.
+        """
+        size = array_bytes(array)
+        if size > self.budget:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (array, size)
+            self.size += size
+            evicted = self._evict()
+        if evicted:
+            metrics.inc('cr_column_cache_evictions_total', evicted)
+
+    def _evict(self):
+        """Evict entries until under budget. Call with the lock held."""
+        evicted = 0
+        while self.size > self.budget:
+            _, (_, size) = self._entries.popitem(last=False)
+            self.size -= size
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+
+    def resize(self, budget):
+        """Set a new byte budget, evicting as needed"""
+        with self._lock:
+            self.budget = budget
+            evicted = self._evict()
+        if evicted:
+            metrics.inc('cr_column_cache_evictions_total', evicted)
+
+    def invalidate(self, dataset_id):
+        """Drop every cached column of a dataset, of any version"""
+        with self._lock:
+            for key in [key for key in self._entries
+                        if key[0] == dataset_id]:
+                self.size -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'budget': self.budget,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+COLUMN_CACHE = ColumnCache()
+
+metrics.REGISTRY.describe('cr_column_cache_hits_total',
+                          'Decoded columns served from the column cache')
+metrics.REGISTRY.describe('cr_column_cache_misses_total',
+                          'Decoded columns not found in the column cache')
+metrics.REGISTRY.describe('cr_column_cache_evictions_total',
+                          'Decoded columns evicted from the column cache')
+
+
+def configure(settings):
+    """Apply the column_cache_bytes setting, if given"""
+    budget = settings.get('column_cache_bytes')
+    if budget is not None:
+        COLUMN_CACHE.resize(int(budget))
+
+
+get = COLUMN_CACHE.get
+put = COLUMN_CACHE.put
+invalidate = COLUMN_CACHE.invalidate
+clear = COLUMN_CACHE.clear
+stats = COLUMN_CACHE.stats
@@ -0,0 +1,237 @@
+"""
+Encoding of dataset column chunks.
+
+A dataset column is stored as a series of row range chunks. Each chunk is
+encoded on its own, as one of:
+
+dense
+    A packed validity bitmap (one bit per row, 1 = present, left out when
+    every row is present) next to a dense value buffer. Fixed width values
+    fill every row slot, missing rows hold 0. Object values (strings) only
+    list the present rows.
+sparse
+    For chunks that are mostly missing: the positions of the present rows
+    within the chunk and their values, and nothing for the missing rows.
+null
+    Every row is missing.
+
+Fixed width values are stored as little endian NumPy buffers, so decoding
+is a zero copy ``np.frombuffer`` over the stored bytes. Boolean values are
+bit packed instead, 8 rows per byte (chunks flagged with ``'bits': True``),
+and can be counted with ``count_true()`` without unpacking them.
+
+Chunks of fixed width columns also record the smallest and largest present
+value in ``'min'`` and ``'max'`` (a "zone map", with ``null_count``), so
+range filters can skip chunks that cannot match without decoding them.
+
+Any chunk may also be block compressed with a ``cr.db.compression`` codec,
+which ``decode_chunk()`` undoes transparently.
+"""
+from bson.binary import Binary
+import numpy as np
+
+from cr.db.compression import compress_chunk, decompress_chunk
+
+# NumPy dtype string for Python object values stored as BSON lists
+OBJECT = 'O'
+
+# NumPy dtype string for booleans, which are stored bit packed
+BOOL = '|b1'
+
+# Default fraction of missing rows above which a chunk is stored sparse
+SPARSE_NULL_RATIO = 0.75
+
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+_H01 = np.uint64(0x0101010101010101)
+
+
+def pack_bitmap(flags):
+    """Pack a boolean array into bits, 8 rows per byte, first row high bit"""
+    return np.packbits(np.asarray(flags, dtype=bool)).tobytes()
+
+
+def unpack_bitmap(packed, num_rows):
+    """Unpack the first num_rows flags of a packed bitmap"""
+    bits = np.unpackbits(np.frombuffer(packed, dtype=np.uint8))
+    return bits[:num_rows].view(bool)
+
+
+def popcount(packed):
+    """
+    Return the number of set bits in a packed bitmap, counted 64 bits at a
+    time on the packed words.
+    """
+    data = np.frombuffer(packed, dtype=np.uint8)
+    padding = -len(data) % 8
+    if padding:
+        data = np.concatenate([data, np.zeros(padding, dtype=np.uint8)])
+    words = data.view('<u8')
+    words = words - ((words >> np.uint64(1)) & _M1)
+    words = (words & _M2) + ((words >> np.uint64(2)) & _M2)
+    words = (words + (words >> np.uint64(4))) & _M4
+    return int(((words * _H01) >> np.uint64(56)).sum())
+
+
+def _encode_values(values, dtype):
+    """Return (stored values, bit packed flag) for non-object values"""
+    if dtype == BOOL:
+        return Binary(pack_bitmap(values)), True
+    return Binary(np.array(values, dtype=dtype).tobytes()), False
+
+
+def _decode_values(chunk, count):
+    if chunk.get('bits'):
+        return unpack_bitmap(chunk['values'], count)
+    return np.frombuffer(chunk['values'], dtype=chunk['dtype'])
+
+
+def _zone(values, dtype):
+    """Return (min, max) of the present values of a chunk, or None"""
+    if dtype == OBJECT or dtype == BOOL or not values:
+        return None
+    array = np.array(values, dtype=dtype)
+    low, high = array.min(), array.max()
+    if low != low or high != high:
+        # NaN: no usable bounds
+        return None
+    return low.item(), high.item()
+
+
+def may_match(chunk, low=None, high=None):
+    """
+    Could the chunk hold a value in [low, high], going by its zone map?
+    None bounds are open. Chunks without a zone map may always match,
+    except chunks where every row is missing.
+    """
+    if chunk['encoding'] == 'null':
+        return False
+    if 'min' not in chunk:
+        return True
+    if low is not None and chunk['max'] < low:
+        return False
+    if high is not None and chunk['min'] > high:
+        return False
+    return True
+
+
+def count_true(chunk):
+    """
+    Return the number of True values in a stored boolean chunk. Missing
+    rows are stored as 0 bits, so this is a popcount of the packed values.
+    """
+    if chunk['encoding'] == 'null':
+        return 0
+    decompress_chunk(chunk)
+    return popcount(chunk['values'])
+
+
+def encode_chunk(values, dtype, sparse_ratio=SPARSE_NULL_RATIO, codec=None):
+    """
+    Encode one chunk of a column.
+    values:
+        List of normalized values, None for missing.
+    dtype:
+        NumPy dtype string of the values, or OBJECT.
+    codec:
+        Name of a cr.db.compression codec to compress the chunk with.
+    Return the chunk as a dictionary ready to be stored.
+    """
+    chunk = _encode_chunk(values, dtype, sparse_ratio)
+    if codec is not None:
+        compress_chunk(chunk, codec)
+    return chunk
+
+
+def _encode_chunk(values, dtype, sparse_ratio):
+    num_rows = len(values)
+    valid = np.fromiter((value is not None for value in values),
+                        dtype=bool, count=num_rows)
+    present = int(valid.sum())
+    chunk = {
+        'num_rows': num_rows,
+        'null_count': num_rows - present,
+        'dtype': dtype,
+    }
+    if present == 0:
+        chunk['encoding'] = 'null'
+        return chunk
+
+    if num_rows - present > num_rows * sparse_ratio:
+        chunk['encoding'] = 'sparse'
+        index = np.flatnonzero(valid)
+        chunk['index'] = Binary(index.astype('<u4').tobytes())
+        present_values = [values[i] for i in index]
+        _add_zone(chunk, present_values, dtype)
+        if dtype == OBJECT:
+            chunk['values'] = present_values
+        else:
+            chunk['values'], chunk['bits'] = _encode_values(present_values,
+                                                            dtype)
+        return chunk
+
+    chunk['encoding'] = 'dense'
+    if present < num_rows:
+        chunk['valid'] = Binary(pack_bitmap(valid))
+    if dtype == OBJECT:
+        chunk['values'] = [value for value in values if value is not None]
+    else:
+        _add_zone(chunk, [value for value in values if value is not None]
+                  if present < num_rows else values, dtype)
+        if present < num_rows:
+            values = [0 if value is None else value for value in values]
+        chunk['values'], chunk['bits'] = _encode_values(values, dtype)
+    return chunk
+
+
+def _add_zone(chunk, present_values, dtype):
+    zone = _zone(present_values, dtype)
+    if zone is not None:
+        chunk['min'], chunk['max'] = zone
+
+
+def _object_array(values):
+    result = np.empty(len(values), dtype=object)
+    result[:] = values
+    return result
+
+
+def decode_chunk(chunk):
+    """
+    Decode a stored chunk, decompressing it in place first if needed.
+    Return a NumPy masked array with missing rows masked.
+    """
+    decompress_chunk(chunk)
+    num_rows = chunk['num_rows']
+    dtype = chunk['dtype']
+    encoding = chunk['encoding']
+
+    if encoding == 'null':
+        data = np.zeros(num_rows, dtype=dtype)
+        if dtype == OBJECT:
+            data[:] = None
+        return np.ma.masked_array(data, mask=np.ones(num_rows, dtype=bool))
+
+    if encoding == 'sparse':
+        index = np.frombuffer(chunk['index'], dtype='<u4')
+        mask = np.ones(num_rows, dtype=bool)
+        mask[index] = False
+        if dtype == OBJECT:
+            data = np.empty(num_rows, dtype=object)
+            data[index] = _object_array(chunk['values'])
+        else:
+            data = np.zeros(num_rows, dtype=dtype)
+            data[index] = _decode_values(chunk, len(index))
+        return np.ma.masked_array(data, mask=mask)
+
+    if 'valid' in chunk:
+        mask = ~unpack_bitmap(chunk['valid'], num_rows)
+    else:
+        mask = np.zeros(num_rows, dtype=bool)
+    if dtype == OBJECT:
+        data = np.empty(num_rows, dtype=object)
+        data[~mask] = _object_array(chunk['values'])
+    else:
+        data = _decode_values(chunk, num_rows)
+    return np.ma.masked_array(data, mask=mask)
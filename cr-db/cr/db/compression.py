@@ -0,0 +1,273 @@
+"""
+Block compression codecs for stored column chunks.
+
+A codec compresses the binary buffers of a chunk (values, validity bitmap,
+sparse index) one block at a time. Codecs are looked up by name in
+``CODECS``:
+
+zlib, bz2, lzma
+    General purpose compression from the standard library. lzma is only
+    registered when the module is available (Python 3, or the
+    ``backports.lzma`` package on Python 2).
+rle
+    Run-length encoding of fixed width values, for long runs of repeated
+    codes.
+delta
+    Differences between consecutive integer values, deflated. Suits sorted
+    data such as sparse row indexes or clustered columns.
+
+Object (string) values are serialized to BSON before a general purpose
+codec compresses them; rle and delta only apply to fixed width values.
+"""
+import bz2
+import time
+import zlib
+
+import bson
+from bson.binary import Binary
+import numpy as np
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+OBJECT = 'O'
+
+
+class Codec(object):
+
+    name = None
+
+    def applies(self, dtype):
+        """Can this codec compress buffers of the given dtype?"""
+        return True
+
+    def encode(self, data, dtype):
+        """Compress the bytes of an array of dtype values"""
+        raise NotImplementedError()
+
+    def decode(self, data, dtype):
+        """Return the original bytes"""
+        raise NotImplementedError()
+
+
+class ZlibCodec(Codec):
+
+    name = 'zlib'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def encode(self, data, dtype):
+        return zlib.compress(data, self.level)
+
+    def decode(self, data, dtype):
+        return zlib.decompress(data)
+
+
+class Bz2Codec(Codec):
+
+    name = 'bz2'
+
+    def encode(self, data, dtype):
+        return bz2.compress(data)
+
+    def decode(self, data, dtype):
+        return bz2.decompress(data)
+
+
+class LzmaCodec(Codec):
+
+    name = 'lzma'
+
+    def encode(self, data, dtype):
+        return lzma.compress(data)
+
+    def decode(self, data, dtype):
+        return lzma.decompress(data)
+
+
+class RleCodec(Codec):
+    """
+    Layout: uint32 number of runs, the run values, then the uint32 run
+    lengths.
+    """
+
+    name = 'rle'
+
+    def applies(self, dtype):
+        return dtype != OBJECT and np.dtype(dtype).itemsize in (1, 2, 4, 8)
+
+    def encode(self, data, dtype):
+        values = np.frombuffer(data, dtype=dtype)
+        if not len(values):
+            return np.zeros(1, dtype='<u4').tobytes()
+        # Compare the raw bytes, so NaNs and -0.0 round trip exactly
+        raw = values.view('u{}'.format(values.dtype.itemsize))
+        starts = np.concatenate(
+            [[0], np.flatnonzero(raw[1:] != raw[:-1]) + 1])
+        lengths = np.diff(np.concatenate([starts, [len(values)]]))
+        return (np.array([len(starts)], dtype='<u4').tobytes() +
+                values[starts].tobytes() +
+                lengths.astype('<u4').tobytes())
+
+    def decode(self, data, dtype):
+        num_runs = int(np.frombuffer(data[:4], dtype='<u4')[0])
+        itemsize = np.dtype(dtype).itemsize
+        values_end = 4 + num_runs * itemsize
+        values = np.frombuffer(data[4:values_end], dtype=dtype)
+        lengths = np.frombuffer(data[values_end:], dtype='<u4')
+        return np.repeat(values, lengths).tobytes()
+
+
+class DeltaCodec(Codec):
+    """
+    Store the first value and the differences between consecutive values,
+    wrapping around on overflow, then deflate them.
+    """
+
+    name = 'delta'
+
+    def applies(self, dtype):
+        return dtype != OBJECT and np.dtype(dtype).kind in 'iu'
+
+    def encode(self, data, dtype):
+        values = np.frombuffer(data, dtype=dtype)
+        deltas = np.empty_like(values)
+        if len(values):
+            deltas[0] = values[0]
+            np.subtract(values[1:], values[:-1], out=deltas[1:])
+        return zlib.compress(deltas.tobytes())
+
+    def decode(self, data, dtype):
+        deltas = np.frombuffer(zlib.decompress(data), dtype=dtype)
+        return np.cumsum(deltas, dtype=dtype).tobytes()
+
+
+CODECS = {}
+
+
+def register(codec):
+    CODECS[codec.name] = codec
+
+register(ZlibCodec())
+register(Bz2Codec())
+if lzma is not None:
+    register(LzmaCodec())
+register(RleCodec())
+register(DeltaCodec())
+
+
+def _buffer_dtypes(chunk):
+    """Return {field: element dtype} for the compressible chunk buffers"""
+    dtypes = {}
+    if 'values' in chunk:
+        if chunk['dtype'] == OBJECT:
+            dtypes['values'] = OBJECT
+        elif chunk.get('bits'):
+            dtypes['values'] = '|u1'
+        else:
+            dtypes['values'] = chunk['dtype']
+    if 'valid' in chunk:
+        dtypes['valid'] = '|u1'
+    if 'index' in chunk:
+        dtypes['index'] = '<u4'
+    return dtypes
+
+
+def compress_chunk(chunk, codec_name):
+    """
+    Compress the buffers of an encoded chunk in place with the named codec.
+    Buffers the codec does not apply to are left alone. Return the chunk.
+    """
+    codec = CODECS[codec_name]
+    compressed = []
+    for field, dtype in sorted(_buffer_dtypes(chunk).iteritems()):
+        if dtype == OBJECT:
+            if not codec.applies(OBJECT):
+                continue
+            data = bson.BSON.encode({'v': chunk[field]})
+        elif codec.applies(dtype):
+            data = chunk[field]
+        else:
+            continue
+        chunk[field] = Binary(codec.encode(data, dtype))
+        compressed.append(field)
+    if compressed:
+        chunk['codec'] = codec_name
+        chunk['compressed'] = compressed
+    return chunk
+
+
+def decompress_chunk(chunk):
+    """Undo compress_chunk(), in place. Return the chunk."""
+    codec_name = chunk.pop('codec', None)
+    if codec_name is None:
+        return chunk
+    codec = CODECS[codec_name]
+    dtypes = _buffer_dtypes(chunk)
+    for field in chunk.pop('compressed'):
+        dtype = dtypes[field]
+        data = codec.decode(chunk[field], dtype)
+        if dtype == OBJECT:
+            chunk[field] = bson.BSON(data).decode()['v']
+        else:
+            chunk[field] = data
+    return chunk
+
+
+def chunk_size(chunk):
+    """Return the stored size of a chunk, in bytes"""
+    return len(bson.BSON.encode(chunk))
+
+
+def choose_codec(chunk, candidates=None):
+    """
+    Return the name of the codec that stores the chunk smallest, or None if
+    no codec beats leaving it uncompressed.
+    """
+    if candidates is None:
+        candidates = sorted(CODECS)
+    best_name = None
+    best_size = chunk_size(chunk)
+    for name in candidates:
+        size = chunk_size(compress_chunk(dict(chunk), name))
+        if size < best_size:
+            best_name, best_size = name, size
+    return best_name
+
+
+def benchmark(chunks_by_type, repeat=3):
+    """
+    Measure compression ratio and decode throughput of every codec.
+    chunks_by_type:
+        {ColumnType class name: [encoded, uncompressed chunk, ...]}
+    Return {type name: {codec name: {'ratio': uncompressed / compressed,
+                                     'decode_mb_per_s': float}}}
+    """
+    result = {}
+    for type_name, chunks in sorted(chunks_by_type.iteritems()):
+        raw_size = sum(chunk_size(chunk) for chunk in chunks)
+        result[type_name] = {}
+        for name in sorted(CODECS):
+            compressed = [compress_chunk(dict(chunk), name)
+                          for chunk in chunks]
+            compressed_size = sum(chunk_size(chunk) for chunk in compressed)
+            best = None
+            for _ in range(repeat):
+                copies = [dict(chunk) for chunk in compressed]
+                start = time.time()
+                for chunk in copies:
+                    decompress_chunk(chunk)
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            result[type_name][name] = {
+                'ratio': float(raw_size) / max(compressed_size, 1),
+                'decode_mb_per_s': (raw_size / 1e6) / max(best, 1e-9),
+            }
+    return result
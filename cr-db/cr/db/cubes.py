@@ -0,0 +1,332 @@
+"""
+Materialized cross-tab cubes.
+
+A cube is declared at load time as a group of category dimension columns
+plus numeric measure columns, for instance::
+
+    {'dimensions': ['Combined Gender', 'FormalEducation'],
+     'measures': ['SalaryAdjusted']}
+
+While the dataset is written, every chunk of rows is reduced to one cell
+per combination of dimension codes, with a vectorized ``np.bincount`` over
+the combined codes. Each cell holds the row count and, per measure, the
+count of present values, their sum and sum of squares, and a quantile
+sketch of the values (see ``cr.db.sketches``). The finished cube is
+stored in the ``dataset_cubes`` collection, so category comparisons are
+answered from its cells without reading any rows.
+
+Cube document::
+
+    {
+        '_id': ObjectId,
+        'dataset_id': ObjectId,
+        'dimensions': [header, ...],
+        'measures': [header, ...],
+        'offsets': [smallest code of each dimension, ...],
+        'shape': [cells along each dimension, ...],
+        'count': little endian int64 buffer of shape,
+        'values': [{'count': buffer, 'sum': buffer, 'sumsq': buffer}, ...],
+        'sketches': [[{'cell': flat cell index, 'sketch': sketch document},
+                      ...], ...],
+    }
+
+``values`` and ``sketches`` hold one entry per measure; only cells with
+values have a sketch.
+
+Along each dimension, cell 0 holds the rows where the dimension is missing
+and cell ``code - offset + 1`` the rows with that code.
+"""
+from bson.binary import Binary
+from bson.objectid import ObjectId
+import numpy as np
+
+from cr.db.rules import (
+    CategoryColumn,
+    DictionaryColumn,
+    FloatColumn,
+    IntColumn,
+)
+from cr.db.sketches import DEFAULT_ALPHA, QuantileSketch
+
+_STATS = ('count', 'sum', 'sumsq')
+
+_STAT_DTYPES = {'count': '<i8', 'sum': '<f8', 'sumsq': '<f8'}
+
+
+def _code_range(column_type):
+    codes = list(column_type.value_map)
+    return int(min(codes)), int(max(codes))
+
+
+class CubeBuilder(object):
+    """Accumulate a cube over the chunks of a dataset being written"""
+
+    def __init__(self, headers, column_types, dimensions, measures=(),
+                 sketch_alpha=DEFAULT_ALPHA):
+        self.dimensions = list(dimensions)
+        self.measures = list(measures)
+        self.dimension_indexes = []
+        self.offsets = []
+        self.shape = []
+        for header in self.dimensions:
+            i = headers.index(header)
+            column_type = column_types[i]
+            if (not isinstance(column_type, CategoryColumn) or
+                    isinstance(column_type, DictionaryColumn)):
+                raise ValueError(
+                    "Cube dimension is not a category column: {}".format(
+                        header))
+            low, high = _code_range(column_type)
+            self.dimension_indexes.append(i)
+            self.offsets.append(low)
+            # One more cell for missing values
+            self.shape.append(high - low + 2)
+        self.measure_indexes = []
+        for header in self.measures:
+            i = headers.index(header)
+            if not isinstance(column_types[i], (FloatColumn, IntColumn)):
+                raise ValueError(
+                    "Cube measure is not a numeric column: {}".format(header))
+            self.measure_indexes.append(i)
+        self.size = int(np.prod(self.shape))
+        self.count = np.zeros(self.size, dtype=np.int64)
+        self.values = [dict((stat, np.zeros(self.size,
+                                            dtype=_STAT_DTYPES[stat]))
+                            for stat in _STATS)
+                       for _ in self.measures]
+        self.sketch_alpha = sketch_alpha
+        # Per measure: {flat cell index: QuantileSketch}
+        self.sketches = [{} for _ in self.measures]
+
+    def _cells(self, columns):
+        """Return the flat cell index of every row of a chunk"""
+        num_rows = len(columns[0])
+        cells = np.zeros(num_rows, dtype=np.int64)
+        for i, offset, size in zip(self.dimension_indexes, self.offsets,
+                                   self.shape):
+            codes = np.fromiter(
+                (0 if code is None else code - offset + 1
+                 for code in columns[i]),
+                dtype=np.int64, count=num_rows)
+            cells = cells * size + codes
+        return cells
+
+    def add_chunk(self, columns):
+        """Add a chunk of converted columns, one list of values per header"""
+        if not columns or not len(columns[0]):
+            return
+        cells = self._cells(columns)
+        size = self.size
+        self.count += np.bincount(cells, minlength=size)
+        for i, values, sketches in zip(self.measure_indexes, self.values,
+                                       self.sketches):
+            data = np.array([np.nan if value is None else value
+                             for value in columns[i]], dtype=np.float64)
+            present = ~np.isnan(data)
+            measure_cells = cells[present]
+            data = data[present]
+            values['count'] += np.bincount(measure_cells, minlength=size)
+            values['sum'] += np.bincount(measure_cells, weights=data,
+                                         minlength=size)
+            values['sumsq'] += np.bincount(measure_cells, weights=data * data,
+                                           minlength=size)
+            self._add_sketches(sketches, measure_cells, data)
+
+    def _add_sketches(self, sketches, cells, data):
+        """Add the values to the sketch of their cell"""
+        order = np.argsort(cells, kind='mergesort')
+        cells = cells[order]
+        data = data[order]
+        unique, starts = np.unique(cells, return_index=True)
+        stops = list(starts[1:]) + [len(cells)]
+        for cell, start, stop in zip(unique.tolist(), starts, stops):
+            sketch = sketches.get(cell)
+            if sketch is None:
+                sketch = sketches[cell] = QuantileSketch(self.sketch_alpha)
+            sketch.add(data[start:stop])
+
+    def restore(self, document):
+        """Carry on from the accumulated cells of a document() result"""
+        self.count = np.frombuffer(document['count'], dtype='<i8').copy()
+        self.values = [dict((stat, np.frombuffer(values[stat],
+                                                 dtype=_STAT_DTYPES[stat]
+                                                 ).copy())
+                            for stat in _STATS)
+                       for values in document['values']]
+        self.sketches = [
+            dict((entry['cell'], QuantileSketch.from_document(entry['sketch']))
+                 for entry in sketches)
+            for sketches in document['sketches']]
+
+    def document(self, dataset_id):
+        return {
+            '_id': ObjectId(),
+            'dataset_id': dataset_id,
+            'dimensions': self.dimensions,
+            'measures': self.measures,
+            'offsets': self.offsets,
+            'shape': self.shape,
+            'count': Binary(self.count.astype('<i8').tobytes()),
+            'values': [
+                dict((stat, Binary(values[stat].astype(
+                    _STAT_DTYPES[stat]).tobytes()))
+                     for stat in _STATS)
+                for values in self.values],
+            'sketches': [
+                [{'cell': cell, 'sketch': sketch.to_document()}
+                 for cell, sketch in sorted(sketches.iteritems())]
+                for sketches in self.sketches],
+        }
+
+
+class Cube(object):
+    """
+    Query access to a stored cube. Arrays have one axis per dimension, in
+    the declared order, with cell 0 of each axis for missing values.
+
+    column_types:
+        ColumnType of each dimension, to look up the cell labels.
+    """
+
+    def __init__(self, document, column_types=None):
+        self.document = document
+        self.dimensions = document['dimensions']
+        self.measures = document['measures']
+        self.offsets = document['offsets']
+        self.shape = tuple(document['shape'])
+        self.column_types = column_types
+        self.count = self._array(document['count'], 'count')
+        self._values = [dict((stat, self._array(values[stat], stat))
+                             for stat in _STATS)
+                        for values in document['values']]
+        self._sketches = [
+            dict((entry['cell'], QuantileSketch.from_document(entry['sketch']))
+                 for entry in sketches)
+            for sketches in document.get('sketches', ())]
+
+    def _array(self, data, stat):
+        return np.frombuffer(data, dtype=_STAT_DTYPES[stat]).reshape(
+            self.shape)
+
+    def _axis(self, dimension):
+        if isinstance(dimension, (int, long)):
+            return dimension
+        return self.dimensions.index(dimension)
+
+    def _measure_index(self, measure):
+        if isinstance(measure, (int, long)):
+            return measure
+        return self.measures.index(measure)
+
+    def _measure(self, measure):
+        return self._values[self._measure_index(measure)]
+
+    def codes(self, dimension):
+        """Return the code of each cell along a dimension, None first"""
+        axis = self._axis(dimension)
+        offset = self.offsets[axis]
+        return [None] + range(offset, offset + self.shape[axis] - 1)
+
+    def labels(self, dimension):
+        """Return the label of each cell along a dimension, None first"""
+        codes = self.codes(dimension)
+        if self.column_types is None:
+            return codes
+        column_type = self.column_types[self._axis(dimension)]
+        return [None] + column_type.decode(codes[1:]).tolist()
+
+    def _reduce(self, array, keep):
+        if keep is None:
+            return array
+        axes = [self._axis(dimension) for dimension in keep]
+        other = tuple(axis for axis in range(len(self.shape))
+                      if axis not in axes)
+        array = array.sum(axis=other)
+        # Order the remaining axes as asked
+        order = sorted(range(len(axes)), key=lambda k: axes[k])
+        return array.transpose([order.index(k) for k in range(len(axes))])
+
+    def rows(self, keep=None):
+        """
+        Return the row count of every cell. keep: the dimensions to keep,
+        in order; the others are summed over. None keeps them all.
+        """
+        return self._reduce(self.count, keep)
+
+    def stat(self, measure, stat, keep=None):
+        """Return the 'count', 'sum' or 'sumsq' of a measure per cell"""
+        return self._reduce(self._measure(measure)[stat], keep)
+
+    def null_count(self, measure, keep=None):
+        """Return the number of rows per cell where the measure is missing"""
+        return self.rows(keep) - self.stat(measure, 'count', keep)
+
+    def mean(self, measure, keep=None):
+        """Return the mean of a measure per cell, NaN for empty cells"""
+        count = self.stat(measure, 'count', keep)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.stat(measure, 'sum', keep) / count
+
+    def std(self, measure, keep=None):
+        """
+        Return the population standard deviation of a measure per cell,
+        NaN for empty cells.
+        """
+        count = self.stat(measure, 'count', keep)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.stat(measure, 'sum', keep) / count
+            variance = self.stat(measure, 'sumsq', keep) / count - mean * mean
+        return np.sqrt(np.maximum(variance, 0))
+
+    def sketches(self, measure, keep=None):
+        """
+        Return {cell index tuple: QuantileSketch} of a measure for the
+        non-empty cells, with the sketches of the dimensions not kept merged
+        together.
+        """
+        sketches = self._sketches[self._measure_index(measure)]
+        if keep is None:
+            axes = range(len(self.shape))
+        else:
+            axes = [self._axis(dimension) for dimension in keep]
+        result = {}
+        for cell, sketch in sketches.iteritems():
+            index = np.unravel_index(cell, self.shape)
+            key = tuple(int(index[axis]) for axis in axes)
+            merged = result.get(key)
+            if merged is None:
+                merged = result[key] = QuantileSketch(sketch.alpha)
+            merged.merge(sketch)
+        return result
+
+    def quantile(self, measure, q, keep=None):
+        """
+        Return the q quantile (e.g. 0.5 for the median) of a measure per
+        cell, NaN for empty cells, within the relative error of the
+        sketches.
+        """
+        if keep is None:
+            shape = self.shape
+        else:
+            shape = tuple(self.shape[self._axis(dimension)]
+                          for dimension in keep)
+        result = np.full(shape, np.nan)
+        for key, sketch in self.sketches(measure, keep).iteritems():
+            result[key] = sketch.quantile(q)
+        return result
+
+
+def parse_cube_specs(specs):
+    """
+    Normalize cube declarations: a dict with 'dimensions' and optional
+    'measures', or a (dimensions, measures) pair.
+    """
+    result = []
+    for spec in specs or ():
+        if isinstance(spec, dict):
+            dimensions = spec['dimensions']
+            measures = spec.get('measures', ())
+        else:
+            dimensions, measures = spec
+        result.append((list(dimensions), list(measures)))
+    return result
@@ -0,0 +1,698 @@
+"""
+Chunked columnar dataset storage.
+
+A dataset is stored as one catalog document in the ``datasets`` collection
+plus one document per column per row range chunk in ``dataset_chunks``. The
+catalog holds the headers, row counts and per-column metadata; the chunks
+hold the column values encoded by ``cr.db.columnar``. No document grows with
+the dataset beyond the chunk size, so datasets are not limited by the 16MB
+Mongo document size.
+
+Catalog document::
+
+    {
+        '_id': ObjectId,
+        'name': source file base name,
+        'source': full path of the source file, see cr.db.sources,
+        'format': 2,
+        'version': 1; stored rows are never changed in place, see
+                   cr.db.cache,
+        'headers': [header, ...],
+        'num_rows': rows,
+        'chunk_rows': rows per chunk,
+        'num_chunks': chunks per column,
+        'column_meta': [{'type': ColumnType class name, 'dtype': dtype,
+                         'codec': compression codec name or None}, ...],
+        'dictionaries': [{'column': index, 'labels': [...],
+                          'complete': bool}, ...],
+        'sorted_by': header the rows were sorted on at load, or None,
+        'schema': [type spec, ...] of an inferred schema (see
+                  cr.db.inference), or None when the column rules apply,
+        'cubes': [{'_id': cube id, 'dimensions': [header, ...],
+                   'measures': [header, ...]}, ...],
+    }
+
+Chunk document::
+
+    {
+        '_id': '<dataset id>:<column index>:<chunk index>',
+        'dataset_id': ObjectId,
+        'column': column index,
+        'chunk': chunk index,
+        'row_start': first row of the chunk,
+        ... plus the fields from cr.db.columnar.encode_chunk(), including
+        the 'min' / 'max' zone map of fixed width columns
+    }
+
+Range filters (``Dataset.matching_chunks()``, ``Dataset.filter_range()``)
+read the zone maps first and only fetch the chunks that can hold matching
+rows. Loading with ``sort_by`` clusters the rows on one column, which makes
+its zone maps, and those of correlated columns, much more selective.
+
+Cross-tab cubes declared at load time are stored in ``dataset_cubes``, see
+``cr.db.cubes``. Float columns get a quantile sketch (``cr.db.sketches``),
+stored in ``dataset_sketches`` with the ``_id`` '<dataset id>:<column>'.
+
+While a checkpointed load runs, the dictionaries, sketches and cubes built
+so far are kept in ``ingest_state``, see ``DatasetWriter.save_state()``.
+"""
+from bson.objectid import ObjectId
+import numpy as np
+import pymongo
+
+from cr.db import cache, columnar, compression, metrics
+from cr.db.cubes import Cube, CubeBuilder, parse_cube_specs
+from cr.db.indexes import ensure_indexes
+from cr.db.inference import column_types_from_specs
+from cr.db.rules import (
+    DictionaryColumn,
+    FloatColumn,
+    STR_COLUMN,
+    StrColumn,
+    get_converter_funcs,
+)
+from cr.db.sketches import DEFAULT_ALPHA, QuantileSketch
+
+FORMAT_VERSION = 2
+
+# Default number of rows per chunk
+CHUNK_ROWS = 2**16
+
+# String columns are dictionary encoded when the first chunk has at most
+# this many distinct values, and at most this many distinct values per
+# non-empty cell. A dictionary that later outgrows DICTIONARY_MAX_SIZE stops
+# growing and the remaining chunks store plain strings.
+DICTIONARY_MAX_SIZE = 1024
+DICTIONARY_MAX_RATIO = 0.5
+
+
+def chunk_id(dataset_id, column, chunk):
+    return '{}:{}:{}'.format(dataset_id, column, chunk)
+
+
+def ensure_chunk_indexes(db):
+    ensure_indexes(db, ['dataset_chunks'])
+
+
+class DatasetWriter(object):
+    """
+    Write a dataset chunk by chunk. Feed it converted columns with
+    write_chunk(), then call finish() to store the catalog document. The
+    dataset is invisible to readers until finish() has run.
+    """
+
+    def __init__(self, db, headers, column_types, name=None,
+                 chunk_rows=CHUNK_ROWS,
+                 sparse_ratio=columnar.SPARSE_NULL_RATIO,
+                 dictionary_encode=True, codecs=None, sorted_by=None,
+                 cubes=None, sketch_alpha=DEFAULT_ALPHA, dataset_id=None,
+                 schema=None, source=None):
+        """
+        source:
+            Full path of the source file, see cr.db.sources.source_path().
+            finish(replace=True) replaces the datasets of the same source.
+        schema:
+            Type specs the column types were made from, if they were
+            inferred, see cr.db.inference. Recorded in the catalog so
+            readers get the same column types back.
+        sketch_alpha:
+            Relative error of the quantile sketches of float columns and
+            cube measures.
+        cubes:
+            Cross-tab cubes to build while writing, as a list of
+            {'dimensions': [header, ...], 'measures': [header, ...]}.
+        sorted_by:
+            Header the rows are written in order of, if any.
+        codecs:
+            Compression for the column chunks: None, a codec name for every
+            column, 'auto' to pick the smallest codec per column from its
+            first chunk, or a {header: codec name or 'auto'} dictionary.
+        """
+        self.db = db
+        self.dataset_id = dataset_id or ObjectId()
+        self.headers = headers
+        self.column_types = column_types
+        self.name = name
+        self.source = source
+        self.chunk_rows = chunk_rows
+        self.sparse_ratio = sparse_ratio
+        self.num_rows = 0
+        self.num_chunks = 0
+        self.dictionary_encode = dictionary_encode
+        self.sorted_by = sorted_by
+        self.schema = schema
+        # {column index: DictionaryColumn} for dictionary encoded columns
+        self.dictionaries = {}
+        self.incomplete_dictionaries = set()
+        if not isinstance(codecs, dict):
+            codecs = dict((header, codecs) for header in headers)
+        self.codecs = [codecs.get(header) for header in headers]
+        for codec in self.codecs:
+            if codec not in (None, 'auto') and codec not in compression.CODECS:
+                raise ValueError("Unknown codec: {}".format(codec))
+        self.cubes = [CubeBuilder(headers, column_types, dimensions, measures,
+                                  sketch_alpha)
+                      for dimensions, measures in parse_cube_specs(cubes)]
+        self.sketches = dict((i, QuantileSketch(sketch_alpha))
+                             for i, column_type in enumerate(column_types)
+                             if isinstance(column_type, FloatColumn))
+        ensure_chunk_indexes(db)
+
+    def _dictionary_values(self, i, values):
+        """
+        Return (values, dtype) to store for the string column i, as
+        dictionary codes when the column is dictionary encoded.
+        """
+        dictionary = self.dictionaries.get(i)
+        if dictionary is None:
+            if self.num_chunks > 0:
+                return values, columnar.OBJECT
+            distinct = set(values)
+            distinct.discard(None)
+            non_null = len(values) - values.count(None)
+            if (not distinct or len(distinct) > DICTIONARY_MAX_SIZE or
+                    len(distinct) > non_null * DICTIONARY_MAX_RATIO):
+                return values, columnar.OBJECT
+            dictionary = self.dictionaries[i] = DictionaryColumn(
+                sorted(distinct))
+        elif i in self.incomplete_dictionaries:
+            return values, columnar.OBJECT
+
+        num_labels = len(dictionary.labels)
+        codes = [None if value is None else dictionary.add(value)
+                 for value in values]
+        if len(dictionary.labels) > DICTIONARY_MAX_SIZE:
+            # Outgrown: forget this chunk's new labels, store strings
+            for label in dictionary.labels[num_labels:]:
+                del dictionary.value_map[dictionary.category_map_orig.pop(
+                    label)]
+            del dictionary.labels[num_labels:]
+            self.incomplete_dictionaries.add(i)
+            return values, columnar.OBJECT
+        return codes, DictionaryColumn.dtype
+
+    def encode_chunk(self, i, values):
+        column_type = self.column_types[i]
+        if self.dictionary_encode and isinstance(column_type, StrColumn):
+            values, dtype = self._dictionary_values(i, values)
+        else:
+            dtype = column_type.dtype
+        chunk = columnar.encode_chunk(values, dtype, self.sparse_ratio)
+        codec = self.codecs[i]
+        if codec == 'auto':
+            codec = self.codecs[i] = compression.choose_codec(chunk)
+        if codec is not None:
+            compression.compress_chunk(chunk, codec)
+        chunk.update({
+            '_id': chunk_id(self.dataset_id, i, self.num_chunks),
+            'dataset_id': self.dataset_id,
+            'column': i,
+            'chunk': self.num_chunks,
+            'row_start': self.num_rows,
+        })
+        return chunk
+
+    def write_chunk(self, columns):
+        """
+        Store one chunk of rows.
+        columns:
+            One list of converted values per header, all of the same length.
+        """
+        num_rows = len(columns[0]) if columns else 0
+        if not num_rows:
+            return
+        if self.cubes:
+            with metrics.timer('cr_load_stage_seconds', stage='cube'):
+                for cube in self.cubes:
+                    cube.add_chunk(columns)
+        if self.sketches:
+            with metrics.timer('cr_load_stage_seconds', stage='sketch'):
+                for i, sketch in self.sketches.iteritems():
+                    sketch.add([np.nan if value is None else value
+                                for value in columns[i]])
+        with metrics.timer('cr_load_stage_seconds', stage='encode'):
+            chunks = [self.encode_chunk(i, values)
+                      for i, values in enumerate(columns)]
+        with metrics.timer('cr_load_stage_seconds', stage='insert'):
+            self.db.dataset_chunks.insert_many(chunks, ordered=False)
+        self.num_rows += num_rows
+        self.num_chunks += 1
+
+    def state(self):
+        """
+        Return the counters a writer needs to carry on after the chunks
+        written so far, as a small storable dictionary. The dictionaries,
+        sketches and cubes are saved separately by save_state().
+        """
+        return {
+            'dataset_id': self.dataset_id,
+            'num_rows': self.num_rows,
+            'num_chunks': self.num_chunks,
+            'codecs': self.codecs,
+        }
+
+    def save_state(self):
+        """
+        Store the dictionaries, sketches and cubes built so far in
+        ``ingest_state``, one document each, and return state(). Documents
+        alternate between two slots, so those of the previous checkpoint
+        stay intact until the new checkpoint is recorded.
+        """
+        slot = self.num_chunks % 2
+        documents = [
+            ('dictionary', i, {'labels': dictionary.labels,
+                               'complete':
+                               i not in self.incomplete_dictionaries})
+            for i, dictionary in sorted(self.dictionaries.iteritems())]
+        documents.extend(('sketch', i, sketch.to_document())
+                         for i, sketch in sorted(self.sketches.iteritems()))
+        documents.extend(('cube', k, cube.document(self.dataset_id))
+                         for k, cube in enumerate(self.cubes))
+        self.db.ingest_state.delete_many(
+            {'dataset_id': self.dataset_id, 'slot': slot})
+        if documents:
+            self.db.ingest_state.insert_many([
+                {'_id': '{}:{}:{}:{}'.format(self.dataset_id, kind, key,
+                                             slot),
+                 'dataset_id': self.dataset_id,
+                 'slot': slot,
+                 'num_chunks': self.num_chunks,
+                 'kind': kind,
+                 'key': key,
+                 'state': state}
+                for kind, key, state in documents])
+        return self.state()
+
+    def restore(self, state):
+        """
+        Carry on writing a dataset from a save_state() checkpoint. Chunks,
+        cubes, sketches and catalog stored after the checkpoint are
+        deleted, so the rows after it can be written again without
+        duplicates.
+        """
+        self.dataset_id = state['dataset_id']
+        self.num_rows = state['num_rows']
+        self.num_chunks = state['num_chunks']
+        self.codecs = state['codecs']
+        self.dictionaries = {}
+        self.incomplete_dictionaries = set()
+        for document in self.db.ingest_state.find(
+                {'dataset_id': self.dataset_id,
+                 'slot': self.num_chunks % 2,
+                 'num_chunks': self.num_chunks}):
+            key, saved = document['key'], document['state']
+            if document['kind'] == 'dictionary':
+                self.dictionaries[key] = DictionaryColumn(saved['labels'])
+                if not saved['complete']:
+                    self.incomplete_dictionaries.add(key)
+            elif document['kind'] == 'sketch':
+                self.sketches[key] = QuantileSketch.from_document(saved)
+            else:
+                self.cubes[key].restore(saved)
+        self.db.dataset_chunks.delete_many(
+            {'dataset_id': self.dataset_id,
+             'chunk': {'$gte': self.num_chunks}})
+        self.db.datasets.delete_one({'_id': self.dataset_id})
+        self.db.dataset_cubes.delete_many({'dataset_id': self.dataset_id})
+        self.db.dataset_sketches.delete_many({'dataset_id': self.dataset_id})
+
+    def catalog_document(self, cube_documents=()):
+        column_meta = []
+        for i, column_type in enumerate(self.column_types):
+            dtype = column_type.dtype
+            type_name = type(column_type).__name__
+            if i in self.dictionaries:
+                if i in self.incomplete_dictionaries:
+                    dtype = columnar.OBJECT
+                else:
+                    dtype = DictionaryColumn.dtype
+                    type_name = DictionaryColumn.__name__
+            column_meta.append({'type': type_name, 'dtype': dtype,
+                                'codec': self.codecs[i]})
+        return {
+            '_id': self.dataset_id,
+            'name': self.name,
+            'source': self.source,
+            'format': FORMAT_VERSION,
+            'version': 1,
+            'headers': self.headers,
+            'num_rows': self.num_rows,
+            'chunk_rows': self.chunk_rows,
+            'num_chunks': self.num_chunks,
+            'column_meta': column_meta,
+            'dictionaries': [
+                {'column': i,
+                 'labels': dictionary.labels,
+                 'complete': i not in self.incomplete_dictionaries}
+                for i, dictionary in sorted(self.dictionaries.iteritems())],
+            'sorted_by': self.sorted_by,
+            'schema': self.schema,
+            'cubes': [{'_id': cube['_id'],
+                       'dimensions': cube['dimensions'],
+                       'measures': cube['measures']}
+                      for cube in cube_documents],
+        }
+
+    def finish(self, replace=False):
+        """
+        Store the cubes and catalog document. Return the dataset id.
+        With replace, then delete the other datasets of the same source
+        and name, so readers switch from the old dataset to the new one
+        without a gap.
+        """
+        cube_documents = [cube.document(self.dataset_id)
+                          for cube in self.cubes]
+        if cube_documents:
+            self.db.dataset_cubes.insert_many(cube_documents)
+        if self.sketches:
+            self.db.dataset_sketches.insert_many([
+                {'_id': '{}:{}'.format(self.dataset_id, i),
+                 'dataset_id': self.dataset_id,
+                 'column': i,
+                 'sketch': sketch.to_document()}
+                for i, sketch in sorted(self.sketches.iteritems())])
+        self.db.datasets.insert_one(self.catalog_document(cube_documents))
+        self.db.ingest_state.delete_many({'dataset_id': self.dataset_id})
+        if replace:
+            for document in self.db.datasets.find(
+                    {'name': self.name, 'source': self.source,
+                     '_id': {'$ne': self.dataset_id}},
+                    {'_id': True}):
+                delete_dataset(self.db, document['_id'])
+        return self.dataset_id
+
+
+def delete_dataset(db, dataset_id):
+    """
+    Delete a dataset. The catalog document goes first, so readers never see
+    a partly deleted dataset.
+    """
+    db.datasets.delete_one({'_id': dataset_id})
+    db.dataset_chunks.delete_many({'dataset_id': dataset_id})
+    db.dataset_cubes.delete_many({'dataset_id': dataset_id})
+    db.dataset_sketches.delete_many({'dataset_id': dataset_id})
+    db.ingest_state.delete_many({'dataset_id': dataset_id})
+    cache.invalidate(dataset_id)
+
+
+def get_column_types(dataset):
+    """
+    Return the ColumnType of every column of a dataset document (a catalog
+    document or a load_dataset_to_dict() result), for reverse lookups of
+    the stored values.
+    """
+    if dataset.get('schema'):
+        column_types = column_types_from_specs(dataset['headers'],
+                                               dataset['schema'])
+    else:
+        column_types = get_converter_funcs(dataset['headers'])
+    for dictionary in dataset.get('dictionaries', ()):
+        if dictionary.get('complete', True):
+            column_types[dictionary['column']] = DictionaryColumn(
+                dictionary['labels'])
+        else:
+            column_types[dictionary['column']] = STR_COLUMN
+    return column_types
+
+
+class Dataset(object):
+    """Read access to a stored dataset"""
+
+    def __init__(self, db, document):
+        self.db = db
+        self.document = document
+        self.dataset_id = document['_id']
+        self.headers = document['headers']
+        self.num_rows = document['num_rows']
+        self.num_chunks = document['num_chunks']
+        self.version = document.get('version', 1)
+        self.column_types = get_column_types(document)
+        # Labels to decode stored codes of columns whose dictionary was
+        # outgrown part way through loading
+        self._partial_labels = dict(
+            (d['column'], np.array([None] + d['labels'], dtype=object))
+            for d in document.get('dictionaries', ())
+            if not d.get('complete', True))
+
+    def column_index(self, key):
+        """Return the index of a column given its index or (first) header"""
+        if isinstance(key, (int, long)):
+            return key
+        return self.headers.index(key)
+
+    def column_type(self, key):
+        return self.column_types[self.column_index(key)]
+
+    def _decode(self, i, chunk):
+        array = columnar.decode_chunk(chunk)
+        labels = self._partial_labels.get(i)
+        if labels is not None and chunk['dtype'] != columnar.OBJECT:
+            array = np.ma.masked_array(labels[array.filled(0)],
+                                       mask=np.ma.getmaskarray(array))
+        return array
+
+    def iter_chunks(self, key, chunks=None):
+        """
+        Yield the column's chunks, in row order, as masked arrays.
+        chunks:
+            Only read the chunks with these indexes.
+        """
+        i = self.column_index(key)
+        query = {'dataset_id': self.dataset_id, 'column': i}
+        if chunks is not None:
+            query['chunk'] = {'$in': list(chunks)}
+        cursor = self.db.dataset_chunks.find(query).sort('chunk',
+                                                         pymongo.ASCENDING)
+        for chunk in cursor:
+            yield self._decode(i, chunk)
+
+    def iter_row_chunks(self, keys=None, start=0, stop=None):
+        """
+        Yield the rows start to stop (exclusive) of some columns, one
+        storage chunk at a time, as (first row, [masked array per column]).
+        keys:
+            The columns, by index or header. None for all columns.
+        Only one chunk of each column is in memory at a time.
+        """
+        if keys is None:
+            indexes = range(len(self.headers))
+        else:
+            indexes = [self.column_index(key) for key in keys]
+        stop = self.num_rows if stop is None else min(stop, self.num_rows)
+        start = max(start, 0)
+        if start >= stop:
+            return
+        query = {'dataset_id': self.dataset_id}
+        if keys is not None:
+            query['column'] = {'$in': sorted(set(indexes))}
+        for zone in self.zone_maps(0):
+            row_start = zone['row_start']
+            if row_start >= stop:
+                break
+            if row_start + zone['num_rows'] <= start:
+                continue
+            query['chunk'] = zone['chunk']
+            cursor = self.db.dataset_chunks.find(query)
+            chunks = dict((document['column'], document)
+                          for document in cursor)
+            low = max(start - row_start, 0)
+            high = stop - row_start
+            yield row_start + low, [self._decode(i, chunks[i])[low:high]
+                                    for i in indexes]
+
+    def zone_maps(self, key):
+        """
+        Return the zone map of each of the column's chunks, in row order:
+        [{'chunk', 'row_start', 'num_rows', 'null_count', 'encoding',
+          'min', 'max'}, ...]. 'min' and 'max' are left out for columns
+        without fixed width values.
+        """
+        i = self.column_index(key)
+        fields = ('chunk', 'row_start', 'num_rows', 'null_count', 'encoding',
+                  'min', 'max')
+        cursor = self.db.dataset_chunks.find(
+            {'dataset_id': self.dataset_id, 'column': i},
+            dict((field, True) for field in fields + ('_id',))
+        ).sort('chunk', pymongo.ASCENDING)
+        return [dict((field, zone[field]) for field in fields
+                     if field in zone)
+                for zone in cursor]
+
+    def matching_chunks(self, key, low=None, high=None):
+        """
+        Return the indexes of the chunks whose values of the column may lie
+        in [low, high], going by the zone maps. None bounds are open.
+        """
+        return [zone['chunk'] for zone in self.zone_maps(key)
+                if columnar.may_match(zone, low, high)]
+
+    def filter_range(self, key, low=None, high=None, columns=()):
+        """
+        Select the rows where low <= column key <= high (None bounds are
+        open; missing values never match), reading only the chunks that may
+        hold such rows.
+
+        Return {'rows': row numbers, key: values, column: values, ...} with
+        the values of key and of each of the columns for the selected rows,
+        as masked arrays.
+        """
+        zones = [zone for zone in self.zone_maps(key)
+                 if columnar.may_match(zone, low, high)]
+        chunks = [zone['chunk'] for zone in zones]
+        selected = []
+        rows = []
+        parts = {key: []}
+        for zone, values in zip(zones, self.iter_chunks(key, chunks)):
+            match = ~np.ma.getmaskarray(values)
+            if low is not None:
+                match &= (values >= low).filled(False)
+            if high is not None:
+                match &= (values <= high).filled(False)
+            selected.append(match)
+            rows.append(np.flatnonzero(match) + zone['row_start'])
+            parts[key].append(values[match])
+        for column in columns:
+            if column not in parts:
+                parts[column] = [
+                    values[match] for match, values in
+                    zip(selected, self.iter_chunks(column, chunks))]
+        result = {'rows': (np.concatenate(rows) if rows
+                           else np.zeros(0, dtype=np.int64))}
+        for column, column_parts in parts.iteritems():
+            if column_parts:
+                result[column] = np.ma.concatenate(column_parts)
+            else:
+                result[column] = np.ma.masked_array(
+                    np.zeros(0, dtype=self.dtype(column)))
+        return result
+
+    def take(self, rows, columns=()):
+        """
+        Select rows by number, reading only the chunks that hold them.
+
+        Return {'rows': the sorted distinct row numbers, column: values, ...}
+        with the values of each of the columns as masked arrays.
+        Raise IndexError for a row number out of range.
+        """
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        if len(rows) and (rows[0] < 0 or rows[-1] >= self.num_rows):
+            raise IndexError("Row number out of range")
+        zones = self.zone_maps(0)
+        row_starts = np.array([zone['row_start'] for zone in zones],
+                              dtype=np.int64)
+        positions = np.searchsorted(row_starts, rows, side='right') - 1
+        chunks = []
+        offsets = []
+        for position in np.unique(positions).tolist():
+            chunks.append(zones[position]['chunk'])
+            offsets.append(rows[positions == position] - row_starts[position])
+        result = {'rows': rows}
+        for column in columns:
+            parts = [values[chunk_offsets] for chunk_offsets, values in
+                     zip(offsets, self.iter_chunks(column, chunks))]
+            if parts:
+                result[column] = np.ma.concatenate(parts)
+            else:
+                result[column] = np.ma.masked_array(
+                    np.zeros(0, dtype=self.dtype(column)))
+        return result
+
+    def count_true(self, key):
+        """
+        Return the number of True values in a boolean column, counted on
+        the bit packed chunks without decoding them.
+        """
+        i = self.column_index(key)
+        if self.dtype(i) != np.dtype(columnar.BOOL):
+            raise TypeError("Not a boolean column: {}".format(key))
+        cursor = self.db.dataset_chunks.find(
+            {'dataset_id': self.dataset_id, 'column': i},
+            {'encoding': True, 'values': True, 'dtype': True, 'bits': True,
+             'codec': True, 'compressed': True})
+        return sum(columnar.count_true(chunk) for chunk in cursor)
+
+    def column(self, key, masked=True):
+        """
+        Return a whole column as a NumPy masked array, with missing values
+        masked. With masked=False, return a plain array instead: numeric
+        columns as float64 with NaN for missing values, object columns with
+        None for missing values.
+
+        Columns are kept in the process wide cr.db.cache column cache and
+        shared between callers, so the returned arrays, data and mask, are
+        read only.
+        """
+        cache_key = (self.dataset_id, self.version, self.column_index(key))
+        array = cache.get(cache_key)
+        if array is None:
+            chunks = list(self.iter_chunks(key))
+            if chunks:
+                array = np.ma.concatenate(chunks)
+            else:
+                array = np.ma.masked_array(
+                    np.zeros(0, dtype=self.dtype(key)))
+            data, mask = array.data, np.ma.getmaskarray(array)
+            data.setflags(write=False)
+            mask.setflags(write=False)
+            array = np.ma.masked_array(data, mask=mask, copy=False)
+            cache.put(cache_key, array)
+        if masked:
+            # A view of its own, so that attributes set by one caller do
+            # not reach the others
+            return np.ma.masked_array(array.data, mask=array.mask,
+                                      copy=False)
+        if array.dtype == object:
+            return array.filled(None)
+        return array.astype(np.float64).filled(np.nan)
+
+    def cube(self, dimensions):
+        """
+        Return the stored Cube over the given dimension headers, in any
+        order. Raise KeyError if no such cube was built at load time.
+        """
+        for entry in self.document.get('cubes', ()):
+            if sorted(entry['dimensions']) == sorted(dimensions):
+                document = self.db.dataset_cubes.find_one(
+                    {'_id': entry['_id']})
+                if document is None:
+                    break
+                return Cube(document,
+                            [self.column_type(dimension)
+                             for dimension in document['dimensions']])
+        raise KeyError(tuple(dimensions))
+
+    def sketch(self, key):
+        """
+        Return the QuantileSketch of a float column.
+        Raise KeyError if the column has none.
+        """
+        i = self.column_index(key)
+        document = self.db.dataset_sketches.find_one(
+            {'_id': '{}:{}'.format(self.dataset_id, i)})
+        if document is None:
+            raise KeyError(key)
+        return QuantileSketch.from_document(document['sketch'])
+
+    def quantiles(self, key, qs):
+        """
+        Return the values of a float column at the quantiles qs (e.g.
+        [0.5, 0.9] for the median and 90th percentile), from its sketch.
+        """
+        return self.sketch(key).quantiles(qs)
+
+    def dtype(self, key):
+        meta = self.document['column_meta'][self.column_index(key)]
+        return np.dtype(meta['dtype'])
+
+
+def open_dataset(db, dataset_id):
+    """
+    Return the Dataset with the given id (an ObjectId or its hex string).
+    Raise KeyError if there is no such dataset.
+    """
+    if not isinstance(dataset_id, ObjectId):
+        dataset_id = ObjectId(dataset_id)
+    document = db.datasets.find_one({'_id': dataset_id})
+    if document is None:
+        raise KeyError(dataset_id)
+    return Dataset(db, document)
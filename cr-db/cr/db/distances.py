@@ -0,0 +1,224 @@
+"""
+Great circle distances between user pairs.
+
+``pair_statistics()`` summarizes the distance of every pair of users. The
+n * (n - 1) / 2 distances are never held at once: the pairs are visited in
+square tiles of TILE_SIZE by TILE_SIZE users, so memory stays at a few
+tiles of float64 whatever the number of users. Each tile's count, mean
+and sum of squared deviations are merged into the running totals with
+Chan's parallel update, which stays accurate over billions of pairs.
+
+``pair_summary()`` also counts the distances into histogram bins in the
+same pass, adding up ``np.histogram()`` counts per tile. ``SummaryCache``
+keeps the summaries of the last few bin layouts asked for, until the
+positions they were computed from change.
+"""
+from collections import OrderedDict
+import threading
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Half the circumference: no two points are further apart. Worked out as
+# haversine() does, so antipodes are not a rounding error past it.
+MAX_DISTANCE_KM = 2 * EARTH_RADIUS_KM * np.arcsin(1.0)
+
+DEFAULT_BINS = 20
+
+# Users per tile side: a tile of distances is TILE_SIZE**2 * 8 bytes
+TILE_SIZE = 2048
+
+# Summaries (bin layouts) SummaryCache keeps per version of the positions
+MAX_SUMMARIES = 8
+
+
+def to_radians(latitudes, longitudes):
+    """Return (latitude radians, longitude radians, cosine of latitude)"""
+    latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+    longitudes = np.radians(np.asarray(longitudes, dtype=np.float64))
+    return latitudes, longitudes, np.cos(latitudes)
+
+
+def haversine(lat1, lon1, cos1, lat2, lon2, cos2):
+    """
+    Return the distances in km between points given in radians, with the
+    cosines of their latitudes. Broadcasts like NumPy arithmetic.
+    """
+    a = (np.sin((lat2 - lat1) / 2) ** 2 +
+         cos1 * cos2 * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def iter_pair_tiles(latitudes, longitudes, tile_size=TILE_SIZE):
+    """
+    Yield the distances of every pair of distinct points once, as flat
+    arrays of at most tile_size**2 distances.
+    """
+    lat, lon, cos = to_radians(latitudes, longitudes)
+    n = len(lat)
+    for start in xrange(0, n, tile_size):
+        stop = min(start + tile_size, n)
+        rows = slice(start, stop)
+        for other in xrange(start, n, tile_size):
+            columns = slice(other, min(other + tile_size, n))
+            tile = haversine(lat[rows, np.newaxis], lon[rows, np.newaxis],
+                             cos[rows, np.newaxis],
+                             lat[columns], lon[columns], cos[columns])
+            if other == start:
+                # Same block: the pairs above the diagonal only
+                yield tile[np.triu_indices(stop - start, 1)]
+            else:
+                yield tile.ravel()
+
+
+class PairStats(object):
+    """Running count, min, max, mean and variance of distances"""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, distances):
+        count = len(distances)
+        if not count:
+            return
+        mean = distances.mean()
+        m2 = ((distances - mean) ** 2).sum()
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+        low, high = distances.min(), distances.max()
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+
+    def result(self):
+        if not self.count:
+            return {'pairs': 0, 'min': None, 'max': None, 'mean': None,
+                    'std': None}
+        return {
+            'pairs': self.count,
+            'min': float(self.min),
+            'max': float(self.max),
+            'mean': float(self.mean),
+            'std': float(np.sqrt(self.m2 / self.count)),
+        }
+
+
+def histogram_edges(bins=DEFAULT_BINS, low=None, high=MAX_DISTANCE_KM,
+                    log=False):
+    """
+    Return the edges of bins histogram bins from low to high km, equal
+    width, or equal on a log scale with log. Log bins start at low (1 km
+    by default) and get an extra first bin from 0 to low.
+    """
+    if bins < 1:
+        raise ValueError("At least one bin is needed")
+    if log:
+        low = 1.0 if low is None else low
+        if not 0 < low < high:
+            raise ValueError("Log bins need 0 < low < high")
+        return np.concatenate([[0.0], np.logspace(np.log10(low),
+                                                  np.log10(high), bins + 1)])
+    low = 0.0 if low is None else low
+    if not low < high:
+        raise ValueError("Bins need low < high")
+    return np.linspace(low, high, bins + 1)
+
+
+class PairHistogram(object):
+    """
+    Running histogram of distances over fixed bin edges. The last bin
+    includes its upper edge; distances outside the edges are counted as
+    'under' or 'over'.
+    """
+
+    def __init__(self, edges):
+        self.edges = np.asarray(edges, dtype=np.float64)
+        if len(self.edges) < 2 or (np.diff(self.edges) <= 0).any():
+            raise ValueError("Bin edges must be increasing")
+        self.counts = np.zeros(len(self.edges) - 1, dtype=np.int64)
+        self.under = 0
+        self.over = 0
+
+    def add(self, distances):
+        self.counts += np.histogram(distances, self.edges)[0]
+        self.under += int((distances < self.edges[0]).sum())
+        self.over += int((distances > self.edges[-1]).sum())
+
+    def result(self):
+        return {
+            'edges': self.edges.tolist(),
+            'counts': self.counts.tolist(),
+            'cumulative': (self.under + np.cumsum(self.counts)).tolist(),
+            'under': self.under,
+            'over': self.over,
+        }
+
+
+def pair_summary(latitudes, longitudes, edges=None, tile_size=TILE_SIZE):
+    """
+    Return the min, max, mean and (population) standard deviation of the
+    distance in km between every pair of points, and with edges, their
+    histogram, all in one tiled pass:
+    {'users', 'pairs', 'min', 'max', 'mean', 'std'[, 'histogram']}.
+    See PairHistogram.result() for the histogram.
+    """
+    stats = PairStats()
+    histogram = None if edges is None else PairHistogram(edges)
+    for distances in iter_pair_tiles(latitudes, longitudes, tile_size):
+        stats.add(distances)
+        if histogram is not None:
+            histogram.add(distances)
+    result = stats.result()
+    result['users'] = len(latitudes)
+    if histogram is not None:
+        result['histogram'] = histogram.result()
+    return result
+
+
+def pair_statistics(latitudes, longitudes, tile_size=TILE_SIZE):
+    """Return pair_summary() without a histogram"""
+    return pair_summary(latitudes, longitudes, tile_size=tile_size)
+
+
+class SummaryCache(object):
+    """
+    Pair summaries of one version of the positions, by histogram edges.
+    Summaries of older versions are dropped as soon as a newer version is
+    asked for, and beyond max_entries bin layouts, the least recently used
+    ones are.
+    """
+
+    def __init__(self, max_entries=MAX_SUMMARIES):
+        self.max_entries = max_entries
+        self.version = None
+        self.summaries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, version, edges, compute):
+        """
+        Return the summary for the positions version and the edges (None
+        for no histogram), calling compute(edges) if it is not cached.
+        """
+        key = None if edges is None else tuple(edges)
+        with self.lock:
+            if version != self.version:
+                self.version = version
+                self.summaries = OrderedDict()
+            summary = self.summaries.pop(key, None)
+            if summary is not None:
+                self.summaries[key] = summary
+        if summary is None:
+            summary = compute(edges)
+            with self.lock:
+                if version == self.version:
+                    self.summaries[key] = summary
+                    while len(self.summaries) > self.max_entries:
+                        self.summaries.popitem(last=False)
+        return summary
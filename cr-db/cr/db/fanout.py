@@ -0,0 +1,168 @@
+"""
+Fan-out execution of one query over many datasets.
+
+A query is an object with three methods:
+
+run(dataset)
+    Compute a partial result over one ``cr.db.dataset.Dataset``.
+merge(partial, other)
+    Combine two partial results, return the combination.
+finish(partial)
+    Turn the merged partial result into the final answer.
+
+``iter_fan_out()`` runs the query over every dataset in a process pool and
+yields the partial results as the datasets finish; ``fan_out()`` merges
+them. Each worker opens its own Mongo connection from the settings. Memory
+per worker is bounded by recycling workers after a number of datasets and,
+optionally, by an address space limit. Queries must be picklable, so define
+them at module level.
+"""
+import multiprocessing
+
+from cr.db.dataset import open_dataset
+from cr.db.sketches import DEFAULT_ALPHA, QuantileSketch
+from cr.db.store import Settings, connect
+
+# Datasets a worker process handles before it is replaced, so memory
+# fragmentation and caches cannot build up over thousands of datasets
+DATASETS_PER_WORKER = 50
+
+_worker_db = None
+
+
+def _init_worker(settings, memory_limit):
+    global _worker_db
+    if memory_limit:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    _worker_db = connect(Settings(settings))
+
+
+def _run(args):
+    query, dataset_id = args
+    return dataset_id, query.run(open_dataset(_worker_db, dataset_id))
+
+
+def resolve_datasets(db, datasets):
+    """
+    Return a list of dataset ids given a list of ids or a catalog query
+    (a filter dictionary on the datasets collection).
+    """
+    if isinstance(datasets, dict):
+        return [document['_id'] for document in
+                db.datasets.find(datasets, {'_id': True})]
+    return list(datasets)
+
+
+def iter_fan_out(settings, datasets, query, processes=None,
+                 memory_limit=None, datasets_per_worker=DATASETS_PER_WORKER):
+    """
+    Run query over the datasets, yielding (dataset id, partial result)
+    pairs in the order the datasets finish.
+
+    datasets:
+        List of dataset ids, or a catalog query.
+    processes:
+        Worker processes, by default one per CPU. With 1, run in this
+        process.
+    memory_limit:
+        Address space limit of each worker, in bytes.
+    """
+    db = connect(Settings(settings))
+    try:
+        dataset_ids = resolve_datasets(db, datasets)
+        if processes == 1:
+            for dataset_id in dataset_ids:
+                yield dataset_id, query.run(open_dataset(db, dataset_id))
+            return
+    finally:
+        # connect() opens a client per call
+        db.client.close()
+
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (dict(settings), memory_limit),
+                                maxtasksperchild=datasets_per_worker)
+    try:
+        for result in pool.imap_unordered(
+                _run, [(query, dataset_id) for dataset_id in dataset_ids]):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def fan_out(settings, datasets, query, **kwargs):
+    """
+    Run query over the datasets and return the final merged result, or
+    None if there were no datasets. Takes the iter_fan_out() arguments.
+    """
+    total = None
+    for _, partial in iter_fan_out(settings, datasets, query, **kwargs):
+        total = partial if total is None else query.merge(total, partial)
+    if total is None:
+        return None
+    return query.finish(total)
+
+
+class RangeAggregate(object):
+    """
+    Count the rows where low <= column <= high and, optionally, summarize
+    a numeric measure over those rows: count, sum, mean, std, min, max and
+    quantiles from a merged sketch. Reads only the chunks the zone maps
+    allow, see Dataset.filter_range().
+    """
+
+    def __init__(self, column, low=None, high=None, measure=None,
+                 quantiles=(0.5,), sketch_alpha=DEFAULT_ALPHA):
+        self.column = column
+        self.low = low
+        self.high = high
+        self.measure = measure
+        self.quantiles = quantiles
+        self.sketch_alpha = sketch_alpha
+
+    def run(self, dataset):
+        columns = [self.measure] if self.measure is not None else []
+        selected = dataset.filter_range(self.column, self.low, self.high,
+                                        columns)
+        partial = {'datasets': 1, 'rows': len(selected['rows'])}
+        if self.measure is not None:
+            values = selected[self.measure].compressed().astype(float)
+            sketch = QuantileSketch(self.sketch_alpha)
+            sketch.add(values)
+            partial.update({
+                'count': len(values),
+                'sum': float(values.sum()),
+                'sumsq': float((values * values).sum()),
+                'sketch': sketch,
+            })
+        return partial
+
+    def merge(self, partial, other):
+        for key in ('datasets', 'rows', 'count', 'sum', 'sumsq'):
+            if key in partial:
+                partial[key] += other[key]
+        if 'sketch' in partial:
+            partial['sketch'].merge(other['sketch'])
+        return partial
+
+    def finish(self, partial):
+        result = {'datasets': partial['datasets'], 'rows': partial['rows']}
+        if 'sketch' in partial:
+            count = partial['count']
+            sketch = partial['sketch']
+            mean = std = None
+            if count:
+                mean = partial['sum'] / count
+                std = max(partial['sumsq'] / count - mean * mean, 0) ** 0.5
+            result.update({
+                'count': count,
+                'sum': partial['sum'],
+                'mean': mean,
+                'std': std,
+                'min': sketch.min,
+                'max': sketch.max,
+                'quantiles': dict(zip(self.quantiles,
+                                      sketch.quantiles(self.quantiles))),
+            })
+        return result
@@ -1,39 +1,92 @@
 """
-Helper functions, runnable as a script
+Helper functions, runnable as a script::
+
+    python -m cr.db.helper [--settings FILE] [--timings] COMMAND [ARG ...]
+
+Commands are registered with the ``@command`` decorator. Modules are imported
+and the database connection is opened lazily, only for commands that need
+them, so the CSV-only commands start quickly.
+
+Settings are read from the ``--settings`` json file, else from the json file
+named by the ``CR_SETTINGS`` environment variable, else the database URL is
+taken from ``CR_DB_URL``.
 """
 from __future__ import print_function
+import time
+_START = time.time()
+
+import argparse
 from collections import defaultdict
-import csv
 import json
+import os
 import sys
 
-import bson
-from bson.objectid import ObjectId
+DEFAULT_URL = "mongodb://localhost:27017/test_crunch_fitness"
 
-from cr.db.loader import load_dataset_to_dict
-from cr.db.store import global_settings as settings
-from cr.db.store import connect
+# Registered subcommands: {name: (func, needs_db)}
+COMMANDS = {}
 
-settings.update({"url": "mongodb://localhost:27017/test_crunch_fitness"})
-db = connect(settings)
+_settings = {}
+_db = None
 
 
+def command(needs_db=False):
+    """Register the decorated function as a helper subcommand"""
+    def register(func):
+        COMMANDS[func.__name__] = (func, needs_db)
+        return func
+    return register
+
+
+def load_settings(settings_filename=None):
+    """
+    Load the helper settings from a json file or the environment.
+    Return the settings dictionary.
+    """
+    if settings_filename is None:
+        settings_filename = os.environ.get('CR_SETTINGS')
+    if settings_filename:
+        with open(settings_filename) as f:
+            _settings.update(json.load(f))
+    elif 'CR_DB_URL' in os.environ:
+        _settings['url'] = os.environ['CR_DB_URL']
+    _settings.setdefault('url', DEFAULT_URL)
+    return _settings
+
+
+def get_db():
+    """Connect to the database on first use. Return the database."""
+    global _db
+    if _db is None:
+        from cr.db.store import global_settings as settings
+        from cr.db.store import connect
+        if not _settings:
+            load_settings()
+        settings.update(_settings)
+        _db = connect(settings)
+    return _db
+
+
+@command(needs_db=True)
 def get_dataset(dataset_id=None):
     """
     Get a dataset from the Mongo database
     dataset_id:
         None to pick a dataset at random.
         Otherwise, the hex document ID of the dataset
-    Return the dataset document.
+    Return the dataset catalog document.
     Raise IndexError if no matching dataset found.
     """
+    from bson.objectid import ObjectId
+
     if dataset_id is None:
         dataset_query = {}
     else:
         dataset_query = {'_id': ObjectId(dataset_id)}
-    return db.datasets.find(dataset_query)[0]
+    return get_db().datasets.find(dataset_query)[0]
 
 
+@command(needs_db=True)
 def get_dataset_unique_values(dataset_id=None):
     """
     Scan the values in a dataset and count up unique values.
@@ -42,17 +95,19 @@ def get_dataset_unique_values(dataset_id=None):
         Otherwise, the hex document ID of the dataset
     Return a dictionary: {header: {col_value: count}}
     """
-    dataset = get_dataset(dataset_id)
-    headers = dataset['headers']
-    columns = dataset['columns']
+    from cr.db.dataset import Dataset
+
+    dataset = Dataset(get_db(), get_dataset(dataset_id))
     result = defaultdict(lambda: defaultdict(int))
-    for i, column in enumerate(columns):
-        header = headers[i]
-        for value in column:
-            result[header][value] += 1
+    for i, header in enumerate(dataset.headers):
+        for chunk in dataset.iter_chunks(i):
+            # tolist() turns masked (missing) values into None
+            for value in chunk.tolist():
+                result[header][value] += 1
     return result
 
 
+@command(needs_db=True)
 def scan_dataset(dataset_id=None):
     """
     Scan a dataset, print report of data character counts to stdout
@@ -77,16 +132,30 @@ def scan_dataset(dataset_id=None):
         print("{} chars: {}".format(char_count, headers_by_char_count[char_count]))
 
 
+def _bitmap_spec(items):
+    """Map sorted set items to integers that are even powers of 2"""
+    result = {}
+    for i, item in enumerate(sorted(items)):
+        result[item] = 2**i
+    return result
+
+
+@command()
 def calc_dataset_size(csv_filename):
     """
-    Given a CSV file, estimate the Mongo document size using the bson
-    module. This is to see if we will fit under the 16MB Mongo limit.
+    Given a CSV file, work out the size of the single Mongo document holding
+    the whole dataset without dictionary encoding, as
+    load_dataset_to_dict(dictionary_encode=False) builds it, without
+    building it. This is to see if it would fit under the 16MB Mongo limit;
+    load_dataset() itself stores chunks and dictionary encodes.
     """
-    data = load_dataset_to_dict(csv_filename)
-    b = bson.BSON(data)
-    return len(b)
+    from cr.db.scan import EncodedSizeVisitor, scan_csv
+
+    visitor, = scan_csv(csv_filename, [EncodedSizeVisitor()])
+    return visitor.result()['total']
 
 
+@command()
 def scan_csv_cols(csv_filename):
     """
     Scan the values in a CSV file with headers and count up unique values.
@@ -95,16 +164,13 @@ def scan_csv_cols(csv_filename):
 
     Return a dictionary: {header: {col_value: count}}
     """
-    with open(csv_filename, 'rU') as f:
-        csv_reader = csv.reader(f)
-        headers = csv_reader.next()
-        result = defaultdict(lambda: defaultdict(int))
-        for row in csv_reader:
-            for i, header in enumerate(headers):
-                result[header][row[i]] += 1
-    return result
+    from cr.db.scan import ValueCountVisitor, scan_csv
+
+    visitor, = scan_csv(csv_filename, [ValueCountVisitor()])
+    return visitor.result()
 
 
+@command()
 def gen_lang_bitmap(csv_filename):
     """
     Scan the values in the WantWorkLanguage column of the CSV file and
@@ -112,62 +178,139 @@ def gen_lang_bitmap(csv_filename):
     encoding the selection set efficiently as a bitmap in a single
     (potentially large) integer.
     """
-    language_set = set()
-    with open(csv_filename, 'rU') as f:
-        csv_reader = csv.reader(f)
-        headers = csv_reader.next()
-        lang_index = headers.index('WantWorkLanguage')
-        for row in csv_reader:
-            value = row[lang_index]
-            languages = [lang.strip() for lang in value.split(';')]
-            language_set.update(languages)
-    result = {}
-    for i, language in enumerate(sorted(language_set)):
-        result[language] = 2**i
-    return result
+    from cr.db.scan import SetItemVisitor, scan_csv
+
+    visitor, = scan_csv(csv_filename, [SetItemVisitor(['WantWorkLanguage'])])
+    return _bitmap_spec(visitor.result()['WantWorkLanguage'])
 
 
+@command()
 def scan_csv_rows(csv_filename, *row_indexes):
     """
     Scan a CSV file and verify row size and header consistency.
     Optionally pick some specific rows by index and return them for inspection.
     """
-    headers_are_unique = None
-    shortest_row = None
-    longest_row = None
-    num_rows = 0
-    specific_rows = []
-    row_indexes = [int(i) for i in row_indexes]
-    with open(csv_filename, 'rU') as f:
-        csv_reader = csv.reader(f)
-        headers = csv_reader.next()
-        headers_are_unique = (sorted(headers) == sorted(set(headers)))
-        for row in csv_reader:
-            if shortest_row is None or len(row) < shortest_row:
-                shortest_row = len(row)
-            if longest_row is None or len(row) > longest_row:
-                longest_row = len(row)
-            num_rows += 1
-            if num_rows in row_indexes:
-                specific_rows.append(row)
+    from cr.db.scan import RowShapeVisitor, scan_csv
+
+    visitor, = scan_csv(csv_filename, [RowShapeVisitor(row_indexes)])
+    return visitor.result()
+
+
+@command()
+def profile_csv(csv_filename, processes=1):
+    """
+    Profile a new CSV file in a single pass, optionally split over several
+    processes: row shape, number of distinct values per column, items of
+    the semicolon separated columns and the estimated encoded size.
+    """
+    from cr.db.scan import (EncodedSizeVisitor, RowShapeVisitor,
+                            SetItemVisitor, ValueCountVisitor, scan_csv)
+
+    shape, values, set_items, size = scan_csv(
+        csv_filename,
+        [RowShapeVisitor(), ValueCountVisitor(), SetItemVisitor(),
+         EncodedSizeVisitor()],
+        processes=int(processes))
     return {
-        'headers_are_unique': headers_are_unique,
-        'shortest_row': shortest_row,
-        'longest_row': longest_row,
-        'num_rows': num_rows,
-        'specific_rows': specific_rows,
+        'rows': shape.result(),
+        'distinct_values': dict((header, len(counts)) for header, counts
+                                in values.result().iteritems()),
+        'set_items': dict((header, _bitmap_spec(items)) for header, items
+                          in set_items.result().iteritems()),
+        'encoded_size': size.result(),
     }
 
 
+@command()
+def plan_storage(csv_filename, processes=1):
+    """
+    Estimate, in one streaming pass, the size of each candidate encoding of
+    every column of a CSV file, and report the cheapest encodings and a
+    document layout that fits under the Mongo document size limit.
+    """
+    from cr.db import planner
+    from cr.db.scan import scan_csv
+
+    visitor, = scan_csv(csv_filename, [planner.ColumnProfileVisitor()],
+                        processes=int(processes))
+    return planner.plan_storage(visitor.result())
+
+
+@command()
+def sample_csv_rows(csv_filename, size=10, seed=None):
+    """
+    Pick size rows of a CSV file uniformly at random, in one pass, for a
+    quick look at a file too big to open.
+    """
+    from cr.db.sampling import ReservoirVisitor
+    from cr.db.scan import scan_csv
+
+    seed = None if seed is None else int(seed)
+    visitor, = scan_csv(csv_filename, [ReservoirVisitor(int(size), seed)])
+    return visitor.result()
+
+
+@command()
+def bench_codecs(csv_filename, chunk_rows=2**16):
+    """
+    Encode the columns of a CSV file into chunks and report, per ColumnType,
+    the compression ratio and decode throughput of every compression codec.
+    """
+    from cr.db import columnar, compression
+    from cr.db.dataset import get_column_types
+    from cr.db.loader import load_dataset_to_dict
+
+    chunk_rows = int(chunk_rows)
+    data = load_dataset_to_dict(csv_filename)
+    column_types = get_column_types(data)
+    chunks_by_type = defaultdict(list)
+    for column_type, column in zip(column_types, data['columns']):
+        for start in range(0, len(column), chunk_rows):
+            chunks_by_type[type(column_type).__name__].append(
+                columnar.encode_chunk(column[start:start + chunk_rows],
+                                      column_type.dtype))
+    return compression.benchmark(chunks_by_type)
+
+
+@command(needs_db=True)
+def create_indexes():
+    """Create the declared indexes of every collection, see cr.db.indexes"""
+    from cr.db.indexes import ensure_indexes
+
+    return ensure_indexes(get_db())
+
+
+@command(needs_db=True)
 def list_datasets():
-    return [str(d['_id']) for d in db.datasets.find({}, {'_id': True})]
+    return [str(d['_id'])
+            for d in get_db().datasets.find({}, {'_id': True})]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='cr.helper', description='Crunch DB helper commands')
+    parser.add_argument('--settings', help='json settings file')
+    parser.add_argument('--timings', action='store_true',
+                        help='report startup and run times on stderr')
+    parser.add_argument('command', choices=sorted(COMMANDS))
+    parser.add_argument('args', nargs=argparse.REMAINDER)
+    options = parser.parse_args(argv)
 
+    load_settings(options.settings)
+    func, needs_db = COMMANDS[options.command]
+    started = time.time()
+    if needs_db:
+        get_db()
+    connected = time.time()
+    result = func(*options.args)
+    finished = time.time()
 
-def main():
-    func = getattr(sys.modules[__name__], sys.argv[1])
-    result = func(*sys.argv[2:])
     if result is not None:
         json.dump(result, sys.stdout, indent=2, sort_keys=True)
+    if options.timings:
+        print("startup: {:.3f}s connect: {:.3f}s run: {:.3f}s".format(
+            started - _START, connected - started, finished - connected),
+            file=sys.stderr)
 
 
 if __name__ == '__main__':
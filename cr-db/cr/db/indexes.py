@@ -0,0 +1,88 @@
+"""
+Index declarations and bootstrap.
+
+The indexes each collection needs for its hot queries are declared in
+``INDEXES``. ``ensure_indexes()`` creates them; it is idempotent and cheap
+when they already exist, so it runs at API startup and after every bulk
+load. An index whose declared options changed is dropped and built again.
+
+users
+    Unique email and (when set) username, for login lookups and signup
+    validation; 2dsphere on the GeoJSON location, see cr.db.users.
+sessions
+    TTL on 'expires': Mongo deletes a session once its expiry time has
+    passed. Sessions are looked up by their _id token.
+dataset_chunks
+    Chunks by dataset, column and chunk index, see cr.db.dataset.
+"""
+from pymongo import ASCENDING, GEOSPHERE, IndexModel
+from pymongo.errors import OperationFailure
+
+# Mongo error codes for an existing index of the same name or keys but
+# different options
+_INDEX_CONFLICTS = (85, 86)
+
+INDEXES = {
+    'users': [
+        IndexModel([('email', ASCENDING)], name='email_unique', unique=True),
+        # Sparse, so the users without a username do not collide
+        IndexModel([('username', ASCENDING)], name='username_unique',
+                   unique=True, sparse=True),
+        IndexModel([('location', GEOSPHERE)], name='location_2dsphere'),
+    ],
+    'sessions': [
+        IndexModel([('expires', ASCENDING)], name='expires_ttl',
+                   expireAfterSeconds=0),
+        IndexModel([('user_id', ASCENDING)], name='user_id'),
+    ],
+    'dataset_chunks': [
+        IndexModel([('dataset_id', ASCENDING), ('column', ASCENDING),
+                    ('chunk', ASCENDING)]),
+    ],
+}
+
+
+def ensure_collection_indexes(collection, name=None):
+    """
+    Create the indexes declared for the collection name (by default the
+    collection's own name) on collection. Return the index names.
+    """
+    models = INDEXES.get(name or collection.name, ())
+    names = []
+    for model in models:
+        try:
+            names.extend(collection.create_indexes([model]))
+        except OperationFailure as exc:
+            if exc.code not in _INDEX_CONFLICTS:
+                raise
+            collection.drop_index(model.document['name'])
+            names.extend(collection.create_indexes([model]))
+    return names
+
+
+def ensure_indexes(db, names=None):
+    """
+    Create the declared indexes of the named collections, by default of
+    all of them. Return {collection name: [index name, ...]}.
+    """
+    if names is None:
+        names = sorted(INDEXES)
+    return dict((name, ensure_collection_indexes(db[name]))
+                for name in names)
+
+
+def winning_plan_indexes(explanation):
+    """
+    Return the names of the indexes used by the winning plan of an
+    explain() result, in plan order. Empty for a collection scan.
+    """
+    names = []
+    stages = [explanation['queryPlanner']['winningPlan']]
+    while stages:
+        stage = stages.pop(0)
+        if 'indexName' in stage:
+            names.append(stage['indexName'])
+        if 'inputStage' in stage:
+            stages.append(stage['inputStage'])
+        stages.extend(stage.get('inputStages', ()))
+    return names
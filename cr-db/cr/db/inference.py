@@ -0,0 +1,394 @@
+"""
+Column type inference from a sample of rows.
+
+``COLUMN_RULES`` only knows the headers of the surveys it was written for.
+For a new corpus every unknown header falls through to the catch all string
+rule. ``infer_schema()`` reads the first rows of a CSV file and proposes a
+type for each column instead:
+
+int
+    Every value is a whole number.
+float
+    Every value is a number.
+
+    Numbers with leading zeros mark identifiers and postal codes, which
+    are not typed as numbers.
+boolean
+    The values are yes/no, true/false or y/n, in any case.
+enum
+    Few distinct values, coded 1, 2, ... in sorted order. Only up to
+    MAX_CATEGORIES, so the codes fit a byte. Larger sets are left to the
+    dictionary encoding of string columns by the dataset writer, which is
+    exact however many labels turn up.
+set
+    Semicolon separated multiple choice answers with few distinct items.
+
+Columns with no other fitting type stay strings.
+
+Headers that match one of the hand written rules, other than the catch
+all, keep the rule's type. The sample is still checked against the rule,
+and disagreements are reported as conflicts in the schema.
+
+Types are kept as JSON friendly specs, so a schema can be stored. Each spec
+is {'type': name, ...}, and the type is one of 'rule', 'int', 'float',
+'str', 'boolean' (with 'labels': [false label, true label]), 'enum' and
+'set' (with 'items'). 'rule' means "resolve the header with the column
+rules".
+
+Resolved schemas are cached in the ``column_schemas`` collection under a
+signature of the headers. Later files with the same headers, such as the
+next wave of a survey, are then loaded with the same types and codes
+without sampling again.
+
+Values seen only after the sample convert to missing under an enum, boolean
+or set type, the same as values that the hand written rules do not list.
+"""
+import csv
+import datetime
+import hashlib
+import itertools
+import json
+import re
+
+from cr.db.rules import (
+    COLUMN_RULES,
+    FLOAT_COLUMN,
+    INT_COLUMN,
+    STR_COLUMN,
+    BitmappedSetColumn,
+    CategoryColumn,
+    EnumColumn,
+    FloatColumn,
+    IntColumn,
+)
+from cr.db.scan import Visitor, fill_blank_headers
+from cr.db.sources import open_source
+
+SAMPLE_ROWS = 10000
+
+# Enum codes start at 1, so this many fit a signed byte
+MAX_CATEGORIES = 127
+
+# Set members are bits of an unsigned 64 bit integer
+MAX_SET_ITEMS = 64
+
+# Enums and sets are proposed only when the distinct values are at most
+# this fraction of the values sampled, so free text is not mistaken for
+# categories.
+CATEGORY_MAX_RATIO = 0.5
+
+MISSING_VALUES = frozenset(['', 'na', 'n/a'])
+
+BOOLEAN_LABELS = [
+    ('no', 'yes'),
+    ('false', 'true'),
+    ('n', 'y'),
+]
+
+_INT_MAX = 2**63 - 1
+
+
+def _has_leading_zero(value):
+    digits = value.strip().lstrip('+-').split('.')[0]
+    return len(digits) > 1 and digits.startswith('0')
+
+
+def _is_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        return False
+    return abs(number) <= _INT_MAX and not _has_leading_zero(value)
+
+
+def _is_float(value):
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return not _has_leading_zero(value)
+
+
+def matching_rule(header, column_rules=None):
+    """Return the (pattern, column type) of the first rule header matches"""
+    if column_rules is None:
+        column_rules = COLUMN_RULES
+    for rule in column_rules:
+        if re.match(rule[0], header):
+            return rule
+    return None
+
+
+def type_kind(column_type):
+    """Return the spec type name that describes a column type"""
+    if isinstance(column_type, IntColumn):
+        return 'int'
+    if isinstance(column_type, FloatColumn):
+        return 'float'
+    if isinstance(column_type, BitmappedSetColumn):
+        return 'set'
+    if isinstance(column_type, CategoryColumn):
+        if column_type.dtype == '|b1':
+            return 'boolean'
+        return 'enum'
+    return 'str'
+
+
+# Rule kinds that hold the values of a proposed kind without loss
+_COMPATIBLE_KINDS = {
+    'int': ('int', 'float', 'str'),
+    'float': ('float', 'str'),
+    'boolean': ('boolean', 'enum', 'str'),
+    'enum': ('enum', 'str'),
+    'set': ('set', 'str'),
+    'str': ('str',),
+}
+
+
+class _ColumnSample(object):
+
+    def __init__(self):
+        self.values = 0
+        self.ints = 0
+        self.floats = 0
+        self.rejected = 0
+        self.with_separator = 0
+        self.item_count = 0
+        # {lower case value: first value seen}, None once too many
+        self.distinct = {}
+        self.items = set()
+
+    def add(self, value):
+        self.values += 1
+        if _is_int(value):
+            self.ints += 1
+            self.floats += 1
+        elif _is_float(value):
+            self.floats += 1
+        if self.distinct is not None:
+            self.distinct.setdefault(value.lower(), value)
+            if len(self.distinct) > MAX_CATEGORIES:
+                self.distinct = None
+        if ';' in value:
+            self.with_separator += 1
+        if self.items is not None:
+            for item in value.split(';'):
+                item = item.strip()
+                if item:
+                    self.item_count += 1
+                    self.items.add(item)
+            if len(self.items) > MAX_SET_ITEMS:
+                self.items = None
+
+    def merge(self, other):
+        for name in ('values', 'ints', 'floats', 'rejected', 'with_separator',
+                     'item_count'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for name, limit in (('distinct', MAX_CATEGORIES),
+                            ('items', MAX_SET_ITEMS)):
+            mine, theirs = getattr(self, name), getattr(other, name)
+            if mine is None or theirs is None:
+                setattr(self, name, None)
+                continue
+            if name == 'distinct':
+                for key, value in theirs.iteritems():
+                    mine.setdefault(key, value)
+            else:
+                mine.update(theirs)
+            if len(mine) > limit:
+                setattr(self, name, None)
+
+    def propose(self):
+        """Return the type spec that fits the sampled values"""
+        if not self.values:
+            return {'type': 'rule'}
+        if self.ints == self.values:
+            return {'type': 'int'}
+        if self.floats == self.values:
+            return {'type': 'float'}
+        if self.distinct is not None:
+            seen = set(self.distinct)
+            for false_label, true_label in BOOLEAN_LABELS:
+                if seen <= set([false_label, true_label]):
+                    return {'type': 'boolean', 'labels': [
+                        self.distinct.get(false_label, false_label.title()),
+                        self.distinct.get(true_label, true_label.title())]}
+        if (self.with_separator and self.items is not None and
+                len(self.items) <= self.item_count * CATEGORY_MAX_RATIO):
+            return {'type': 'set', 'items': sorted(self.items)}
+        if (self.distinct is not None and
+                len(self.distinct) <= self.values * CATEGORY_MAX_RATIO):
+            return {'type': 'enum', 'items': sorted(self.distinct.values())}
+        return {'type': 'str'}
+
+
+class TypeInferenceVisitor(Visitor):
+    """
+    Collect per column statistics of the first sample_rows rows and propose
+    a type spec for each column. Values of columns with a specific column
+    rule are also converted with the rule, to count the ones it rejects.
+
+    Result: {'headers': [...], 'proposals': [spec, ...],
+             'rejected': [count, ...], 'num_rows': rows sampled}
+    """
+
+    def __init__(self, sample_rows=SAMPLE_ROWS, column_rules=None):
+        self.sample_rows = sample_rows
+        self.column_rules = column_rules
+        self.num_rows = 0
+        self.columns = None
+
+    def start(self, headers):
+        headers = fill_blank_headers(list(headers))
+        super(TypeInferenceVisitor, self).start(headers)
+        self.rules = [rule[1] if rule is not None and rule[0] != '' else None
+                      for rule in (matching_rule(header, self.column_rules)
+                                   for header in headers)]
+        if self.columns is None:
+            self.columns = [_ColumnSample() for _ in headers]
+
+    def visit(self, row):
+        if self.num_rows >= self.sample_rows:
+            return
+        self.num_rows += 1
+        rules = self.rules
+        for i, column in enumerate(self.columns):
+            value = row[i] if i < len(row) else ''
+            if value.strip().lower() in MISSING_VALUES:
+                continue
+            column.add(value)
+            if rules[i] is not None and rules[i](value) is None:
+                column.rejected += 1
+
+    def merge(self, other):
+        for column, other_column in zip(self.columns, other.columns):
+            column.merge(other_column)
+        self.num_rows += other.num_rows
+
+    def result(self):
+        return {
+            'headers': self.headers,
+            'proposals': [column.propose() for column in self.columns],
+            'rejected': [column.rejected for column in self.columns],
+            'num_rows': self.num_rows,
+        }
+
+    def __getstate__(self):
+        # Rule column types are re-resolved in start()
+        state = self.__dict__.copy()
+        state.pop('rules', None)
+        return state
+
+
+def column_type_from_spec(header, spec, column_rules=None):
+    """Return the ColumnType for a type spec"""
+    kind = spec['type']
+    if kind == 'rule':
+        return matching_rule(header, column_rules)[1]
+    if kind == 'int':
+        return INT_COLUMN
+    if kind == 'float':
+        return FLOAT_COLUMN
+    if kind == 'str':
+        return STR_COLUMN
+    if kind == 'boolean':
+        false_label, true_label = spec['labels']
+        return CategoryColumn({false_label: False, true_label: True})
+    if kind == 'enum':
+        return EnumColumn(spec['items'])
+    if kind == 'set':
+        return BitmappedSetColumn(spec['items'])
+    raise ValueError("Unknown column type spec: {}".format(kind))
+
+
+def column_types_from_specs(headers, specs, column_rules=None):
+    return [column_type_from_spec(header, spec, column_rules)
+            for header, spec in zip(headers, specs)]
+
+
+def resolve_schema(sample, column_rules=None):
+    """
+    Merge the proposals of a TypeInferenceVisitor result with the column
+    rules. Specific rules win; the catch all rule gives way to the
+    proposal.
+
+    Return (specs, conflicts). A conflict is reported for a rule whose type
+    cannot hold the proposed kind of values, or that rejected some sampled
+    values: {'column': index, 'header': header, 'rule': rule type name,
+    'proposed': proposed type, 'rejected': rejected value count}.
+    """
+    specs = []
+    conflicts = []
+    for i, (header, proposal, rejected) in enumerate(zip(
+            sample['headers'], sample['proposals'], sample['rejected'])):
+        rule = matching_rule(header, column_rules)
+        if rule is None or rule[0] == '':
+            specs.append(proposal)
+            continue
+        specs.append({'type': 'rule'})
+        if proposal['type'] == 'rule':
+            continue
+        rule_kind = type_kind(rule[1])
+        if rejected or rule_kind not in _COMPATIBLE_KINDS[proposal['type']]:
+            conflicts.append({
+                'column': i,
+                'header': header,
+                'rule': type(rule[1]).__name__,
+                'proposed': proposal['type'],
+                'rejected': rejected,
+            })
+    return specs, conflicts
+
+
+def header_signature(headers):
+    """Return a key identifying a list of headers"""
+    return hashlib.sha1(json.dumps(headers)).hexdigest()
+
+
+def sample_csv(csv_filename, sample_rows=SAMPLE_ROWS, column_rules=None,
+               member=None):
+    """
+    Run a TypeInferenceVisitor over the first sample_rows rows of a CSV
+    file, which may be compressed (see cr.db.sources). Return its result.
+    """
+    visitor = TypeInferenceVisitor(sample_rows, column_rules)
+    with open_source(csv_filename, member) as csv_file:
+        csv_data = csv.reader(csv_file)
+        visitor.start(csv_data.next())
+        for row in itertools.islice(csv_data, sample_rows):
+            visitor.visit(row)
+    return visitor.result()
+
+
+def infer_schema(db, csv_filename, sample_rows=SAMPLE_ROWS, member=None,
+                 refresh=False):
+    """
+    Return the schema document for a CSV file: the cached one for its
+    headers if there is one, else a newly inferred and cached one:
+
+    {'_id': header signature, 'headers': [...], 'columns': [spec, ...],
+     'conflicts': [...], 'sample_rows': rows sampled, 'created': datetime}
+
+    refresh:
+        Infer and cache the schema again even if one is cached.
+    """
+    with open_source(csv_filename, member) as csv_file:
+        headers = fill_blank_headers(csv.reader(csv_file).next())
+    signature = header_signature(headers)
+    if not refresh:
+        schema = db.column_schemas.find_one({'_id': signature})
+        if schema is not None:
+            return schema
+
+    sample = sample_csv(csv_filename, sample_rows, member=member)
+    specs, conflicts = resolve_schema(sample)
+    schema = {
+        '_id': signature,
+        'headers': headers,
+        'columns': specs,
+        'conflicts': conflicts,
+        'sample_rows': sample['num_rows'],
+        'created': datetime.datetime.utcnow(),
+    }
+    db.column_schemas.replace_one({'_id': signature}, schema, upsert=True)
+    return schema
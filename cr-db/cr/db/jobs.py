@@ -0,0 +1,76 @@
+"""
+Checkpoints for resumable loads.
+
+A load with a job id records its progress in an ``ingest_jobs`` document
+after every committed batch or chunk: the byte offset and row count reached
+in the source file, plus whatever state the loader needs to carry on. If
+the load dies, running it again with the same job id resumes from the last
+checkpoint instead of starting over. A finished job remembers its result,
+so running it yet again is a no-op.
+
+Job document::
+
+    {
+        '_id': job id,
+        'source': source file name,
+        'status': 'running' or 'done',
+        'offset': byte offset in the source file of the next row to load,
+        'num_rows': rows committed,
+        'started': datetime,
+        'updated': datetime,
+        ... plus loader specific state
+    }
+"""
+import datetime
+import hashlib
+import os
+
+
+def default_job_id(filename):
+    """
+    Return a job id for loading a file: the same for every run over the same
+    unchanged file, different once the file changes.
+    """
+    stat = os.stat(filename)
+    key = '{}:{}:{}'.format(os.path.abspath(filename), stat.st_size,
+                            stat.st_mtime)
+    return hashlib.sha1(key).hexdigest()
+
+
+class IngestJob(object):
+
+    def __init__(self, db, job_id, source=None):
+        self.collection = db.ingest_jobs
+        self.job_id = job_id
+        self.document = self.collection.find_one({'_id': job_id})
+        if self.document is None:
+            now = datetime.datetime.utcnow()
+            self.document = {
+                '_id': job_id,
+                'source': source,
+                'status': 'running',
+                'offset': None,
+                'num_rows': 0,
+                'started': now,
+                'updated': now,
+            }
+            self.resumed = False
+        else:
+            self.resumed = True
+
+    @property
+    def done(self):
+        return self.document['status'] == 'done'
+
+    def get(self, key, default=None):
+        return self.document.get(key, default)
+
+    def checkpoint(self, **fields):
+        """Record progress. Call only once the work it covers is stored."""
+        fields['updated'] = datetime.datetime.utcnow()
+        self.document.update(fields)
+        self.collection.replace_one({'_id': self.job_id}, self.document,
+                                    upsert=True)
+
+    def finish(self, **fields):
+        self.checkpoint(status='done', **fields)
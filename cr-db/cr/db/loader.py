@@ -1,12 +1,78 @@
 import csv
+import itertools
 import os
 import json
 import sys
 
-from cr.db.rules import get_converter_funcs
+from bson.objectid import ObjectId
+from pymongo import InsertOne, ReplaceOne
+
+from cr.db import metrics
+from cr.db.indexes import ensure_collection_indexes
+from cr.db.columnar import SPARSE_NULL_RATIO
+from cr.db.dataset import (
+    CHUNK_ROWS,
+    DICTIONARY_MAX_RATIO,
+    DICTIONARY_MAX_SIZE,
+    DatasetWriter,
+)
+from cr.db.inference import (
+    SAMPLE_ROWS,
+    column_types_from_specs,
+    infer_schema,
+)
+from cr.db.jobs import IngestJob
+from cr.db.rules import DictionaryColumn, StrColumn, get_converter_funcs
+from cr.db.scan import fill_blank_headers
+from cr.db.sources import (
+    LineCounter,
+    open_source,
+    source_members,
+    source_name,
+    source_path,
+)
 from cr.db.store import global_settings, connect
+from cr.db.users import prepare_user
+
+# Rows are parsed and converted in batches of this size, so each load stage
+# can be timed separately without a clock call per row.
+BATCH_SIZE = 1000
+
+# Derived fields added to the documents of a collection as they are loaded
+DOCUMENT_PREPARERS = {
+    'users': prepare_user,
+}
+
+
+def _write_request(obj):
+    # Objects with an _id can be written again on resume without duplicates
+    if '_id' in obj:
+        return ReplaceOne({'_id': obj['_id']}, obj, upsert=True)
+    return InsertOne(obj)
+
+
+def _job_object_id(job_id, index):
+    """The _id of the index'th object of a checkpointed load without one"""
+    return '{}:{}'.format(job_id, index)
+
+
+def load_data(filename, settings=None, clear=None, job_id=None):
+    """
+    Load a json list of objects into the collection named after the file.
+    The file may be gzip, bz2 or zip compressed, see cr.db.sources.
+    The collection's indexes (see cr.db.indexes) are built once the
+    objects are in.
 
-def load_data(filename, settings=None, clear=None):
+    clear:
+        Replace the collection's documents. The objects are loaded into a
+        staging collection that is renamed over the old one at the end, so
+        the old documents stay in place until the new ones are all in.
+    job_id:
+        Checkpoint progress in an ingest job (see cr.db.jobs) after every
+        batch, and resume from the last checkpoint if the job was
+        interrupted. Objects without an _id get '<job id>:<index>', so a
+        batch written again on resume replaces its first copy.
+    """
     if settings is None:
         settings = global_settings
         global_settings.update(json.load(file(sys.argv[1])))
@@ -15,42 +81,282 @@ def load_data(filename, settings=None, clear=None):
 
     obj_name = os.path.basename(filename).split('.')[0]
 
-    collection = getattr(db, obj_name)
+    job = None
+    done = 0
+    if job_id is not None:
+        job = IngestJob(db, job_id, filename)
+        if job.done:
+            return
+        done = job.get('num_rows')
 
     if clear:
-        collection.remove()
+        collection = db['{}_loading_{}'.format(obj_name,
+                                               job_id or ObjectId())]
+    else:
+        collection = getattr(db, obj_name)
 
-    with file(filename) as the_file:
-        objs = json.load(the_file)
-        for obj in objs:
-            collection.insert(obj)
+    with open_source(filename) as the_file:
+        with metrics.timer('cr_load_stage_seconds', stage='parse'):
+            objs = json.load(the_file)
+    metrics.inc('cr_load_rows_total', len(objs) - done)
+    prepare = DOCUMENT_PREPARERS.get(obj_name)
+    for start in xrange(done, len(objs), BATCH_SIZE):
+        batch = objs[start:start + BATCH_SIZE]
+        if prepare is not None:
+            batch = [prepare(obj) for obj in batch]
+        if job is not None:
+            # The same ids when the batch is written again on resume
+            for index, obj in enumerate(batch, start):
+                if '_id' not in obj:
+                    obj['_id'] = _job_object_id(job_id, index)
+        with metrics.timer('cr_load_stage_seconds', stage='insert'):
+            collection.bulk_write([_write_request(obj) for obj in batch],
+                                  ordered=False)
+        if job is not None:
+            job.checkpoint(num_rows=start + len(batch))
 
+    with metrics.timer('cr_load_stage_seconds', stage='index'):
+        ensure_collection_indexes(collection, obj_name)
+    if clear:
+        if collection.name in db.collection_names():
+            collection.rename(obj_name, dropTarget=True)
+        else:
+            db.drop_collection(obj_name)
+    if job is not None:
+        job.finish()
 
-def load_dataset_to_dict(csv_filename):
-    with file(csv_filename, 'rU') as csv_file:
-        csv_data = csv.reader(csv_file)
-        headers = csv_data.next()
 
-        last_header = None
-        for i, header in enumerate(headers):
-            if header:
-                last_header = header
-            else:
-                # multiple response have no header
-                headers[i] = last_header
+def dictionary_encode_column(column, max_size=DICTIONARY_MAX_SIZE,
+                             max_ratio=DICTIONARY_MAX_RATIO):
+    """
+    Replace the string values of a column, in place, with integer codes if
+    the column has few enough distinct values.
+    Return the DictionaryColumn for the codes, or None if the column was left
+    alone.
+    """
+    distinct = set(column)
+    distinct.discard(None)
+    non_null = len(column) - column.count(None)
+    if not distinct or len(distinct) > max_size:
+        return None
+    if len(distinct) > non_null * max_ratio:
+        return None
+    dictionary = DictionaryColumn(sorted(distinct))
+    column[:] = [dictionary.category_map_orig.get(value) for value in column]
+    return dictionary
 
-        columns = [[] for _ in headers]
-        converter_funcs = get_converter_funcs(headers)
-        for r, row in enumerate(csv_data):
+
+def _convert_rows(rows, converter_funcs, columns):
+    """Convert the CSV rows and append the values to columns"""
+    with metrics.timer('cr_load_stage_seconds', stage='convert'):
+        for row in rows:
             for i, data in enumerate(row):
                 columns[i].append(converter_funcs[i](data))
 
+
+def _count_cells(converter_funcs, num_rows):
+    if metrics.is_enabled():
+        metrics.inc('cr_load_rows_total', num_rows)
+        for converter_func in converter_funcs:
+            metrics.inc('cr_load_cells_total', num_rows,
+                        column_type=type(converter_func).__name__)
+
+
+def _read_rows(csv_data, count):
+    with metrics.timer('cr_load_stage_seconds', stage='parse'):
+        return list(itertools.islice(csv_data, count))
+
+
+def _write_sorted(csv_data, converter_funcs, key_index, writer):
+    """Convert all of the rows, then write them sorted on one column"""
+    columns = [[] for _ in converter_funcs]
+    while True:
+        rows = _read_rows(csv_data, BATCH_SIZE)
+        if not rows:
+            break
+        _convert_rows(rows, converter_funcs, columns)
+    with metrics.timer('cr_load_stage_seconds', stage='sort'):
+        keys = columns[key_index]
+        order = sorted(xrange(len(keys)),
+                       key=lambda i: (keys[i] is None, keys[i]))
+        columns = [[column[i] for i in order] for column in columns]
+    chunk_rows = writer.chunk_rows
+    for start in xrange(0, len(order), chunk_rows):
+        writer.write_chunk([column[start:start + chunk_rows]
+                            for column in columns])
+
+
+def load_dataset_to_dict(csv_filename, dictionary_encode=True, member=None):
+    """
+    Read and convert a CSV file with headers into a dataset dictionary, all
+    in memory, in the single document form:
+    {'headers': [...], 'columns': [[...], ...], 'dictionaries': [...]}
+
+    Low cardinality columns that only matched the catch all string rule are
+    dictionary encoded unless dictionary_encode is false. Their labels are
+    recorded in 'dictionaries': [{'column': index, 'labels': [...]}, ...].
+
+    The file may be compressed, see cr.db.sources; member picks the file
+    to read from a zip archive.
+    """
+    with open_source(csv_filename, member) as csv_file:
+        csv_data = csv.reader(csv_file)
+        headers = fill_blank_headers(csv_data.next())
+
+        columns = [[] for _ in headers]
+        with metrics.timer('cr_load_stage_seconds', stage='resolve'):
+            converter_funcs = get_converter_funcs(headers)
+        num_rows = 0
+        while True:
+            rows = _read_rows(csv_data, BATCH_SIZE)
+            if not rows:
+                break
+            _convert_rows(rows, converter_funcs, columns)
+            num_rows += len(rows)
+        _count_cells(converter_funcs, num_rows)
+
         data = {'headers': headers,
                 'columns': columns,
                 }
+        if dictionary_encode:
+            with metrics.timer('cr_load_stage_seconds', stage='dictionary'):
+                dictionaries = []
+                for i, converter_func in enumerate(converter_funcs):
+                    if not isinstance(converter_func, StrColumn):
+                        continue
+                    dictionary = dictionary_encode_column(columns[i])
+                    if dictionary is not None:
+                        dictionaries.append({'column': i,
+                                             'labels': dictionary.labels})
+            data['dictionaries'] = dictionaries
         return data
 
 
-def load_dataset(csv_filename, db):
-    data = load_dataset_to_dict(csv_filename)
-    return db.datasets.insert(data)
+def load_dataset(csv_filename, db, chunk_rows=CHUNK_ROWS,
+                 sparse_ratio=SPARSE_NULL_RATIO, dictionary_encode=True,
+                 codecs=None, sort_by=None, cubes=None, job_id=None,
+                 replace=False, member=None, infer_types=False,
+                 sample_rows=SAMPLE_ROWS):
+    """
+    Load a CSV file with headers into a new chunked columnar dataset, see
+    cr.db.dataset. Rows are read, converted and stored one chunk of
+    chunk_rows rows at a time, so memory use does not grow with the file.
+
+    The file may be gzip, bz2 or zip compressed. It is decompressed as it
+    is read, without an extracted copy on disk. member picks the file to
+    load from a zip archive of several files, see load_datasets().
+
+    sparse_ratio:
+        Chunks of a column with a larger fraction of missing values than
+        this are stored sparse.
+    dictionary_encode:
+        Dictionary encode low cardinality catch all string columns.
+    codecs:
+        Block compression of the stored chunks: a cr.db.compression codec
+        name, 'auto', or {header: codec}. See DatasetWriter.
+    sort_by:
+        Header of a column to sort the rows on, missing values last, to
+        cluster the rows and sharpen the chunk zone maps for range filters
+        on that column. Sorting needs every converted row in memory.
+    cubes:
+        Cross-tab cubes to materialize while loading, as a list of
+        {'dimensions': [category header, ...],
+         'measures': [numeric header, ...]}. See cr.db.cubes.
+    job_id:
+        Checkpoint the byte offset, row count and writer counters in an
+        ingest job (see cr.db.jobs) after every chunk, with the writer's
+        dictionaries, sketches and cubes in their own documents. Loading
+        again with the same job id resumes an interrupted load from its
+        last checkpoint, or returns the dataset id of a finished one.
+        Cannot be combined with sort_by.
+    replace:
+        Once the new dataset is stored, delete the other datasets loaded
+        from the same file (or zip member).
+    infer_types:
+        Type the columns that only match the catch all string rule from
+        the first sample_rows rows, see cr.db.inference. The schema is
+        cached for files with the same headers.
+
+    Return the dataset id.
+    """
+    job = None
+    if job_id is not None:
+        if sort_by is not None:
+            raise ValueError("Sorted loads cannot be checkpointed")
+        job = IngestJob(db, job_id, csv_filename)
+        if job.done:
+            return job.get('dataset_id')
+
+    schema = None
+    if infer_types:
+        with metrics.timer('cr_load_stage_seconds', stage='infer'):
+            schema = infer_schema(db, csv_filename, sample_rows,
+                                  member=member)['columns']
+
+    with open_source(csv_filename, member) as csv_file:
+        if job is None:
+            csv_data = csv.reader(csv_file)
+        else:
+            # Count the lines read, for the offset after each chunk
+            lines = LineCounter(csv_file)
+            csv_data = csv.reader(lines)
+        headers = fill_blank_headers(csv_data.next())
+        with metrics.timer('cr_load_stage_seconds', stage='resolve'):
+            if schema is None:
+                converter_funcs = get_converter_funcs(headers)
+            else:
+                converter_funcs = column_types_from_specs(headers, schema)
+        writer = DatasetWriter(db, headers, converter_funcs,
+                               name=source_name(csv_filename, member),
+                               source=source_path(csv_filename, member),
+                               chunk_rows=chunk_rows,
+                               sparse_ratio=sparse_ratio,
+                               dictionary_encode=dictionary_encode,
+                               codecs=codecs, sorted_by=sort_by,
+                               cubes=cubes, schema=schema)
+        if sort_by is not None:
+            _write_sorted(csv_data, converter_funcs,
+                          headers.index(sort_by), writer)
+            _count_cells(converter_funcs, writer.num_rows)
+            return writer.finish(replace=replace)
+        if job is not None:
+            if job.resumed:
+                writer.restore(job.get('writer'))
+                lines.skip_to(job.get('offset'))
+            else:
+                job.checkpoint(offset=lines.offset,
+                               writer=writer.save_state())
+        resumed_rows = writer.num_rows
+        while True:
+            rows = _read_rows(csv_data, chunk_rows)
+            if not rows:
+                break
+            columns = [[] for _ in headers]
+            _convert_rows(rows, converter_funcs, columns)
+            writer.write_chunk(columns)
+            if job is not None:
+                job.checkpoint(offset=lines.offset,
+                               num_rows=writer.num_rows,
+                               writer=writer.save_state())
+        _count_cells(converter_funcs, writer.num_rows - resumed_rows)
+        dataset_id = writer.finish(replace=replace)
+        if job is not None:
+            job.finish(dataset_id=dataset_id)
+        return dataset_id
+
+
+def load_datasets(filename, db, job_id=None, **kwargs):
+    """
+    Load every CSV file of a zip archive as its own dataset, or a single
+    plain or compressed CSV file as one dataset. Takes the load_dataset()
+    arguments; with job_id, each member gets the job '<job_id>:<member>'.
+    Return the list of dataset ids.
+    """
+    dataset_ids = []
+    for member in source_members(filename):
+        member_job_id = job_id
+        if job_id is not None and member is not None:
+            member_job_id = '{}:{}'.format(job_id, member)
+        dataset_ids.append(load_dataset(filename, db, job_id=member_job_id,
+                                        member=member, **kwargs))
+    return dataset_ids
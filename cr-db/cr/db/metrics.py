@@ -0,0 +1,214 @@
+"""
+Lightweight process-wide metrics: counters and histograms that can be
+rendered in the Prometheus text exposition format.
+
+Collection is off by default. While disabled, the instrumentation calls are
+cheap no-ops, so they can stay in the hot paths of the loader, the store and
+the API server. Turn it on with ``enable()`` or with ``"metrics": true`` in
+the settings passed to ``cr.db.store.connect()``.
+"""
+import threading
+import time
+
+
+# Default latency buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _NullTimer(object):
+    """Timer handed out while metrics are disabled. Does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry.observe(self.name, time.time() - self.start,
+                              **self.labels)
+        return False
+
+
+class _Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.iteritems()))
+
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v))
+                          for k, v in pairs) + '}'
+
+
+def _escape(value):
+    return (str(value).replace('\\', r'\\')
+                      .replace('"', r'\"')
+                      .replace('\n', r'\n'))
+
+
+def _format_number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._counters = {}     # {name: {label_key: value}}
+        self._histograms = {}   # {name: {label_key: _Histogram}}
+        self._buckets = {}      # {name: bucket bounds}
+        self._help = {}         # {name: help text}
+
+    def describe(self, name, help_text, buckets=None):
+        """Register help text (and optionally buckets) for a metric name."""
+        self._help[name] = help_text
+        if buckets is not None:
+            self._buckets[name] = tuple(sorted(buckets))
+
+    def inc(self, name, amount=1, **labels):
+        """Add amount to a counter."""
+        if not self.enabled:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """Record one observation in a histogram."""
+        if not self.enabled:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = _Histogram(
+                    self._buckets.get(name, DEFAULT_BUCKETS))
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        """
+        Return a context manager that observes its elapsed wall time, in
+        seconds, in the named histogram.
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name in sorted(self._counters):
+                self._render_header(lines, name, 'counter')
+                for key, value in sorted(self._counters[name].iteritems()):
+                    lines.append('{}{} {}'.format(
+                        name, _format_labels(key), _format_number(value)))
+            for name in sorted(self._histograms):
+                self._render_header(lines, name, 'histogram')
+                for key, hist in sorted(self._histograms[name].iteritems()):
+                    cumulative = 0
+                    for bound, count in zip(hist.buckets, hist.counts):
+                        cumulative += count
+                        lines.append('{}_bucket{} {}'.format(
+                            name, _format_labels(key, [('le', repr(bound))]),
+                            cumulative))
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _format_labels(key, [('le', '+Inf')]),
+                        hist.count))
+                    lines.append('{}_sum{} {}'.format(
+                        name, _format_labels(key), repr(hist.sum)))
+                    lines.append('{}_count{} {}'.format(
+                        name, _format_labels(key), hist.count))
+        return '\n'.join(lines) + '\n'
+
+    def _render_header(self, lines, name, metric_type):
+        if name in self._help:
+            lines.append('# HELP {} {}'.format(name, self._help[name]))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+
+
+REGISTRY = Registry()
+
+REGISTRY.describe('cr_load_stage_seconds',
+                  'Time spent in each dataset/data load stage')
+REGISTRY.describe('cr_load_rows_total', 'Rows read by the loaders')
+REGISTRY.describe('cr_load_cells_total',
+                  'Cells converted, by ColumnType class')
+REGISTRY.describe('cr_mongo_commands_total', 'Mongo round trips by command')
+REGISTRY.describe('cr_mongo_command_failures_total',
+                  'Failed Mongo round trips by command')
+REGISTRY.describe('cr_mongo_command_seconds', 'Mongo round trip latency')
+REGISTRY.describe('cr_mongo_request_bytes_total',
+                  'BSON bytes sent to Mongo by command')
+REGISTRY.describe('cr_mongo_reply_bytes_total',
+                  'BSON bytes received from Mongo by command')
+REGISTRY.describe('cr_http_request_seconds', 'API request latency by endpoint')
+REGISTRY.describe('cr_position_moves_total', 'User positions reported')
+REGISTRY.describe('cr_position_writes_total',
+                  'User positions written, after coalescing')
+
+
+def enable(enabled=True):
+    REGISTRY.enabled = enabled
+
+
+def is_enabled():
+    return REGISTRY.enabled
+
+
+def configure(settings):
+    """Enable metrics if the settings ask for them."""
+    if settings.get('metrics'):
+        enable()
+
+
+inc = REGISTRY.inc
+observe = REGISTRY.observe
+timer = REGISTRY.timer
+render = REGISTRY.render
+reset = REGISTRY.reset
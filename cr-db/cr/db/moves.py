@@ -0,0 +1,141 @@
+"""
+Coalesced writes of user positions.
+
+Users report their position every few minutes; at a million users that
+would be thousands of single document updates, each a round trip, per
+second. ``MoveWriter`` buffers the reported positions in memory instead,
+keeping only the latest per user, and writes them every max_staleness
+seconds as unordered ``bulk_write()`` batches of at most batch_size
+updates. A user is written at most once per flush however often it
+moves, and a flush is one round trip per batch.
+
+After each flush the {user id: (latitude, longitude)} of the written
+users are passed to the subscribers, e.g. ``PositionStore.update()``, so
+caches derived from the positions refresh only what changed.
+"""
+import logging
+import threading
+
+from pymongo import UpdateOne
+
+from cr.db import metrics
+from cr.db.users import user_location
+
+log = logging.getLogger(__name__)
+
+# Seconds a reported position may wait before it is written
+MAX_STALENESS = 5.0
+
+# Updates per bulk_write() round trip
+BATCH_SIZE = 1000
+
+# Buffered users that trigger a flush before max_staleness is up
+MAX_PENDING = 100000
+
+
+def position_update(user_id, latitude, longitude):
+    """Return the UpdateOne setting a user's position fields"""
+    location = user_location({'latitude': latitude, 'longitude': longitude})
+    return UpdateOne({'_id': user_id}, {'$set': {
+        # Strings, as the loaded user documents have them
+        'latitude': repr(float(latitude)),
+        'longitude': repr(float(longitude)),
+        'location': location,
+    }})
+
+
+class MoveWriter(object):
+
+    def __init__(self, collection, max_staleness=MAX_STALENESS,
+                 batch_size=BATCH_SIZE, max_pending=MAX_PENDING):
+        self.collection = collection
+        self.max_staleness = max_staleness
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.pending = {}       # {user id: (latitude, longitude)}
+        self.subscribers = []
+        self.lock = threading.Lock()
+        # Serializes flushes, so positions are written in report order
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def subscribe(self, callback):
+        """Call callback({user id: (latitude, longitude)}) after flushes"""
+        self.subscribers.append(callback)
+
+    def move(self, user_id, latitude, longitude):
+        """
+        Buffer a user's new position, replacing any not yet written.
+        Raise ValueError for an invalid position.
+        """
+        if user_location({'latitude': latitude,
+                          'longitude': longitude}) is None:
+            raise ValueError("Invalid position: {}, {}".format(latitude,
+                                                               longitude))
+        with self.lock:
+            self.pending[user_id] = (float(latitude), float(longitude))
+            full = len(self.pending) >= self.max_pending
+        metrics.inc('cr_position_moves_total')
+        if full:
+            self.wakeup.set()
+
+    def flush(self):
+        """
+        Write the buffered positions and notify the subscribers. Return
+        the number of users written.
+        """
+        with self.flush_lock:
+            with self.lock:
+                changes, self.pending = self.pending, {}
+            if not changes:
+                return 0
+            updates = [position_update(user_id, latitude, longitude)
+                       for user_id, (latitude, longitude)
+                       in changes.iteritems()]
+            try:
+                for start in xrange(0, len(updates), self.batch_size):
+                    batch = updates[start:start + self.batch_size]
+                    self.collection.bulk_write(batch, ordered=False)
+                    metrics.inc('cr_position_writes_total', len(batch))
+            except Exception:
+                # Keep the positions for the next flush, unless newer ones
+                # came in meanwhile. Rewriting a written one is harmless.
+                with self.lock:
+                    for user_id, position in changes.iteritems():
+                        self.pending.setdefault(user_id, position)
+                raise
+            for callback in self.subscribers:
+                callback(changes)
+            return len(changes)
+
+    def _run(self):
+        while not self.stopping.is_set():
+            self.wakeup.wait(self.max_staleness)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Position flush failed")
+        self.flush()
+
+    def start(self):
+        """Flush every max_staleness seconds in a daemon thread"""
+        if self.thread is None:
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._run,
+                                           name='position-writer')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """Stop the flush thread, writing what is still buffered"""
+        if self.thread is not None:
+            self.stopping.set()
+            self.wakeup.set()
+            self.thread.join()
+            self.thread = None
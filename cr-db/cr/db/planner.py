@@ -0,0 +1,288 @@
+"""
+Storage planning for datasets.
+
+``ColumnProfileVisitor`` extends the streaming encoded-size estimate with
+per-column statistics (nulls, distinct values, runs, value range) gathered in
+the same pass. ``plan_storage()`` uses those to estimate, for every column,
+the size of each candidate encoding:
+
+bson
+    One BSON array element per cell, as load_dataset() stores it today.
+typed
+    Fixed width binary values, one slot per row, plus a null bitmap.
+dictionary
+    A table of the distinct values plus a fixed width code per row.
+rle
+    (value, run length) pairs.
+null_bitmap
+    A validity bitmap plus fixed width values for the non-null rows only.
+
+It recommends the cheapest encoding per column and reports which document
+layout fits under the Mongo document size limit.
+"""
+from cr.db.scan import EncodedSizeVisitor, bson_value_size
+
+MONGO_DOCUMENT_LIMIT = 16 * 1024 * 1024
+
+# Stop tracking distinct values of a column past this many
+MAX_DICTIONARY_SIZE = 2**16
+
+ENCODINGS = ('bson', 'typed', 'dictionary', 'rle', 'null_bitmap')
+
+
+class ColumnStats(object):
+    """Statistics about the converted values of one column"""
+
+    def __init__(self):
+        self.nulls = 0
+        self.runs = 0
+        self.empty = True
+        self.first = None
+        self.last = None
+        self.distinct = set()
+        self.distinct_overflow = False
+        self.kinds = set()
+        self.min = None
+        self.max = None
+        # Payload bytes of the non-null values in a flat binary buffer
+        self.value_bytes = 0
+
+    def add(self, value):
+        if (self.empty or value != self.last or
+                type(value) is not type(self.last)):
+            self.runs += 1
+            if self.empty:
+                self.first = value
+                self.empty = False
+        self.last = value
+        if value is None:
+            self.nulls += 1
+            return
+        if not self.distinct_overflow:
+            self.distinct.add(value)
+            if len(self.distinct) > MAX_DICTIONARY_SIZE:
+                self.distinct_overflow = True
+                self.distinct = set()
+        kind = type(value)
+        self.kinds.add(kind)
+        if kind is str or kind is unicode:
+            # Length prefixed bytes
+            self.value_bytes += 4 + len(value)
+        elif kind is not bool:
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def merge(self, other):
+        """Merge the stats of the rows following these ones"""
+        if other.empty:
+            return
+        self.runs += other.runs
+        if (not self.empty and self.last == other.first and
+                type(self.last) is type(other.first)):
+            self.runs -= 1
+        if self.empty:
+            self.first = other.first
+            self.empty = False
+        self.last = other.last
+        self.nulls += other.nulls
+        if other.distinct_overflow:
+            self.distinct_overflow = True
+        if not self.distinct_overflow:
+            self.distinct.update(other.distinct)
+            if len(self.distinct) > MAX_DICTIONARY_SIZE:
+                self.distinct_overflow = True
+        if self.distinct_overflow:
+            self.distinct = set()
+        self.kinds.update(other.kinds)
+        if other.min is not None:
+            if self.min is None or other.min < self.min:
+                self.min = other.min
+            if self.max is None or other.max > self.max:
+                self.max = other.max
+        self.value_bytes += other.value_bytes
+
+    def value_width(self):
+        """
+        Return the fixed width, in bytes, of one binary value, or None for
+        strings, which have no fixed width.
+        """
+        if str in self.kinds or unicode in self.kinds:
+            return None
+        if float in self.kinds:
+            return 8
+        if self.min is None:
+            # Only booleans, or nothing at all
+            return 1
+        return _int_width(self.min, self.max)
+
+
+def _int_width(low, high):
+    for width in (1, 2, 4):
+        bound = 2**(8 * width - 1)
+        if -bound <= low and high < bound:
+            return width
+    return 8
+
+
+def _bitmap_size(num_rows):
+    return (num_rows + 7) // 8
+
+
+class ColumnProfileVisitor(EncodedSizeVisitor):
+    """
+    Streaming encoded size estimate plus ColumnStats for every column.
+    Result adds 'stats': [ColumnStats, ...] in column order.
+    """
+
+    def start(self, headers):
+        super(ColumnProfileVisitor, self).start(headers)
+        if not hasattr(self, 'stats'):
+            self.stats = [ColumnStats() for _ in self.headers]
+
+    def visit(self, row):
+        value_sizes = self.value_sizes
+        converter_funcs = self.converter_funcs
+        stats = self.stats
+        for i, data in enumerate(row):
+            value = converter_funcs[i](data)
+            value_sizes[i] += bson_value_size(value)
+            stats[i].add(value)
+        self.num_rows += 1
+
+    def merge(self, other):
+        super(ColumnProfileVisitor, self).merge(other)
+        for stats, other_stats in zip(self.stats, other.stats):
+            stats.merge(other_stats)
+
+    def result(self):
+        result = super(ColumnProfileVisitor, self).result()
+        result['headers'] = self.headers
+        result['stats'] = self.stats
+        result['column_bson_sizes'] = self.column_sizes()
+        return result
+
+
+def estimate_encodings(stats, num_rows, bson_size):
+    """
+    Estimate the size of each candidate encoding of a column.
+    Return {encoding_name: bytes}. Encodings that do not apply to the
+    column's values are left out.
+    """
+    sizes = {'bson': bson_size}
+    non_null = num_rows - stats.nulls
+    width = stats.value_width()
+    if width is None:
+        # Strings: offsets instead of fixed width slots
+        sizes['typed'] = 4 * num_rows + stats.value_bytes
+        sizes['null_bitmap'] = (_bitmap_size(num_rows) + 4 * non_null +
+                                stats.value_bytes)
+        run_value_size = 4 + stats.value_bytes / max(non_null, 1)
+    else:
+        bits = stats.kinds == set([bool])
+        if bits:
+            # Booleans pack 8 to a byte
+            sizes['typed'] = 2 * _bitmap_size(num_rows)
+            sizes['null_bitmap'] = (_bitmap_size(num_rows) +
+                                    _bitmap_size(non_null))
+        else:
+            sizes['typed'] = width * num_rows + _bitmap_size(num_rows)
+            sizes['null_bitmap'] = _bitmap_size(num_rows) + width * non_null
+        run_value_size = width
+    # Each run stores its value (nulls included) and a 4 byte length
+    sizes['rle'] = stats.runs * (run_value_size + 4)
+    if not stats.distinct_overflow:
+        table = sum(bson_value_size(value) for value in stats.distinct)
+        # Code 0 is reserved for None
+        code_width = _int_width(0, len(stats.distinct))
+        sizes['dictionary'] = table + code_width * num_rows
+    return dict((k, int(v)) for k, v in sizes.iteritems())
+
+
+def _round_down_power_of_2(n):
+    power = 1
+    while power * 2 <= n:
+        power *= 2
+    return power
+
+
+def plan_layout(column_sizes, num_rows, limit=MONGO_DOCUMENT_LIMIT,
+                headroom=0.9):
+    """
+    Pick the simplest document layout that keeps each document under
+    headroom * limit bytes:
+
+    single_document
+        All columns in one dataset document.
+    document_per_column
+        One document per column.
+    row_chunks
+        One document per column per chunk of chunk_rows rows.
+
+    Return a dict describing the layout.
+    """
+    budget = int(limit * headroom)
+    total = sum(column_sizes)
+    largest = max(column_sizes) if column_sizes else 0
+    if total <= budget:
+        return {'layout': 'single_document', 'documents': 1,
+                'largest_document': total}
+    if largest <= budget:
+        return {'layout': 'document_per_column',
+                'documents': len(column_sizes),
+                'largest_document': largest}
+    bytes_per_row = float(largest) / max(num_rows, 1)
+    chunk_rows = _round_down_power_of_2(max(int(budget / bytes_per_row), 1))
+    chunks = (num_rows + chunk_rows - 1) // chunk_rows
+    return {'layout': 'row_chunks',
+            'chunk_rows': chunk_rows,
+            'documents': chunks * len(column_sizes),
+            'largest_document': int(chunk_rows * bytes_per_row)}
+
+
+def plan_storage(profile, limit=MONGO_DOCUMENT_LIMIT):
+    """
+    Given the result of a ColumnProfileVisitor, compare the candidate
+    encodings of every column and recommend the cheapest.
+
+    Return a dictionary::
+
+        {
+            'num_rows': rows,
+            'columns': [{'header': header,
+                         'encodings': {encoding: bytes},
+                         'recommended': encoding}, ...],
+            'totals': {'bson': bytes, 'recommended': bytes},
+            'layouts': {'bson': layout, 'recommended': layout},
+        }
+    """
+    num_rows = profile['num_rows']
+    columns = []
+    bson_sizes = profile['column_bson_sizes']
+    recommended_sizes = []
+    for i, stats in enumerate(profile['stats']):
+        sizes = estimate_encodings(stats, num_rows, bson_sizes[i])
+        recommended = min(sizes, key=lambda k: (sizes[k],
+                                                ENCODINGS.index(k)))
+        recommended_sizes.append(sizes[recommended])
+        columns.append({
+            'header': profile['headers'][i],
+            'encodings': sizes,
+            'recommended': recommended,
+            'nulls': stats.nulls,
+            'distinct': (None if stats.distinct_overflow
+                         else len(stats.distinct)),
+        })
+    return {
+        'num_rows': num_rows,
+        'columns': columns,
+        'totals': {
+            'bson': profile['total'],
+            'recommended': sum(recommended_sizes),
+        },
+        'layouts': {
+            'bson': plan_layout(bson_sizes, num_rows, limit),
+            'recommended': plan_layout(recommended_sizes, num_rows, limit),
+        },
+    }
@@ -0,0 +1,146 @@
+"""
+In-memory store of user positions.
+
+Distance computations need the latitude and longitude of every user, not
+the rest of the user documents. ``PositionStore`` keeps them in two
+contiguous float64 arrays, one slot per user, plus a {user id: slot}
+index: 16 bytes of coordinates per user. It is loaded once from the users
+collection with a projected cursor and then updated in place as users
+move. The slots of removed users are reused by the next users added.
+
+Free slots hold NaN. ``coordinates()`` returns zero-copy views of the
+arrays; ``snapshot()`` returns compact copies of the live positions only.
+
+Every change bumps ``version``, so results derived from the positions can
+be cached against it.
+"""
+import threading
+
+import numpy as np
+
+from cr.db.users import user_location
+
+INITIAL_CAPACITY = 1024
+
+
+class PositionStore(object):
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self.latitudes = np.full(capacity, np.nan)
+        self.longitudes = np.full(capacity, np.nan)
+        self.slots = {}         # {user id: slot}
+        self.ids = []           # slot: user id, None when free
+        self.free = []          # free slots below len(ids)
+        self.version = 0
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, user_id):
+        return user_id in self.slots
+
+    def _grow(self, capacity):
+        for name in ('latitudes', 'longitudes'):
+            old = getattr(self, name)
+            new = np.full(capacity, np.nan)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def _slot(self, user_id):
+        slot = self.slots.get(user_id)
+        if slot is not None:
+            return slot
+        if self.free:
+            slot = self.free.pop()
+            self.ids[slot] = user_id
+        else:
+            slot = len(self.ids)
+            if slot == len(self.latitudes):
+                self._grow(2 * len(self.latitudes))
+            self.ids.append(user_id)
+        self.slots[user_id] = slot
+        return slot
+
+    def set(self, user_id, latitude, longitude):
+        """Add a user or move it to a new position"""
+        with self.lock:
+            slot = self._slot(user_id)
+            self.latitudes[slot] = latitude
+            self.longitudes[slot] = longitude
+            self.version += 1
+
+    def update(self, positions):
+        """Set many positions at once: an iterable of (id, lat, lon)"""
+        with self.lock:
+            for user_id, latitude, longitude in positions:
+                slot = self._slot(user_id)
+                self.latitudes[slot] = latitude
+                self.longitudes[slot] = longitude
+            self.version += 1
+
+    def remove(self, user_id):
+        """Forget a user, freeing its slot. Unknown ids are ignored."""
+        with self.lock:
+            slot = self.slots.pop(user_id, None)
+            if slot is None:
+                return
+            self.ids[slot] = None
+            self.latitudes[slot] = np.nan
+            self.longitudes[slot] = np.nan
+            self.free.append(slot)
+            self.version += 1
+
+    def get(self, user_id):
+        """Return (latitude, longitude) of a user, or None"""
+        slot = self.slots.get(user_id)
+        if slot is None:
+            return None
+        return self.latitudes[slot], self.longitudes[slot]
+
+    def coordinates(self):
+        """
+        Return views of the (latitudes, longitudes) of every slot in use or
+        free, NaN for free ones. The views see later updates, and are cut
+        off from the store when it grows.
+        """
+        used = len(self.ids)
+        return self.latitudes[:used], self.longitudes[:used]
+
+    def snapshot(self):
+        """
+        Return (ids, latitudes, longitudes) of the stored users, as a list
+        and compact array copies that later updates do not change.
+        """
+        with self.lock:
+            used = len(self.ids)
+            if not self.free:
+                return (list(self.ids), self.latitudes[:used].copy(),
+                        self.longitudes[:used].copy())
+            live = np.array([user_id is not None for user_id in self.ids],
+                            dtype=bool)
+            return ([user_id for user_id in self.ids if user_id is not None],
+                    self.latitudes[:used][live], self.longitudes[:used][live])
+
+    def load(self, db, query=None):
+        """
+        Add the position of every user matching query, reading only the
+        coordinate fields. Users without a valid position are skipped.
+        Return the number of users added.
+        """
+        cursor = db.users.find(query or {},
+                               {'latitude': True, 'longitude': True})
+        positions = []
+        for user in cursor:
+            location = user_location(user)
+            if location is not None:
+                longitude, latitude = location['coordinates']
+                positions.append((user['_id'], latitude, longitude))
+        with self.lock:
+            capacity = len(self.latitudes)
+            while capacity < len(self.ids) + len(positions):
+                capacity *= 2
+            if capacity > len(self.latitudes):
+                self._grow(capacity)
+            self.update(positions)
+        return len(positions)
@@ -0,0 +1,188 @@
+"""
+Pair queries on user positions: all pairs within a radius, and the k
+closest pairs.
+
+Comparing every pair is O(n**2). Instead the positions are put on the
+unit sphere in 3D and bucketed in a grid of cubes as wide as the search
+radius (as a chord). Two points within the radius are then in the same or
+neighbouring cubes, so only those are compared. Sorting the points into
+cubes is O(n log n), and the comparisons grow with the output and the
+local density rather than with n**2.
+
+Candidate pairs are generated and filtered with NumPy a batch at a time,
+and results are yielded as they are found, so memory is bounded by the
+batch size: crowded cube pairs are cut into slices of rows. Only a single
+cube of more than BATCH_PAIRS points makes a batch (of one row) larger.
+"""
+import numpy as np
+
+from cr.db.distances import EARTH_RADIUS_KM
+
+# Candidate pairs compared per NumPy batch
+BATCH_PAIRS = 2**20
+
+# Smallest cube side, as a chord of the unit sphere (about 64 m), so the
+# packed cube keys fit an int64
+MIN_CELL = 1e-5
+
+# Neighbour cubes after a cube in key order; with the cube itself, every
+# pair of adjacent cubes is visited once
+_OFFSETS = [(dx, dy, dz)
+            for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)
+            if (dx, dy, dz) > (0, 0, 0)]
+
+
+def unit_vectors(latitudes, longitudes):
+    """Return the (n, 3) points on the unit sphere"""
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lon = np.radians(np.asarray(longitudes, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon),
+                            np.sin(lat)])
+
+
+def km_to_chord(km):
+    """Return the straight line distance on the unit sphere for km"""
+    return 2 * np.sin(np.minimum(km / EARTH_RADIUS_KM, np.pi) / 2)
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(chord / 2, 1.0))
+
+
+class SpatialGrid(object):
+    """Points on the unit sphere bucketed in cubes of side cell"""
+
+    def __init__(self, points, cell):
+        self.points = points
+        self.cell = cell = max(cell, MIN_CELL)
+        span = int(np.ceil(1 / cell)) + 1
+        # Shifted so the keys and their neighbours' are >= 0
+        keys = np.floor(points / cell).astype(np.int64) + span
+        self.size = size = 2 * span + 2
+        codes = (keys[:, 0] * size + keys[:, 1]) * size + keys[:, 2]
+        self.order = np.argsort(codes, kind='mergesort')
+        self.cells, self.starts, self.counts = np.unique(
+            codes[self.order], return_index=True, return_counts=True)
+
+    def neighbour_cells(self):
+        """
+        Yield (a, b, same) arrays of indexes into self.cells of the
+        adjacent cube pairs, same True for the pairs of a cube with itself.
+        """
+        every = np.arange(len(self.cells))
+        yield every, every, True
+        size = self.size
+        for dx, dy, dz in _OFFSETS:
+            wanted = self.cells + (dx * size + dy) * size + dz
+            found = np.searchsorted(self.cells, wanted)
+            found[found == len(self.cells)] = 0
+            hit = self.cells[found] == wanted
+            yield every[hit], found[hit], False
+
+    def candidate_pairs(self):
+        """
+        Yield (i, j) arrays of point indexes of the pairs in adjacent
+        cubes, each pair once, about BATCH_PAIRS at a time.
+        """
+        counts, starts = self.counts, self.starts
+        for a, b, same in self.neighbour_cells():
+            if same:
+                keep = counts[a] > 1
+                a, b = a[keep], b[keep]
+            # Cut crowded cube pairs into slices of rows of a, so that a
+            # batch holds at most BATCH_PAIRS pairs (or a single row)
+            height, width = counts[a], counts[b]
+            step = np.maximum(BATCH_PAIRS // width, 1)
+            slices = -(-height // step)
+            pair = np.repeat(np.arange(len(a)), slices)
+            first_row = (np.arange(slices.sum()) -
+                         np.repeat(np.cumsum(slices) - slices, slices))
+            first_row *= step[pair]
+            rows = np.minimum(step[pair], height[pair] - first_row)
+            row_start = starts[a][pair] + first_row
+            column_start = starts[b][pair]
+            width = width[pair]
+            sizes = rows * width
+            ends = np.cumsum(sizes)
+            first = 0
+            while first < len(sizes):
+                last = max(np.searchsorted(ends, ends[first] - sizes[first] +
+                                           BATCH_PAIRS, side='right'),
+                           first + 1)
+                batch = slice(first, last)
+                i, j = self._expand(row_start[batch], column_start[batch],
+                                    width[batch], sizes[batch])
+                if same:
+                    # Each pair of a cube with itself once
+                    keep = i < j
+                    i, j = i[keep], j[keep]
+                yield self.order[i], self.order[j]
+                first = last
+
+    def _expand(self, row_start, column_start, width, sizes):
+        """
+        Return the (i, j) sorted positions of every pair of a block of rows
+        by a block of width columns, for each block.
+        """
+        block = np.repeat(np.arange(len(sizes)), sizes)
+        within = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes,
+                                                    sizes)
+        width = width[block]
+        return (row_start[block] + within // width,
+                column_start[block] + within % width)
+
+
+def iter_pairs_within(latitudes, longitudes, radius_km):
+    """
+    Yield (i, j, km) arrays of the index pairs of points at most radius_km
+    apart, i < j, and their distances, a batch at a time. Each pair is
+    yielded once, in no particular order.
+    """
+    points = unit_vectors(latitudes, longitudes)
+    if len(points) < 2:
+        return
+    limit = km_to_chord(radius_km)
+    grid = SpatialGrid(points, limit)
+    for i, j in grid.candidate_pairs():
+        chords = np.sqrt(((points[i] - points[j]) ** 2).sum(axis=1))
+        near = chords <= limit
+        if near.any():
+            i, j = i[near], j[near]
+            swap = i > j
+            i[swap], j[swap] = j[swap], i[swap]
+            yield i, j, chord_to_km(chords[near])
+
+
+def closest_pairs(latitudes, longitudes, k):
+    """
+    Return (i, j, km) arrays of the k closest pairs of points, closest
+    first. The search radius starts where about 2k pairs would fall for
+    evenly spread points, and grows until k pairs are found.
+    """
+    n = len(latitudes)
+    pairs = n * (n - 1) // 2
+    k = min(k, pairs)
+    best_i = best_j = np.zeros(0, dtype=np.int64)
+    best_km = np.zeros(0)
+    if k <= 0:
+        return best_i, best_j, best_km
+    # A cap of chord c holds c**2 / 4 of the sphere
+    chord = min(2 * np.sqrt(2.0 * k / pairs), 2.0)
+    while True:
+        radius_km = chord_to_km(chord)
+        best_i = best_j = np.zeros(0, dtype=np.int64)
+        best_km = np.zeros(0)
+        for i, j, km in iter_pairs_within(latitudes, longitudes, radius_km):
+            best_i = np.concatenate([best_i, i])
+            best_j = np.concatenate([best_j, j])
+            best_km = np.concatenate([best_km, km])
+            if len(best_km) > k:
+                keep = np.argpartition(best_km, k - 1)[:k]
+                best_i, best_j, best_km = (best_i[keep], best_j[keep],
+                                           best_km[keep])
+        if len(best_km) >= k or chord >= 2.0:
+            break
+        chord = min(chord * 2, 2.0)
+    order = np.lexsort((best_j, best_i, best_km))
+    return best_i[order], best_j[order], best_km[order]
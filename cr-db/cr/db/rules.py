@@ -1,8 +1,12 @@
 """
 Implement rules for converting and normalizing data column values
 """
+from collections import namedtuple
+import itertools
 import re
 
+import numpy as np
+
 from .countries import COUNTRIES
 
 
@@ -13,13 +17,37 @@ from .countries import COUNTRIES
 
 class ColumnType(object):
 
+    # NumPy dtype string of the normalized values when stored in a binary
+    # buffer, or 'O' for values stored as Python objects.
+    dtype = 'O'
+
     def __call__(self, value):
         """Convert column raw string value to normalized value"""
         raise NotImplementedError()
 
 
+# A pandas style categorical: codes index into the categories, -1 for
+# missing. pandas.Categorical.from_codes(codes, categories) accepts it.
+Categorical = namedtuple('Categorical', ['codes', 'categories'])
+
+
+def _category_dtype(codes):
+    """Return the smallest NumPy dtype string that holds all of the codes"""
+    if all(isinstance(code, bool) for code in codes):
+        return '|b1'
+    for dtype in ('|i1', '<i2', '<i4'):
+        info = np.iinfo(dtype)
+        if all(info.min <= code <= info.max for code in codes):
+            return dtype
+    return '<i8'
+
+
 class CategoryColumn(ColumnType):
 
+    # (label count, code offset, labels, has label, categorical position),
+    # built on first use of the lookup table
+    _table = None
+
     def __init__(self, category_map):
         """
         category_map: Map of string category values to integers
@@ -34,6 +62,7 @@ class CategoryColumn(ColumnType):
         # Sanity checks
         assert len(self.category_map_orig) == len(self.category_map)
         assert len(self.category_map) == len(self.value_map)
+        self.dtype = _category_dtype(self.value_map)
 
     def __call__(self, value):
         """Convert a string value to an encoded integer."""
@@ -43,6 +72,59 @@ class CategoryColumn(ColumnType):
         """Attempt to re-create the original string from an encoded integer."""
         return self.value_map.get(index)
 
+    def _lookup(self):
+        # Labels are only ever added or removed at the end, so the label
+        # count tells whether the table is current
+        if self._table is None or self._table[0] != len(self.value_map):
+            codes = [int(code) for code in self.value_map]
+            offset = min(codes) if codes else 0
+            size = max(codes) - offset + 1 if codes else 0
+            labels = np.empty(size, dtype=object)
+            for code, label in self.value_map.iteritems():
+                labels[int(code) - offset] = label
+            known = np.zeros(size, dtype=bool)
+            known[np.array(codes, dtype=np.int64) - offset] = True
+            positions = np.cumsum(known) - 1
+            self._table = (len(self.value_map), offset, labels, known,
+                           positions)
+        return self._table[1:]
+
+    def label_table(self):
+        """
+        Return (offset, labels): a dense object array holding the label of
+        code c at labels[c - offset], and None for codes without a label.
+        """
+        offset, labels, _, _ = self._lookup()
+        return offset, labels
+
+    def decode(self, codes, categorical=False):
+        """
+        Map a whole array of codes, masked where missing, to labels in one
+        vectorized lookup. Return an object masked array, masked where the
+        code is missing or has no label.
+        With categorical, return a Categorical instead, its categories the
+        labels in code order.
+        """
+        offset, labels, known, positions = self._lookup()
+        codes = np.ma.asarray(codes)
+        index = np.asarray(np.ma.getdata(codes), dtype=np.int64) - offset
+        valid = ~np.ma.getmaskarray(codes)
+        valid &= (index >= 0) & (index < len(labels))
+        index[~valid] = 0
+        if len(labels):
+            valid &= known[index]
+        if categorical:
+            categories = labels[known].tolist()
+            if not len(labels):
+                return Categorical(np.full(len(index), -1, dtype=np.int64),
+                                   categories)
+            return Categorical(np.where(valid, positions[index], -1),
+                               categories)
+        values = np.empty(len(index), dtype=object)
+        if len(labels):
+            values[valid] = labels[index[valid]]
+        return np.ma.masked_array(values, mask=~valid)
+
 
 class EnumColumn(CategoryColumn):
 
@@ -59,6 +141,42 @@ class EnumColumn(CategoryColumn):
         super(EnumColumn, self).__init__(category_map)
 
 
+class DictionaryColumn(CategoryColumn):
+
+    dtype = '<i4'
+
+    def __init__(self, labels=()):
+        """
+        labels:
+            Sequence of distinct string values discovered in the data. The
+            first label is encoded as 1, the second as 2, etc. Unlike the
+            hand written categories, matching is case sensitive, so every
+            distinct string round trips exactly.
+        """
+        self.labels = []
+        self.category_map_orig = {}
+        self.value_map = {}
+        for label in labels:
+            self.add(label)
+        self.category_map = self.category_map_orig
+
+    def add(self, label):
+        """Add label to the dictionary if needed. Return its code."""
+        code = self.category_map_orig.get(label)
+        if code is None:
+            self.labels.append(label)
+            code = len(self.labels)
+            self.category_map_orig[label] = code
+            self.value_map[code] = label
+        return code
+
+    def __call__(self, value):
+        """Convert a string value to its code, None if empty or unknown."""
+        if not value:
+            return None
+        return self.category_map_orig.get(value)
+
+
 class BitmappedSetColumn(ColumnType):
 
     def __init__(self, set_items):
@@ -72,6 +190,9 @@ class BitmappedSetColumn(ColumnType):
         for i, item in enumerate(set_items):
             set_spec[item] = 2**i
         self.set_spec = set_spec
+        # Up to 64 items fit an unsigned 64 bit integer
+        self.dtype = '<u8' if len(set_spec) <= 64 else 'O'
+        self._byte_tables = None
 
     def __call__(self, value):
         """
@@ -98,15 +219,71 @@ class BitmappedSetColumn(ColumnType):
     def __getitem__(self, encoded_value):
         """Attempt to re-create the original string from an encoded value."""
         result = []
+        encoded_value = int(encoded_value)
         for item, bitmask in self.set_spec.iteritems():
             if bitmask & encoded_value:
                 result.append((bitmask, item))
         result.sort()
         return '; '.join(item[1] for item in result)
 
+    def items(self):
+        """Return the set items in bit order"""
+        return sorted(self.set_spec, key=self.set_spec.get)
+
+    def bit_table(self):
+        """Return the bit mask of each item, in bit order, as uint64"""
+        return np.array(sorted(self.set_spec.values()), dtype=np.uint64)
+
+    def item_matrix(self, values):
+        """
+        Return a boolean matrix with a row per value and a column per item
+        (in bit order), True where the item is in the value's set. Missing
+        values have no items.
+        """
+        values = np.ma.asarray(values)
+        bits = np.asarray(values.filled(0), dtype=np.uint64)
+        return (bits[:, np.newaxis] & self.bit_table()) != 0
+
+    def _byte_labels(self):
+        # For each byte of the bitmap, the items of each of its 256 values
+        if self._byte_tables is None:
+            items = self.items()
+            self._byte_tables = [
+                [tuple(items[k * 8 + bit] for bit in range(8)
+                       if byte >> bit & 1 and k * 8 + bit < len(items))
+                 for byte in range(256)]
+                for k in range((len(items) + 7) // 8)]
+        return self._byte_tables
+
+    def decode(self, values):
+        """
+        Map a whole array of bitmaps, masked where missing, to their '; '
+        joined labels. Each distinct bitmap is decoded once, a byte at a
+        time through precomputed tables of the items each byte value holds.
+        Return an object masked array.
+        """
+        values = np.ma.asarray(values)
+        mask = np.ma.getmaskarray(values)
+        if self.dtype == 'O':
+            labels = np.empty(len(values), dtype=object)
+            labels[:] = [None if missing else self[value] for value, missing
+                         in zip(values.data.tolist(), mask)]
+            return np.ma.masked_array(labels, mask=mask)
+        bitmaps, inverse = np.unique(
+            np.asarray(values.filled(0), dtype='<u8'), return_inverse=True)
+        tables = self._byte_labels()
+        distinct = np.empty(len(bitmaps), dtype=object)
+        distinct[:] = [
+            '; '.join(itertools.chain.from_iterable(
+                table[byte] for table, byte in zip(tables, row) if byte))
+            for row in bitmaps.view(np.uint8).reshape(-1, 8).tolist()]
+        return np.ma.masked_array(distinct[inverse], mask=mask)
+
 
 class FloatColumn(ColumnType):
 
+    dtype = '<f8'
+
     def __call__(self, value):
         try:
             return float(value)
@@ -118,6 +295,8 @@ FLOAT_COLUMN = FloatColumn()
 
 class IntColumn(ColumnType):
 
+    dtype = '<i8'
+
     def __call__(self, value):
         try:
             return int(value)
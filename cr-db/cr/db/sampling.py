@@ -0,0 +1,249 @@
+"""
+Row sampling for dataset previews.
+
+Previews and exploratory plots do not need every row. The samplers here
+pick row numbers first and then fetch the selected columns with
+``Dataset.take()``, which reads only the storage chunks holding sampled
+rows, so the cost follows the sample size rather than the dataset size.
+
+random_sample()
+    A uniform random sample of rows, without replacement. With
+    max_chunks, the rows are drawn from that many randomly chosen chunks
+    only, a cluster sample that bounds the chunks read for large samples.
+stratified_sample()
+    A sample drawn separately from each category of a column, in
+    proportion to the category sizes or a fixed number per category. The
+    category column itself is read whole (it is small, and kept in the
+    column cache).
+Reservoir
+    A fixed size uniform sample of a stream of unknown length, for files
+    and row streams that are read once. ``ReservoirVisitor`` samples the
+    rows of a CSV file during a ``cr.db.scan`` pass.
+
+The samplers return the same form as ``Dataset.filter_range()``:
+{'rows': row numbers, column: masked array of values, ...}, in row order.
+"""
+import math
+
+import numpy as np
+
+from cr.db.scan import Visitor
+
+
+def choose_rows(random, population, size):
+    """
+    Return size distinct numbers drawn uniformly from range(population),
+    sorted. Draws in proportion to size, not population, unless size is a
+    large part of the population.
+    """
+    if size >= population:
+        return np.arange(population, dtype=np.int64)
+    if size * 4 > population:
+        return np.sort(random.permutation(population)[:size])
+    chosen = np.unique(random.randint(0, population, size))
+    while len(chosen) < size:
+        more = random.randint(0, population, size - len(chosen))
+        chosen = np.unique(np.concatenate([chosen, more]))
+    return chosen.astype(np.int64)
+
+
+def _random_state(seed):
+    if isinstance(seed, np.random.RandomState):
+        return seed
+    return np.random.RandomState(seed)
+
+
+def random_sample(dataset, size, columns=(), seed=None, max_chunks=None):
+    """
+    Sample size rows uniformly at random, without replacement, and return
+    their values of the columns.
+
+    seed:
+        Seed or numpy RandomState, for repeatable samples.
+    max_chunks:
+        Draw the rows from at most this many chunks, picked at random.
+    """
+    random = _random_state(seed)
+    num_rows = dataset.num_rows
+    chunk_rows = dataset.document['chunk_rows']
+    if max_chunks is None or max_chunks >= dataset.num_chunks:
+        rows = choose_rows(random, num_rows, size)
+    else:
+        chunks = choose_rows(random, dataset.num_chunks, max_chunks)
+        starts = chunks * chunk_rows
+        counts = np.minimum(starts + chunk_rows, num_rows) - starts
+        # Rows are numbered through the chosen chunks, then mapped back
+        picks = choose_rows(random, int(counts.sum()), size)
+        ends = np.cumsum(counts)
+        which = np.searchsorted(ends, picks, side='right')
+        rows = starts[which] + picks - (ends - counts)[which]
+    return dataset.take(rows, columns)
+
+
+def allocate(sizes, size=None, per_stratum=None):
+    """
+    Return the number of rows to sample from each stratum, given their
+    sizes: per_stratum from each, or size in total, shared in proportion
+    to the stratum sizes by largest remainder. Never more than a stratum
+    holds.
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    if per_stratum is not None:
+        return np.minimum(sizes, per_stratum)
+    total = sizes.sum()
+    if size >= total:
+        return sizes
+    quotas = sizes * float(size) / total
+    counts = np.floor(quotas).astype(np.int64)
+    leftover = size - counts.sum()
+    if leftover:
+        order = np.argsort(counts - quotas, kind='mergesort')
+        counts[order[:leftover]] += 1
+    return counts
+
+
+def stratified_sample(dataset, by, size=None, per_stratum=None, columns=(),
+                      seed=None):
+    """
+    Sample rows separately from each category of the column by, either
+    size rows in total, shared in proportion to the category sizes, or
+    per_stratum rows from each category. Rows missing a category are not
+    sampled.
+
+    Return the values of by and of the columns, plus 'strata':
+    {category code: (rows in the dataset, rows sampled)}.
+    """
+    if (size is None) == (per_stratum is None):
+        raise ValueError("Give one of size and per_stratum")
+    random = _random_state(seed)
+    values = dataset.column(by)
+    present = np.flatnonzero(~np.ma.getmaskarray(values))
+    codes = values.data[present]
+    order = np.argsort(codes, kind='mergesort')
+    strata, starts, sizes = np.unique(codes[order], return_index=True,
+                                      return_counts=True)
+    counts = allocate(sizes, size, per_stratum)
+    parts = [present[order[start + choose_rows(random, stratum_size, count)]]
+             for start, stratum_size, count in zip(starts, sizes, counts)]
+    rows = np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+    result = dataset.take(rows, [by] + [column for column in columns
+                                        if column != by])
+    result['strata'] = dict(
+        (code, (int(stratum_size), int(count)))
+        for code, stratum_size, count in zip(strata.tolist(), sizes, counts))
+    return result
+
+
+class Reservoir(object):
+    """
+    A uniform random sample of up to size items of a stream, kept with
+    Li's algorithm L: the number of items to skip before the next one that
+    enters the sample is drawn directly, so skipped items cost nothing but
+    the count.
+    """
+
+    def __init__(self, size, seed=None):
+        self.size = size
+        self.random = _random_state(seed)
+        self.items = []
+        self.seen = 0
+        # Largest sample key, and stream index of the next item to keep
+        self._w = None
+        self._next = None
+
+    def _uniform(self):
+        value = 0.0
+        while value == 0.0:
+            value = self.random.random_sample()
+        return value
+
+    def _skip(self):
+        return int(math.floor(math.log(self._uniform()) /
+                              math.log1p(-self._w)))
+
+    def _start(self):
+        # The largest of the size smallest keys of seen uniform keys
+        self._w = self.random.beta(self.size, self.seen - self.size + 1)
+        self._next = self.seen + self._skip()
+
+    def extend(self, items):
+        """Offer a sequence of items, in stream order"""
+        count = len(items)
+        base = self.seen
+        offset = 0
+        if len(self.items) < self.size:
+            offset = min(self.size - len(self.items), count)
+            self.items.extend(items[:offset])
+            if len(self.items) == self.size:
+                self.seen = base + offset
+                self._start()
+        while self._next is not None and self._next < base + count:
+            self.items[self.random.randint(self.size)] = (
+                items[self._next - base])
+            self._w *= math.exp(math.log(self._uniform()) / self.size)
+            self._next += self._skip() + 1
+        self.seen = base + count
+
+    def add(self, item):
+        self.extend([item])
+
+    def merge(self, other):
+        """
+        Combine with the reservoir of another stream, as though the two
+        streams had been read as one.
+        """
+        seen = self.seen + other.seen
+        keep = min(self.size, len(self.items) + len(other.items))
+        if not other.seen or not self.seen:
+            mine = len(self.items) if other.seen == 0 else 0
+        else:
+            mine = self.random.hypergeometric(self.seen, other.seen, keep)
+        picks = [self.items[i] for i in self.random.permutation(
+            len(self.items))[:mine]]
+        picks.extend(other.items[i] for i in self.random.permutation(
+            len(other.items))[:keep - mine])
+        self.items = picks
+        self.seen = seen
+        self._w = self._next = None
+        if self.size and len(self.items) == self.size:
+            self._start()
+
+
+class ReservoirVisitor(Visitor):
+    """
+    Sample rows of a CSV file uniformly during a scan.
+
+    With a seed, every byte range of a parallel scan starts from the same
+    random state; scan in a single process for repeatable samples.
+
+    Result: {'headers': [...], 'rows': [row, ...] in file order,
+             'num_rows': rows scanned}
+    """
+
+    def __init__(self, size, seed=None):
+        self.seed = seed
+        self.reservoir = Reservoir(size, seed)
+        self.num_rows = 0
+
+    def start(self, headers):
+        super(ReservoirVisitor, self).start(headers)
+        if self.seed is None:
+            # Copies scanning other byte ranges must not share a state
+            self.reservoir.random = np.random.RandomState()
+
+    def visit(self, row):
+        self.reservoir.add((self.num_rows, row))
+        self.num_rows += 1
+
+    def merge(self, other):
+        other.reservoir.items = [(self.num_rows + number, row)
+                                 for number, row in other.reservoir.items]
+        self.reservoir.merge(other.reservoir)
+        self.num_rows += other.num_rows
+
+    def result(self):
+        return {
+            'headers': self.headers,
+            'rows': [row for _, row in sorted(self.reservoir.items)],
+            'num_rows': self.num_rows,
+        }
@@ -0,0 +1,438 @@
+"""
+Single pass CSV scanning.
+
+Analyses of a CSV file are written as visitors. ``scan_csv()`` reads the
+file once and hands every row to every visitor, so profiling a new survey
+file with several analyses costs one pass over the data instead of one per
+analysis.
+
+The pass can be split over byte ranges of the file and run in a process
+pool. Each worker runs fresh copies of the visitors over its range, and the
+partial visitors are merged back together, in file order, at the end.
+Splitting on byte ranges assumes records do not contain embedded newlines,
+so only use ``processes > 1`` on files where that holds. Compressed files
+(see ``cr.db.sources``) cannot be split and are always scanned in one
+process.
+"""
+from collections import defaultdict
+import copy
+import csv
+import multiprocessing
+import os
+
+from cr.db.sources import is_compressed, open_source
+
+
+def fill_blank_headers(headers):
+    """
+    Multiple response columns have no header: give them the header of the
+    column before. Modifies and returns headers.
+    """
+    last_header = None
+    for i, header in enumerate(headers):
+        if header:
+            last_header = header
+        else:
+            headers[i] = last_header
+    return headers
+
+
+class Visitor(object):
+    """
+    Base class for scan analyses.
+
+    Subclasses must be picklable, and merge() must combine the partial
+    result of the *following* byte range of the file into self.
+
+    A visitor that needs the file row numbers sets needs_row_offset; it is
+    then given the number of data rows before its byte range as row_offset
+    (which costs a count of the lines of the file before the pass).
+    """
+
+    needs_row_offset = False
+    row_offset = 0
+
+    def start(self, headers):
+        """Called once, before any rows, with the header row"""
+        self.headers = headers
+
+    def visit(self, row):
+        """Called with each row of the file, as a list of strings"""
+        raise NotImplementedError()
+
+    def merge(self, other):
+        raise NotImplementedError()
+
+    def result(self):
+        raise NotImplementedError()
+
+
+class RowShapeVisitor(Visitor):
+    """
+    Verify row size and header consistency.
+    Optionally pick some specific rows by (1 based) index for inspection.
+    """
+
+    def __init__(self, row_indexes=()):
+        self.row_indexes = sorted(set(int(i) for i in row_indexes))
+        self.wanted = frozenset(self.row_indexes)
+        self.needs_row_offset = bool(self.row_indexes)
+        self.rows = {}          # {row index: row}, of the wanted rows only
+        self.shortest_row = None
+        self.longest_row = None
+        self.num_rows = 0
+
+    def visit(self, row):
+        if self.shortest_row is None or len(row) < self.shortest_row:
+            self.shortest_row = len(row)
+        if self.longest_row is None or len(row) > self.longest_row:
+            self.longest_row = len(row)
+        self.num_rows += 1
+        if self.row_offset + self.num_rows in self.wanted:
+            self.rows[self.row_offset + self.num_rows] = row
+
+    def merge(self, other):
+        if other.num_rows == 0:
+            return
+        if self.num_rows == 0:
+            self.shortest_row = other.shortest_row
+            self.longest_row = other.longest_row
+        else:
+            self.shortest_row = min(self.shortest_row, other.shortest_row)
+            self.longest_row = max(self.longest_row, other.longest_row)
+        self.rows.update(other.rows)
+        self.num_rows += other.num_rows
+
+    def result(self):
+        return {
+            'headers_are_unique': (sorted(self.headers) ==
+                                   sorted(set(self.headers))),
+            'shortest_row': self.shortest_row,
+            'longest_row': self.longest_row,
+            'num_rows': self.num_rows,
+            'specific_rows': [self.rows[i] for i in self.row_indexes
+                              if i in self.rows],
+        }
+
+
+class ValueCountVisitor(Visitor):
+    """
+    Count up unique values per header.
+    Result: {header: {col_value: count}}
+    """
+
+    def start(self, headers):
+        super(ValueCountVisitor, self).start(headers)
+        self.counts = defaultdict(lambda: defaultdict(int))
+
+    def visit(self, row):
+        counts = self.counts
+        for i, header in enumerate(self.headers):
+            counts[header][row[i]] += 1
+
+    def merge(self, other):
+        for header, other_counts in other.counts.iteritems():
+            counts = self.counts[header]
+            for value, count in other_counts.iteritems():
+                counts[value] += count
+
+    def result(self):
+        return self.counts
+
+    # defaultdict(lambda) cannot be pickled, so ship plain dicts
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if 'counts' in state:
+            state['counts'] = dict((k, dict(v))
+                                   for k, v in self.counts.iteritems())
+        return state
+
+    def __setstate__(self, state):
+        counts = state.pop('counts', None)
+        self.__dict__.update(state)
+        if counts is not None:
+            self.counts = defaultdict(lambda: defaultdict(int))
+            for header, values in counts.iteritems():
+                self.counts[header].update(values)
+
+
+class SetItemVisitor(Visitor):
+    """
+    Discover the items of semicolon separated multiple choice columns.
+
+    headers:
+        Headers to collect items for. If None, collect items for every
+        column that has at least one value containing the separator. The
+        distinct values of the other columns are kept until then, so items
+        only ever chosen alone are found too.
+
+    Result: {header: set of items}
+    """
+
+    def __init__(self, headers=None, separator=';'):
+        self.wanted = headers
+        self.separator = separator
+        self.items = {}
+        self.singles = {}       # {header: values}, of the columns not
+                                # known to be multiple choice yet
+
+    def start(self, headers):
+        super(SetItemVisitor, self).start(headers)
+        if self.wanted is None:
+            self.indexes = range(len(headers))
+        else:
+            self.indexes = [headers.index(h) for h in self.wanted]
+            for header in self.wanted:
+                self.items[header] = set()
+
+    def visit(self, row):
+        separator = self.separator
+        for i in self.indexes:
+            value = row[i]
+            header = self.headers[i]
+            items = self.items.get(header)
+            if items is None:
+                if separator not in value:
+                    self.singles.setdefault(header, set()).add(value.strip())
+                    continue
+                items = self.items[header] = self.singles.pop(header, set())
+            items.update(item.strip() for item in value.split(separator))
+
+    def merge(self, other):
+        for header, items in other.items.iteritems():
+            if header not in self.items:
+                self.items[header] = self.singles.pop(header, set())
+            self.items[header].update(items)
+        for header, values in other.singles.iteritems():
+            if header in self.items:
+                self.items[header].update(values)
+            else:
+                self.singles.setdefault(header, set()).update(values)
+
+    def result(self):
+        return self.items
+
+
+# BSON sizes of fixed width values, by Python type
+_BSON_VALUE_SIZES = {
+    type(None): 0,
+    bool: 1,
+    float: 8,
+}
+
+
+def bson_value_size(value):
+    """Return the encoded size of a BSON value, excluding type and key."""
+    size = _BSON_VALUE_SIZES.get(type(value))
+    if size is not None:
+        return size
+    if isinstance(value, (int, long)):
+        return 4 if -2**31 <= value < 2**31 else 8
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    if isinstance(value, str):
+        # int32 length, bytes, trailing NUL
+        return 4 + len(value) + 1
+    raise TypeError("No BSON size for {!r}".format(value))
+
+
+def bson_array_overhead(length):
+    """
+    Return the encoded size of a BSON array of length items, not counting
+    the item values themselves: the document length and terminator, plus a
+    type byte and a "0", "1", ... key for every item.
+    """
+    size = 4 + 1
+    digits = 1
+    bound = 10
+    remaining = length
+    start = 0
+    while remaining > 0:
+        count = min(remaining, bound - start)
+        # type byte + key digits + NUL
+        size += count * (1 + digits + 1)
+        remaining -= count
+        start = bound
+        bound *= 10
+        digits += 1
+    return size
+
+
+class EncodedSizeVisitor(Visitor):
+    """
+    Estimate, without building it, the size of the single BSON document
+    holding the whole CSV file, as load_dataset_to_dict() builds it without
+    dictionary encoding.
+    Converts every cell with the column rules and adds up the encoded value
+    sizes per column.
+
+    Result: {'total': bytes, 'columns': {header: bytes}, 'num_rows': rows}
+    """
+
+    def __init__(self, column_rules=None):
+        self.column_rules = column_rules
+        self.value_sizes = None
+        self.num_rows = 0
+
+    def start(self, headers):
+        from cr.db.rules import get_converter_funcs
+
+        headers = fill_blank_headers(list(headers))
+        super(EncodedSizeVisitor, self).start(headers)
+        self.converter_funcs = get_converter_funcs(
+            headers, column_rules=self.column_rules)
+        if self.value_sizes is None:
+            self.value_sizes = [0] * len(headers)
+
+    def visit(self, row):
+        value_sizes = self.value_sizes
+        converter_funcs = self.converter_funcs
+        for i, data in enumerate(row):
+            value_sizes[i] += bson_value_size(converter_funcs[i](data))
+        self.num_rows += 1
+
+    def merge(self, other):
+        for i, size in enumerate(other.value_sizes):
+            self.value_sizes[i] += size
+        self.num_rows += other.num_rows
+
+    def column_sizes(self):
+        """Return the encoded size of each column array, in header order"""
+        overhead = bson_array_overhead(self.num_rows)
+        return [overhead + size for size in self.value_sizes]
+
+    def result(self):
+        column_sizes = self.column_sizes()
+        headers_size = bson_array_overhead(len(self.headers)) + sum(
+            bson_value_size(header) for header in self.headers)
+        columns_size = bson_array_overhead(len(column_sizes)) + sum(
+            column_sizes)
+        # Document: length, 'headers' and 'columns' elements, terminator.
+        # The _id Mongo adds on insert is an ObjectId (12 bytes) under "_id".
+        total = (4 + (1 + len('headers') + 1 + headers_size) +
+                 (1 + len('columns') + 1 + columns_size) +
+                 (1 + len('_id') + 1 + 12) + 1)
+        columns = {}
+        for header, size in zip(self.headers, column_sizes):
+            columns[header] = columns.get(header, 0) + size
+        return {
+            'total': total,
+            'columns': columns,
+            'num_rows': self.num_rows,
+        }
+
+    def __getstate__(self):
+        # Converter funcs are re-resolved from the rules in start()
+        state = self.__dict__.copy()
+        state.pop('converter_funcs', None)
+        return state
+
+
+def _data_start(csv_filename):
+    """Return (headers, byte offset of the first data row)"""
+    with open(csv_filename, 'rb') as f:
+        header_line = f.readline()
+        headers = csv.reader([header_line]).next()
+        return headers, f.tell()
+
+
+def split_byte_ranges(csv_filename, start, parts):
+    """
+    Split the file from byte offset start to the end into at most parts
+    ranges that each begin at the start of a line.
+    Return a list of (start, stop) offsets.
+    """
+    size = os.path.getsize(csv_filename)
+    bounds = [start]
+    with open(csv_filename, 'rb') as f:
+        for k in range(1, parts):
+            f.seek(max(start + (size - start) * k // parts, bounds[-1]))
+            f.readline()
+            offset = f.tell()
+            if bounds[-1] < offset < size:
+                bounds.append(offset)
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+
+def _iter_lines(f, stop):
+    while f.tell() < stop:
+        line = f.readline()
+        if not line:
+            break
+        yield line
+
+
+def _count_lines(args):
+    csv_filename, start, stop = args
+    lines = 0
+    with open(csv_filename, 'rb') as f:
+        f.seek(start)
+        while start < stop:
+            block = f.read(min(stop - start, 2**20))
+            if not block:
+                break
+            lines += block.count('\n')
+            start += len(block)
+    return lines
+
+
+def _scan_range(args):
+    csv_filename, start, stop, headers, row_offset, visitors = args
+    for visitor in visitors:
+        if visitor.needs_row_offset:
+            visitor.row_offset = row_offset
+        visitor.start(headers)
+    visits = [visitor.visit for visitor in visitors]
+    with open(csv_filename, 'rb') as f:
+        f.seek(start)
+        for row in csv.reader(_iter_lines(f, stop)):
+            for visit in visits:
+                visit(row)
+    return visitors
+
+
+def scan_csv(csv_filename, visitors, processes=1):
+    """
+    Run all of the visitors over the rows of a CSV file with headers, in a
+    single pass. With processes > 1, split the pass over byte ranges of the
+    file and merge the partial results.
+    Return the list of visitors, ready for their result() calls.
+    """
+    if processes <= 1 or is_compressed(csv_filename):
+        with open_source(csv_filename) as f:
+            csv_reader = csv.reader(f)
+            headers = csv_reader.next()
+            for visitor in visitors:
+                visitor.start(headers)
+            visits = [visitor.visit for visitor in visitors]
+            for row in csv_reader:
+                for visit in visits:
+                    visit(row)
+        return visitors
+
+    headers, start = _data_start(csv_filename)
+    ranges = split_byte_ranges(csv_filename, start, processes)
+    pool = multiprocessing.Pool(processes)
+    try:
+        row_offsets = [0] * len(ranges)
+        if any(visitor.needs_row_offset for visitor in visitors):
+            # One data row per line, as for the byte ranges themselves
+            lines = pool.map(_count_lines, [(csv_filename,) + bounds
+                                            for bounds in ranges[:-1]])
+            for k, count in enumerate(lines):
+                row_offsets[k + 1] = row_offsets[k] + count
+        tasks = [(csv_filename, range_start, range_stop, headers,
+                  row_offset, copy.deepcopy(visitors))
+                 for (range_start, range_stop), row_offset
+                 in zip(ranges, row_offsets)]
+        partials = pool.map(_scan_range, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    merged = partials[0]
+    for partial in partials[1:]:
+        for visitor, other in zip(merged, partial):
+            visitor.merge(other)
+    return merged
@@ -0,0 +1,161 @@
+"""
+Mergeable quantile sketches for numeric columns.
+
+``QuantileSketch`` is a relative error sketch (the DDSketch scheme): values
+are counted in logarithmic buckets whose bounds grow by a factor
+``gamma = (1 + alpha) / (1 - alpha)``. Any quantile it returns is within a
+relative error of ``alpha`` of the true value at that rank, e.g. within
+1% with the default alpha = 0.01: a median salary of 50000 comes back
+between 49500 and 50500. Zero and negative values are counted separately
+and have the same bound.
+
+Sketches with the same alpha merge exactly by adding bucket counts, so
+sketches of separate chunks, cube cells or datasets combine into the sketch
+of their union. Memory grows with the log of the value range, not with the
+number of values: a column of salaries from 1 to 10 million needs under 900
+buckets at 1%.
+"""
+import math
+
+from bson.binary import Binary
+import numpy as np
+
+DEFAULT_ALPHA = 0.01
+
+
+class QuantileSketch(object):
+
+    def __init__(self, alpha=DEFAULT_ALPHA):
+        if not 0 < alpha < 1:
+            raise ValueError("alpha must be between 0 and 1")
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self._log_gamma = math.log(self.gamma)
+        # {bucket key: count} of positive values and of negated negatives
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def _keys(self, values):
+        return np.ceil(np.log(values) / self._log_gamma).astype(np.int64)
+
+    @staticmethod
+    def _add_keys(store, keys):
+        unique, counts = np.unique(keys, return_counts=True)
+        for key, count in zip(unique.tolist(), counts.tolist()):
+            store[key] = store.get(key, 0) + count
+
+    def add(self, values):
+        """Add an array of values. NaNs are ignored."""
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return
+        positive = values[values > 0]
+        negative = values[values < 0]
+        self._add_keys(self.positive, self._keys(positive))
+        self._add_keys(self.negative, self._keys(-negative))
+        self.zero_count += len(values) - len(positive) - len(negative)
+        self._update_range(len(values), values.min(), values.max())
+
+    def _update_range(self, count, low, high):
+        self.count += count
+        low, high = float(low), float(high)
+        if self.min is None or low < self.min:
+            self.min = low
+        if self.max is None or high > self.max:
+            self.max = high
+
+    def merge(self, other):
+        """Add the counts of another sketch with the same alpha"""
+        if other.alpha != self.alpha:
+            raise ValueError("Cannot merge sketches with different alpha")
+        if not other.count:
+            return self
+        for store, other_store in ((self.positive, other.positive),
+                                   (self.negative, other.negative)):
+            for key, count in other_store.iteritems():
+                store[key] = store.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self._update_range(other.count, other.min, other.max)
+        return self
+
+    def _value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantile(self, q):
+        """
+        Return the value at quantile q (0 <= q <= 1), within a relative
+        error of alpha, or None if the sketch is empty.
+        """
+        if not 0 <= q <= 1:
+            raise ValueError("q must be between 0 and 1")
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        value = None
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                value = -self._value(key)
+                break
+        else:
+            seen += self.zero_count
+            if seen > rank:
+                value = 0.0
+            else:
+                for key in sorted(self.positive):
+                    seen += self.positive[key]
+                    if seen > rank:
+                        value = self._value(key)
+                        break
+                else:
+                    value = self.max
+        return min(max(value, self.min), self.max)
+
+    def quantiles(self, qs):
+        return [self.quantile(q) for q in qs]
+
+    def to_document(self):
+        """Return the sketch as a dictionary ready to be stored"""
+        document = {
+            'alpha': self.alpha,
+            'count': self.count,
+            'zero_count': self.zero_count,
+            'min': self.min,
+            'max': self.max,
+        }
+        for name, store in (('positive', self.positive),
+                            ('negative', self.negative)):
+            keys = sorted(store)
+            document[name] = {
+                'keys': Binary(np.array(keys, dtype='<i4').tobytes()),
+                'counts': Binary(np.array([store[key] for key in keys],
+                                          dtype='<i8').tobytes()),
+            }
+        return document
+
+    @classmethod
+    def from_document(cls, document):
+        sketch = cls(document['alpha'])
+        sketch.count = document['count']
+        sketch.zero_count = document['zero_count']
+        sketch.min = document['min']
+        sketch.max = document['max']
+        for name in ('positive', 'negative'):
+            keys = np.frombuffer(document[name]['keys'], dtype='<i4')
+            counts = np.frombuffer(document[name]['counts'], dtype='<i8')
+            setattr(sketch, name, dict(zip(keys.tolist(), counts.tolist())))
+        return sketch
+
+
+def merge_sketches(sketches, alpha=DEFAULT_ALPHA):
+    """Return a new sketch of the union of the given sketches"""
+    result = QuantileSketch(alpha)
+    for sketch in sketches:
+        result.merge(sketch)
+    return result
@@ -0,0 +1,227 @@
+"""
+Opening of plain and compressed input files.
+
+The loaders and the scans read their input through ``open_source()``, which
+decompresses ``.gz``, ``.bz2`` and ``.zip`` files on the fly as they are
+read, so survey dumps never need to be extracted to disk first. A zip
+archive may hold several files; ``source_members()`` lists them and each
+is opened by name.
+"""
+import bz2
+import gzip
+import os
+import zipfile
+
+COMPRESSED_EXTENSIONS = ('.gz', '.bz2', '.zip')
+
+# Bytes read at a time from streams that need newline translation
+_BLOCK_SIZE = 2**16
+
+
+def is_compressed(filename):
+    return os.path.splitext(filename)[1].lower() in COMPRESSED_EXTENSIONS
+
+
+def source_members(filename):
+    """
+    Return the names of the files in a zip archive, skipping directories
+    and Mac resource forks, or [None] for any other file.
+    """
+    if not filename.lower().endswith('.zip'):
+        return [None]
+    with zipfile.ZipFile(filename) as archive:
+        return [info.filename for info in archive.infolist()
+                if not info.filename.endswith('/') and
+                not info.filename.startswith('__MACOSX/')]
+
+
+def source_name(filename, member=None):
+    """Return the name of the data file, without compression extension"""
+    if member is not None:
+        return os.path.basename(member)
+    name = os.path.basename(filename)
+    root, ext = os.path.splitext(name)
+    if ext.lower() in COMPRESSED_EXTENSIONS:
+        return root
+    return name
+
+
+def source_path(filename, member=None):
+    """
+    Return the absolute path of the data file, with a zip member's name
+    as if the archive were a directory. Tells apart files of the same
+    name in different places, where source_name() does not.
+    """
+    path = os.path.abspath(filename)
+    if member is not None:
+        return os.path.join(path, member)
+    return path
+
+
+class _ZipSource(object):
+    """A zip member that closes its archive along with itself"""
+
+    def __init__(self, archive, member):
+        self.archive = archive
+        self.stream = archive.open(member, 'rU')
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def __iter__(self):
+        return iter(self.stream)
+
+    def close(self):
+        self.stream.close()
+        self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _UniversalNewlines(object):
+    """
+    Read a binary stream with '\r\n' and '\r' line endings turned into
+    '\n', as files opened with mode 'rU' are. For streams that do not
+    support 'rU' themselves.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = ''
+        self.pos = 0
+        # The last block ended in '\r': drop a '\n' starting the next one
+        self.after_cr = False
+
+    def _fill(self):
+        block = self.stream.read(_BLOCK_SIZE)
+        if not block:
+            return False
+        if self.after_cr and block.startswith('\n'):
+            block = block[1:]
+        self.after_cr = block.endswith('\r')
+        self.buffer = self.buffer[self.pos:] + block.replace(
+            '\r\n', '\n').replace('\r', '\n')
+        self.pos = 0
+        return True
+
+    def readline(self):
+        end = self.buffer.find('\n', self.pos)
+        while end < 0:
+            searched = len(self.buffer) - self.pos
+            if not self._fill():
+                break
+            end = self.buffer.find('\n', searched)
+        stop = len(self.buffer) if end < 0 else end + 1
+        line = self.buffer[self.pos:stop]
+        self.pos = stop
+        return line
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.pos < size:
+            if not self._fill():
+                break
+        stop = len(self.buffer) if size < 0 else self.pos + size
+        data = self.buffer[self.pos:stop]
+        self.pos += len(data)
+        return data
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_source(filename, member=None):
+    """
+    Open a data file for reading text, decompressing it as it is read if
+    it is compressed.
+    member:
+        Name of the file to read from a zip archive. May be left out for
+        archives of a single file.
+    """
+    lower = filename.lower()
+    if lower.endswith('.gz'):
+        # GzipFile has no 'rU' mode
+        return _UniversalNewlines(gzip.open(filename, 'rb'))
+    if lower.endswith('.bz2'):
+        return bz2.BZ2File(filename, 'rU')
+    if lower.endswith('.zip'):
+        archive = zipfile.ZipFile(filename)
+        if member is None:
+            members = source_members(filename)
+            if len(members) != 1:
+                archive.close()
+                raise ValueError(
+                    "{} holds {} files, pick a member: {}".format(
+                        filename, len(members), ', '.join(members)))
+            member = members[0]
+        return _ZipSource(archive, member)
+    return open(filename, 'rU')
+
+
+def skip_ahead(f, offset):
+    """
+    Skip the lines before a LineCounter offset, on a stream that cannot
+    seek, by reading through them.
+    """
+    while offset > 0:
+        line = f.readline()
+        if not line:
+            break
+        offset -= len(line)
+
+
+class LineCounter(object):
+    """
+    Iterate over the lines of a stream, keeping track of the offset of the
+    next line. On plain files that is their tell() position, and skip_to()
+    seeks. On streams that cannot tell() their position, such as
+    decompressed ones, it is the number of characters read, and skip_to()
+    reads through the lines before the offset.
+    """
+
+    def __init__(self, f, offset=0):
+        self.f = f
+        self.seekable = isinstance(f, file)
+        self.read_offset = offset
+
+    @property
+    def offset(self):
+        if self.seekable:
+            return self.f.tell()
+        return self.read_offset
+
+    def skip_to(self, offset):
+        """Move on to the line at offset, after the current one"""
+        if self.seekable:
+            self.f.seek(offset)
+        else:
+            skip_ahead(self.f, offset - self.read_offset)
+            self.read_offset = offset
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.f.readline()
+        if not line:
+            raise StopIteration
+        self.read_offset += len(line)
+        return line
@@ -1,4 +1,8 @@
+import bson
 import pymongo
+from pymongo import monitoring
+
+from cr.db import cache, metrics
 
 class Settings(dict):
 
@@ -16,13 +20,52 @@ global_settings = Settings()
 global_client = None
 global_db = None
 
+
+class CommandMetrics(monitoring.CommandListener):
+    """
+    Count Mongo round trips, latency and bytes into cr.db.metrics, while
+    metrics are enabled.
+    """
+
+    def started(self, event):
+        if not metrics.is_enabled():
+            return
+        metrics.inc('cr_mongo_commands_total', command=event.command_name)
+        metrics.inc('cr_mongo_request_bytes_total',
+                    len(bson.BSON.encode(event.command)),
+                    command=event.command_name)
+
+    def succeeded(self, event):
+        if not metrics.is_enabled():
+            return
+        metrics.observe('cr_mongo_command_seconds',
+                        event.duration_micros / 1e6,
+                        command=event.command_name)
+        metrics.inc('cr_mongo_reply_bytes_total',
+                    len(bson.BSON.encode(event.reply)),
+                    command=event.command_name)
+
+    def failed(self, event):
+        if not metrics.is_enabled():
+            return
+        metrics.observe('cr_mongo_command_seconds',
+                        event.duration_micros / 1e6,
+                        command=event.command_name)
+        metrics.inc('cr_mongo_command_failures_total',
+                    command=event.command_name)
+
+
 def connect(settings=None):
     global global_client
 
     if settings is None:
         settings = global_settings
 
-    global_client = pymongo.MongoClient(settings.url)
+    metrics.configure(settings)
+    cache.configure(settings)
+    # Always listening: metrics may be enabled or disabled after connecting
+    global_client = pymongo.MongoClient(settings.url,
+                                        event_listeners=[CommandMetrics()])
     db_name = settings.url.split('/')[-1]
 
     global_db = global_client[db_name]
@@ -0,0 +1,52 @@
+"""
+User documents.
+
+Users are loaded from json with 'latitude' and 'longitude' strings.
+``prepare_user()`` adds a GeoJSON 'location' point from them, which the
+users 2dsphere index (see cr.db.indexes) covers. Lookups go through the
+unique email and username indexes.
+"""
+
+
+def user_location(user):
+    """
+    Return the user's GeoJSON point, or None if the user has no valid
+    latitude and longitude.
+    """
+    try:
+        latitude = float(user['latitude'])
+        longitude = float(user['longitude'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None
+    return {'type': 'Point', 'coordinates': [longitude, latitude]}
+
+
+def prepare_user(user):
+    """
+    Add the derived fields to a user document. Return the document. A
+    location already in the document is kept when none can be derived.
+    """
+    location = user_location(user)
+    if location is not None:
+        user['location'] = location
+    return user
+
+
+def find_user(db, login):
+    """Return the user whose username or email is login, or None"""
+    return db.users.find_one({'$or': [{'username': login},
+                                      {'email': login}]})
+
+
+def login_taken(db, username=None, email=None):
+    """Whether another user already has the username or email"""
+    clauses = []
+    if username:
+        clauses.append({'username': username})
+    if email:
+        clauses.append({'email': email})
+    if not clauses:
+        return False
+    return db.users.find_one({'$or': clauses}, {'_id': True}) is not None
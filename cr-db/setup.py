@@ -14,7 +14,7 @@ setup(
     author=u'Crunch.io',
     author_email='dev@crunch.io',
     license='Proprietary',
-    install_requires=['pymongo'],
+    install_requires=['numpy', 'pymongo'],
     tests_require=[],
     packages=find_packages(exclude=['ez_setup']),
     namespace_packages=['cr'],
@@ -23,6 +23,7 @@ setup(
     entry_points={
         'console_scripts': [
             'cr.load = cr.db.loader:load_data',
+            'cr.helper = cr.db.helper:main',
         ]
     }
 )
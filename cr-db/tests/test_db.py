@@ -5,24 +5,86 @@ hint: we use py.test.
 """
 from __future__ import print_function
 
-import itertools
+import bz2
+import csv
+import gzip
+import json
 import operator
 import os
 import textwrap
+import zipfile
 
+import bson
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
 import matplotlib
 matplotlib.use('agg')
 import matplotlib.pyplot as plt
 import numpy as np
+import pytest
 
-from cr.db.loader import load_data, load_dataset
+from cr.db import cache, helper, loader, metrics, proximity
+from cr.db.columnar import (
+    count_true,
+    decode_chunk,
+    encode_chunk,
+    popcount,
+)
+from cr.db.compression import CODECS
+from cr.db.dataset import DatasetWriter, get_column_types, open_dataset
+from cr.db.distances import (
+    MAX_DISTANCE_KM,
+    SummaryCache,
+    haversine,
+    histogram_edges,
+    pair_statistics,
+    pair_summary,
+    to_radians,
+)
+from cr.db.fanout import RangeAggregate, fan_out, iter_fan_out
+from cr.db.inference import resolve_schema, sample_csv
+from cr.db.indexes import ensure_indexes, winning_plan_indexes
+from cr.db.jobs import IngestJob, default_job_id
+from cr.db.loader import (
+    load_data,
+    load_dataset,
+    load_dataset_to_dict,
+    load_datasets,
+)
+from cr.db.planner import (
+    ColumnProfileVisitor,
+    MONGO_DOCUMENT_LIMIT,
+    plan_layout,
+    plan_storage,
+)
+from cr.db.moves import MoveWriter
+from cr.db.positions import PositionStore
+from cr.db.proximity import closest_pairs, iter_pairs_within
 from cr.db.rules import (
     BitmappedSetColumn,
+    CATEGORY_AGREEMENT,
     CATEGORY_FORMAL_EDUCATION,
     CATEGORY_GENDER,
+    DictionaryColumn,
+)
+from cr.db.sampling import (
+    Reservoir,
+    ReservoirVisitor,
+    allocate,
+    random_sample,
+    stratified_sample,
 )
+from cr.db.scan import (
+    EncodedSizeVisitor,
+    RowShapeVisitor,
+    SetItemVisitor,
+    ValueCountVisitor,
+    scan_csv,
+)
+from cr.db.sketches import QuantileSketch, merge_sketches
 from cr.db.store import global_settings as settings
-from cr.db.store import connect
+from cr.db.store import CommandMetrics, connect
+from cr.db.users import find_user, login_taken, prepare_user
 
 settings.update({"url": "mongodb://localhost:27017/test_crunch_fitness"})
 db = connect(settings)
@@ -52,11 +114,12 @@ def test_load_dataset():
 
     csv_filename = _here + '/data/S-O-1k.csv'
 
-    ds_id = load_dataset(csv_filename, db)
+    # Small chunks, to exercise multiple chunks per column
+    ds_id = load_dataset(csv_filename, db, chunk_rows=100)
 
-    dataset = db.datasets.find({'_id': ds_id})[0]
-    headers = dataset['headers']
-    columns = dataset['columns']
+    dataset = open_dataset(db, ds_id)
+    headers = dataset.headers
+    columns = [dataset.column(i) for i in range(len(headers))]
 
     # These assertions verify many of my assumptions about the nature of a
     # non-empty dataset.
@@ -75,22 +138,21 @@ def test_load_dataset():
 
     # Each column has the same number of rows
     assert all(len(column) == len(columns[0]) for column in columns)
+    assert dataset.num_rows == len(columns[0])
 
-    # Each item in a given column is of the same type, or None
-    for column in columns:
-        column_type = None
-        for item in column:
-            if item is not None:
-                column_type = type(item)
-                break
-        else:
-            # All None values - I guess that is Ok
-            # Go check the next column
-            continue
-        # Treat int and long as equivalent (not a problem on Python 3)
-        if issubclass(column_type, (int, long)):
-            column_type = (int, long)
-        assert all(isinstance(item, column_type) or item is None for item in column)
+    # Each column is a typed array with missing values masked, and the
+    # stored values round trip exactly
+    expected = load_dataset_to_dict(csv_filename)
+    for i, column in enumerate(columns):
+        assert isinstance(column, np.ma.MaskedArray)
+        assert column.dtype == dataset.dtype(i)
+        assert column.tolist() == expected['columns'][i]
+
+    # Mostly missing chunks are stored sparse, without a row per value
+    encodings = set(chunk['encoding'] for chunk in
+                    db.dataset_chunks.find({'dataset_id': ds_id},
+                                           {'encoding': True}))
+    assert encodings == set(['dense', 'sparse', 'null'])
 
     # the columns aren't terribly useful.  Modify load_dataset to load common responses as integers so we can
     #   do data manipulation.  For instance, you could change the gender column to male = 0 female = 1 (or something)
@@ -120,6 +182,790 @@ def test_bitmapped_set_column():
     assert column[13] == 'Apple; Cucumber; Pear'
 
 
+def test_vectorized_decode():
+    codes = np.ma.masked_array([3, 1, 7, 0, 2], mask=[0, 0, 0, 1, 0])
+    labels = CATEGORY_GENDER.decode(codes)
+    assert labels.tolist() == ['Non-Conforming', 'Female', None, None, 'Male']
+    assert labels.mask.tolist() == [False, False, True, True, False]
+    offset, table = CATEGORY_GENDER.label_table()
+    assert offset == 1 and table[2 - offset] == 'Male'
+
+    categorical = CATEGORY_AGREEMENT.decode([-2, 2, 0], categorical=True)
+    assert categorical.categories == [CATEGORY_AGREEMENT[code]
+                                      for code in range(-2, 3)]
+    assert categorical.codes.tolist() == [0, 4, 2]
+    assert CATEGORY_GENDER.decode(codes, True).codes.tolist() == [
+        2, 0, -1, -1, 1]
+
+    dictionary = DictionaryColumn(['a', 'b'])
+    assert dictionary.decode([2, 1]).tolist() == ['b', 'a']
+    dictionary.add('c')
+    assert dictionary.decode([3]).tolist() == ['c']
+
+    column = BitmappedSetColumn(['item{}'.format(i) for i in range(64)])
+    values = np.ma.masked_array(
+        np.array([1, 2**63 + 2**9 + 1, 0, 5], dtype='<u8'),
+        mask=[0, 0, 0, 1])
+    assert column.decode(values).tolist() == [
+        'item0', 'item0; item9; item63', '', None]
+    assert column.decode(values)[1] == column[values[1]]
+    matrix = column.item_matrix(values)
+    assert matrix.shape == (4, 64)
+    assert np.flatnonzero(matrix[1]).tolist() == [0, 9, 63]
+    assert not matrix[3].any()
+
+
+def test_encode_chunk_round_trip():
+    values = [1.5, None, 2.5, None, None, 4.0, None, None, None, 7.0]
+    dense = encode_chunk(values, '<f8', sparse_ratio=0.9)
+    assert dense['encoding'] == 'dense'
+    sparse = encode_chunk(values, '<f8', sparse_ratio=0.5)
+    assert sparse['encoding'] == 'sparse'
+    assert 'valid' not in sparse
+    for chunk in (dense, sparse):
+        array = decode_chunk(chunk)
+        assert array.tolist() == values
+        filled = array.filled(np.nan)
+        assert np.isnan(filled[1]) and filled[0] == 1.5
+
+    strings = ['a', None, 'b']
+    assert decode_chunk(encode_chunk(strings, 'O')).tolist() == strings
+    empty = encode_chunk([None] * 5, '<i8')
+    assert empty['encoding'] == 'null'
+    assert decode_chunk(empty).tolist() == [None] * 5
+
+
+def test_boolean_chunks_are_bit_packed():
+    values = [True, None, False, True] * 25 + [True]
+    chunk = encode_chunk(values, '|b1')
+    assert chunk['bits']
+    assert len(chunk['values']) == 13  # 101 rows, 8 per byte
+    assert decode_chunk(chunk).tolist() == values
+    assert count_true(chunk) == values.count(True)
+    assert popcount('\xff' * 9 + '\x01') == 73
+
+    sparse = encode_chunk([None] * 30 + [True, False, True], '|b1')
+    assert sparse['encoding'] == 'sparse'
+    assert count_true(sparse) == 2
+
+
+def test_dataset_count_true():
+    csv_filename = _here + '/data/S-O-1k.csv'
+    dataset = open_dataset(db, load_dataset(csv_filename, db, chunk_rows=100))
+    expected = load_dataset_to_dict(csv_filename)
+    boolean_columns = [i for i, header in enumerate(dataset.headers)
+                       if dataset.dtype(i) == np.bool_]
+    assert boolean_columns
+    for i in boolean_columns:
+        assert dataset.count_true(i) == expected['columns'][i].count(True)
+
+
+def test_compression_codecs_round_trip():
+    samples = [
+        ([1.5, None, 1.5, 1.5, float('nan'), 2.0] * 20, '<f8'),
+        ([3, 3, 3, None, 4, 4, 5] * 20, '|i1'),
+        ([True, True, None, False] * 20, '|b1'),
+        (['a', None, 'bb', 'bb'] * 20, 'O'),
+        ([None] * 90 + [1, 2, 3], '<i8'),
+    ]
+    for values, dtype in samples:
+        expected = decode_chunk(encode_chunk(values, dtype))
+        for codec in sorted(CODECS):
+            chunk = encode_chunk(values, dtype, codec=codec)
+            decoded = decode_chunk(chunk)
+            assert np.array_equal(np.ma.getmaskarray(decoded),
+                                  np.ma.getmaskarray(expected))
+            if dtype == 'O':
+                assert decoded.tolist() == expected.tolist()
+            else:
+                # Byte comparison, so NaNs compare equal
+                assert (decoded.filled(0).tobytes() ==
+                        expected.filled(0).tobytes())
+
+
+def test_load_dataset_with_codecs():
+    csv_filename = _here + '/data/S-O-1k.csv'
+    ds_id = load_dataset(csv_filename, db, chunk_rows=250, codecs='auto')
+    dataset = open_dataset(db, ds_id)
+    codecs = [meta['codec'] for meta in dataset.document['column_meta']]
+    assert set(codecs) - set([None]) <= set(CODECS)
+    assert any(codecs)
+    expected = load_dataset_to_dict(csv_filename)
+    for i in range(0, len(dataset.headers), 7):
+        assert dataset.column(i).tolist() == expected['columns'][i]
+    boolean = [i for i in range(len(dataset.headers))
+               if dataset.dtype(i) == np.bool_][0]
+    assert dataset.count_true(boolean) == expected['columns'][boolean].count(True)
+
+
+def test_zone_maps_skip_chunks():
+    csv_filename = _here + '/data/S-O-1k.csv'
+    expected = open_dataset(db, load_dataset(csv_filename, db,
+                                             chunk_rows=100))
+    salary = expected.column('SalaryAdjusted')
+    low, high = 100000, 150000
+
+    ds_id = load_dataset(csv_filename, db, chunk_rows=100,
+                         sort_by='SalaryAdjusted')
+    dataset = open_dataset(db, ds_id)
+    assert dataset.document['sorted_by'] == 'SalaryAdjusted'
+
+    zones = dataset.zone_maps('SalaryAdjusted')
+    assert len(zones) == dataset.num_chunks
+    assert all(zone['min'] <= zone['max'] for zone in zones
+               if zone['encoding'] != 'null')
+
+    # Sorting clusters the range into a few of the chunks
+    chunks = dataset.matching_chunks('SalaryAdjusted', low, high)
+    assert 0 < len(chunks) < dataset.num_chunks / 2
+
+    selected = dataset.filter_range('SalaryAdjusted', low, high,
+                                    columns=['YearsProgram'])
+    in_range = ((salary >= low) & (salary <= high)).filled(False)
+    assert sorted(selected['SalaryAdjusted'].tolist()) == sorted(
+        salary[in_range].tolist())
+    assert len(selected['YearsProgram']) == len(selected['rows'])
+    assert (dataset.column('SalaryAdjusted')[selected['rows']].tolist() ==
+            selected['SalaryAdjusted'].tolist())
+
+
+def test_load_dataset_cubes():
+    dimensions = ['Combined Gender', 'FormalEducation']
+    ds_id = load_dataset(_here + '/data/S-O-1k.csv', db, chunk_rows=100,
+                         cubes=[{'dimensions': dimensions,
+                                 'measures': ['SalaryAdjusted']}])
+    dataset = open_dataset(db, ds_id)
+    cube = dataset.cube(reversed(dimensions))
+    assert cube.rows().sum() == dataset.num_rows
+
+    gender = dataset.column('Combined Gender')
+    education = dataset.column('FormalEducation')
+    salary = dataset.column('SalaryAdjusted')
+    female = CATEGORY_GENDER('female')
+    labels = cube.labels('FormalEducation')
+    gender_cell = cube.codes('Combined Gender').index(female)
+    means = cube.mean('SalaryAdjusted')[gender_cell]
+    counts = cube.stat('SalaryAdjusted', 'count')[gender_cell]
+    for cell, code in enumerate(cube.codes('FormalEducation')):
+        if code is None:
+            continue
+        assert labels[cell] == CATEGORY_FORMAL_EDUCATION[code]
+        selected = ((gender == female) & (education == code)).filled(False)
+        values = salary[selected].compressed()
+        assert counts[cell] == len(values)
+        if len(values):
+            assert np.isclose(means[cell], values.mean())
+
+    # Summing over a dimension gives the one dimensional tables
+    by_gender = cube.rows(keep=['Combined Gender'])
+    assert by_gender[gender_cell] == (gender == female).filled(False).sum()
+    assert cube.null_count('SalaryAdjusted').sum() == (
+        np.ma.getmaskarray(salary).sum())
+    assert np.allclose(cube.std('SalaryAdjusted', keep=[])[()],
+                       salary.std())
+
+
+def test_quantile_sketch():
+    rng = np.random.RandomState(0)
+    values = np.concatenate([rng.lognormal(10, 1, 5000),
+                             -rng.lognormal(2, 1, 500), np.zeros(100)])
+    alpha = 0.01
+    whole = QuantileSketch(alpha)
+    whole.add(values)
+    parts = [QuantileSketch(alpha) for _ in range(4)]
+    for sketch, part in zip(parts, np.array_split(values, 4)):
+        sketch.add(part)
+    merged = merge_sketches(parts, alpha)
+    ordered = np.sort(values)
+    for q in (0, 0.01, 0.1, 0.25, 0.5, 0.9, 0.99, 1):
+        exact = ordered[int(q * (len(values) - 1))]
+        assert abs(whole.quantile(q) - exact) <= alpha * abs(exact) + 1e-9
+        assert merged.quantile(q) == whole.quantile(q)
+    stored = QuantileSketch.from_document(whole.to_document())
+    assert stored.quantiles([0.5, 0.9]) == whole.quantiles([0.5, 0.9])
+
+
+def test_dataset_quantiles():
+    ds_id = load_dataset(_here + '/data/S-O-1k.csv', db, chunk_rows=100,
+                         cubes=[(['Combined Gender'], ['SalaryAdjusted'])])
+    dataset = open_dataset(db, ds_id)
+    salary = dataset.column('SalaryAdjusted').compressed()
+    median = dataset.quantiles('SalaryAdjusted', [0.5])[0]
+    exact = np.sort(salary)[(len(salary) - 1) // 2]
+    assert abs(median - exact) <= 0.01 * exact
+
+    cube = dataset.cube(['Combined Gender'])
+    medians = cube.quantile('SalaryAdjusted', 0.5)
+    gender = dataset.column('Combined Gender')
+    female = CATEGORY_GENDER('female')
+    cell = cube.codes('Combined Gender').index(female)
+    values = np.sort(dataset.column('SalaryAdjusted')[
+        (gender == female).filled(False)].compressed())
+    exact = values[(len(values) - 1) // 2]
+    assert abs(medians[cell] - exact) <= 0.01 * exact
+    assert np.isclose(cube.quantile('SalaryAdjusted', 0.5, keep=[])[()],
+                      median)
+
+
+def test_fan_out():
+    csv_filename = _here + '/data/S-O-1k.csv'
+    ds_ids = [load_dataset(csv_filename, db, chunk_rows=250)
+              for _ in range(3)]
+    query = RangeAggregate('SalaryAdjusted', 50000, None,
+                           measure='SalaryAdjusted')
+    serial = fan_out(settings, ds_ids, query, processes=1)
+    assert serial['datasets'] == 3
+
+    salary = open_dataset(db, ds_ids[0]).column('SalaryAdjusted')
+    values = salary[(salary >= 50000).filled(False)]
+    assert serial['rows'] == serial['count'] == 3 * len(values)
+    assert np.isclose(serial['mean'], values.mean())
+    assert serial['min'] == values.min()
+
+    results = list(iter_fan_out(settings, ds_ids, query, processes=2))
+    assert sorted(dataset_id for dataset_id, _ in results) == sorted(ds_ids)
+    parallel = fan_out(settings, {'_id': {'$in': ds_ids}}, query,
+                       processes=2)
+    assert parallel == serial
+
+
+def test_sampling():
+    csv_filename = _here + '/data/S-O-1k.csv'
+    dataset = open_dataset(db, load_dataset(csv_filename, db, chunk_rows=100))
+    salary = dataset.column('SalaryAdjusted')
+
+    taken = dataset.take([998, 5, 5, 250], ['SalaryAdjusted'])
+    assert taken['rows'].tolist() == [5, 250, 998]
+    assert (taken['SalaryAdjusted'].tolist() ==
+            salary[[5, 250, 998]].tolist())
+    with pytest.raises(IndexError):
+        dataset.take([999])
+
+    sample = random_sample(dataset, 50, ['SalaryAdjusted'], seed=1)
+    assert len(set(sample['rows'].tolist())) == 50
+    assert (sample['SalaryAdjusted'].tolist() ==
+            salary[sample['rows']].tolist())
+    assert (random_sample(dataset, 50, seed=1)['rows'].tolist() ==
+            sample['rows'].tolist())
+    sample = random_sample(dataset, 50, seed=2, max_chunks=2)
+    assert len(sample['rows']) == 50
+    assert len(set((sample['rows'] // 100).tolist())) == 2
+    assert len(random_sample(dataset, 5000)['rows']) == 999
+
+    gender = dataset.column('Combined Gender')
+    sample = stratified_sample(dataset, 'Combined Gender', per_stratum=3,
+                               columns=['SalaryAdjusted'], seed=3)
+    assert sorted(sample['strata']) == sorted(set(gender.compressed()))
+    for code, (stratum_size, count) in sample['strata'].items():
+        assert stratum_size == (gender == code).sum()
+        assert (sample['Combined Gender'] == code).sum() == count
+        assert count == min(3, stratum_size)
+    sample = stratified_sample(dataset, 'Combined Gender', size=100, seed=3)
+    assert len(sample['rows']) == 100
+    assert allocate([10, 30, 60], 11).tolist() == [1, 3, 7]
+
+    reservoir = Reservoir(10, seed=4)
+    for start in range(0, 1000, 7):
+        reservoir.extend(range(start, min(start + 7, 1000)))
+    assert reservoir.seen == 1000
+    assert len(set(reservoir.items)) == 10
+    other = Reservoir(10, seed=5)
+    other.extend(range(1000, 1003))
+    reservoir.merge(other)
+    assert reservoir.seen == 1003 and len(set(reservoir.items)) == 10
+
+    serial, = scan_csv(csv_filename, [ReservoirVisitor(20, seed=6)])
+    parallel, = scan_csv(csv_filename, [ReservoirVisitor(20)], processes=3)
+    for visitor in (serial, parallel):
+        result = visitor.result()
+        assert result['num_rows'] == 999
+        assert len(result['rows']) == 20
+        assert all(len(row) == 415 for row in result['rows'])
+
+
+def test_column_cache():
+    column_cache = cache.ColumnCache(budget=3 * 80)
+    arrays = [np.zeros(10) for _ in range(4)]
+    for i, array in enumerate(arrays[:3]):
+        column_cache.put(i, array)
+    assert column_cache.get(0) is arrays[0]
+    column_cache.put(3, arrays[3])
+    # 1 was the least recently used
+    assert column_cache.get(1) is None
+    assert column_cache.get(0) is arrays[0]
+    assert column_cache.stats() == {'entries': 3, 'bytes': 240,
+                                    'budget': 240, 'hits': 2, 'misses': 1,
+                                    'evictions': 1}
+
+    # Strings count with their contents, not just their pointers
+    strings = np.array(['x' * 100 + str(i) for i in range(10)], dtype=object)
+    assert cache.array_bytes(strings) > 10 * 100
+    column_cache = cache.ColumnCache(budget=2 * cache.array_bytes(strings))
+    column_cache.put('a', strings)
+    column_cache.put('b', strings.copy())
+    column_cache.put('c', strings.copy())
+    assert column_cache.get('a') is None
+    assert column_cache.stats()['evictions'] == 1
+
+    cache.clear()
+    ds_id = load_dataset(_here + '/data/S-O-1k.csv', db)
+    dataset = open_dataset(db, ds_id)
+    salary = dataset.column('SalaryAdjusted')
+    # The cached arrays are shared
+    assert open_dataset(db, ds_id).column('SalaryAdjusted').mask is \
+        salary.mask
+    with pytest.raises(ValueError):
+        salary[0] = 0
+    with pytest.raises(ValueError):
+        salary[0] = np.ma.masked
+    # A new version of the dataset does not see the old columns
+    db.datasets.update_one({'_id': ds_id}, {'$inc': {'version': 1}})
+    assert open_dataset(db, ds_id).column('SalaryAdjusted').mask is not \
+        salary.mask
+    cache.invalidate(ds_id)
+    assert cache.stats()['entries'] == 0
+
+
+def test_resume_interrupted_load(monkeypatch, tmpdir):
+    # A file name of its own, so replace=True only replaces our datasets
+    csv_filename = str(tmpdir.join('resume.csv'))
+    with open(_here + '/data/S-O-1k.csv', 'rb') as f:
+        tmpdir.join('resume.csv').write(f.read(), mode='wb')
+    expected = open_dataset(db, load_dataset(csv_filename, db,
+                                             chunk_rows=100))
+    # Read now, replace=True below deletes the dataset
+    expected_chunks = [[array.tolist() for array in arrays]
+                       for _, arrays in expected.iter_row_chunks()]
+    salary_count = expected.column('SalaryAdjusted').count()
+    job_id = default_job_id(csv_filename)
+    db.ingest_jobs.delete_many({})
+    write_chunk = DatasetWriter.write_chunk
+    calls = []
+
+    def failing_write_chunk(self, columns):
+        write_chunk(self, columns)
+        calls.append(1)
+        if len(calls) == 4:
+            # Dies after storing a chunk, before its checkpoint
+            raise IOError("Simulated crash")
+
+    monkeypatch.setattr(DatasetWriter, 'write_chunk', failing_write_chunk)
+    with pytest.raises(IOError):
+        load_dataset(csv_filename, db, chunk_rows=100, job_id=job_id,
+                     cubes=[(['Combined Gender'], ['SalaryAdjusted'])])
+    job = db.ingest_jobs.find_one({'_id': job_id})
+    assert job['status'] == 'running'
+    assert job['num_rows'] == 300
+    # Only counters in the job, the cube and sketches are kept apart
+    assert sorted(job['writer']) == ['codecs', 'dataset_id', 'num_chunks',
+                                     'num_rows']
+    monkeypatch.undo()
+
+    checkpoint = IngestJob.checkpoint
+
+    def failing_checkpoint(self, **fields):
+        if fields.get('num_rows') == 500:
+            # Dies after storing a chunk and the writer state
+            raise IOError("Simulated crash")
+        checkpoint(self, **fields)
+
+    monkeypatch.setattr(IngestJob, 'checkpoint', failing_checkpoint)
+    with pytest.raises(IOError):
+        load_dataset(csv_filename, db, chunk_rows=100, job_id=job_id,
+                     cubes=[(['Combined Gender'], ['SalaryAdjusted'])])
+    assert db.ingest_jobs.find_one({'_id': job_id})['num_rows'] == 400
+    monkeypatch.undo()
+
+    ds_id = load_dataset(csv_filename, db, chunk_rows=100, job_id=job_id,
+                         cubes=[(['Combined Gender'], ['SalaryAdjusted'])],
+                         replace=True)
+    assert ds_id == job['writer']['dataset_id']
+    dataset = open_dataset(db, ds_id)
+    assert db.dataset_chunks.find({'dataset_id': ds_id}).count() == (
+        dataset.num_chunks * len(dataset.headers))
+    assert [[array.tolist() for array in arrays]
+            for _, arrays in dataset.iter_row_chunks()] == expected_chunks
+    cube = dataset.cube(['Combined Gender'])
+    assert cube.rows().sum() == dataset.num_rows
+    assert cube.stat('SalaryAdjusted', 'count').sum() == salary_count
+    assert db.ingest_state.find({'dataset_id': ds_id}).count() == 0
+    # The replaced datasets are gone, the finished job is not run again
+    assert [d['_id'] for d in db.datasets.find({'name': dataset.document[
+        'name']})] == [ds_id]
+    assert load_dataset(csv_filename, db, job_id=job_id) == ds_id
+    # A file of the same name elsewhere is another source
+    other = tmpdir.mkdir('other').join('resume.csv')
+    other.write(tmpdir.join('resume.csv').read(mode='rb'), mode='wb')
+    other_id = load_dataset(str(other), db, chunk_rows=100, replace=True)
+    assert db.datasets.find_one({'_id': ds_id}) is not None
+    assert db.datasets.find_one({'_id': other_id})['source'] == str(other)
+
+
+def test_load_data_swaps_in_new_documents():
+    db.users.delete_many({})
+    db.users.insert_one({'_id': 'stale'})
+    db.ingest_jobs.delete_many({})
+    load_data(_here + '/data/users.json', settings=settings, clear=True,
+              job_id='users')
+    assert db.users.count() == 10
+    assert db.users.find_one({'_id': 'stale'}) is None
+    assert db.ingest_jobs.find_one({'_id': 'users'})['num_rows'] == 10
+    assert not [name for name in db.collection_names()
+                if name.startswith('users_loading_')]
+
+
+def test_resume_load_data_without_ids(monkeypatch, tmpdir):
+    filename = str(tmpdir.join('things.json'))
+    tmpdir.join('things.json').write(json.dumps([{'n': n} for n in range(5)]))
+    db.things.delete_many({})
+    db.ingest_jobs.delete_many({})
+    monkeypatch.setattr(loader, 'BATCH_SIZE', 2)
+    checkpoint = IngestJob.checkpoint
+
+    def failing_checkpoint(self, **fields):
+        if fields.get('num_rows') == 4:
+            # Dies after writing a batch, before its checkpoint
+            raise IOError("Simulated crash")
+        checkpoint(self, **fields)
+
+    monkeypatch.setattr(IngestJob, 'checkpoint', failing_checkpoint)
+    with pytest.raises(IOError):
+        load_data(filename, settings=settings, job_id='things')
+    assert db.things.count() == 4
+    monkeypatch.setattr(IngestJob, 'checkpoint', checkpoint)
+    load_data(filename, settings=settings, job_id='things')
+    assert sorted(thing['n'] for thing in db.things.find()) == range(5)
+    assert db.things.find_one({'n': 3})['_id'] == 'things:3'
+
+
+def test_user_indexes():
+    load_data(_here + '/data/users.json', settings=settings, clear=True)
+    index_names = set(db.users.index_information())
+    assert set(['email_unique', 'username_unique',
+                'location_2dsphere']) <= index_names
+    # Idempotent
+    assert ensure_indexes(db)['users'] == [
+        'email_unique', 'username_unique', 'location_2dsphere']
+    assert set(db.users.index_information()) == index_names
+    assert 'expires_ttl' in db.sessions.index_information()
+
+    admin = find_user(db, 'admin@crunch.io')
+    assert admin['location'] == {'type': 'Point',
+                                 'coordinates': [-42.081022, 43.175753]}
+    assert login_taken(db, email='admin@crunch.io')
+    assert not login_taken(db, username='admin', email='new@crunch.io')
+    # A location that cannot be derived again is kept
+    location = {'type': 'Point', 'coordinates': [1.0, 2.0]}
+    assert prepare_user({'location': location})['location'] == location
+    with pytest.raises(DuplicateKeyError):
+        db.users.insert_one({'email': 'admin@crunch.io'})
+
+    plan = db.users.find({'email': 'admin@crunch.io'}).explain()
+    assert winning_plan_indexes(plan) == ['email_unique']
+    plan = db.users.find({'$or': [{'username': 'admin'},
+                                  {'email': 'admin'}]}).explain()
+    assert sorted(winning_plan_indexes(plan)) == [
+        'email_unique', 'username_unique']
+    plan = db.users.find({'location': {'$nearSphere': admin['location'],
+                                       '$maxDistance': 1000}}).explain()
+    assert winning_plan_indexes(plan) == ['location_2dsphere']
+
+
+def test_position_store():
+    positions = PositionStore(capacity=2)
+    load_data(_here + '/data/users.json', settings=settings, clear=True)
+    assert positions.load(db) == 10
+    assert len(positions) == 10
+    assert positions.get('985076770cb0173a5b015c32') == (43.175753,
+                                                         -42.081022)
+    latitudes, longitudes = positions.coordinates()
+    assert latitudes.base is positions.latitudes
+
+    version = positions.version
+    positions.remove('985076770cb0173a5b015c32')
+    assert positions.version > version
+    assert np.isnan(positions.coordinates()[0]).sum() == 1
+    ids, latitudes, longitudes = positions.snapshot()
+    assert len(ids) == len(latitudes) == 9
+    positions.set('new', 10.0, 20.0)
+    # The freed slot is reused
+    assert len(positions.coordinates()[0]) == 10
+    assert positions.get('new') == (10.0, 20.0)
+    positions.set('new', 11.0, 20.0)
+    assert len(positions) == 10 and positions.get('new')[0] == 11.0
+
+
+def test_move_writer():
+    load_data(_here + '/data/users.json', settings=settings, clear=True)
+    positions = PositionStore()
+    positions.load(db)
+    batches = []
+
+    class Users(object):
+        def bulk_write(self, requests, ordered=True):
+            assert not ordered
+            batches.append(len(requests))
+            return db.users.bulk_write(requests, ordered=ordered)
+
+    writer = MoveWriter(Users(), batch_size=2)
+    changed = []
+    writer.subscribe(changed.append)
+    writer.subscribe(lambda changes: positions.update(
+        (user_id, lat, lon) for user_id, (lat, lon) in changes.iteritems()))
+    users = [user['_id'] for user in db.users.find().sort('_id')][:3]
+    for step in xrange(5):
+        for user_id in users:
+            writer.move(user_id, 10 + step, '20.5')
+    with pytest.raises(ValueError):
+        writer.move(users[0], 91, 0)
+    # Only the latest position of each user is kept and written
+    assert len(writer) == 3
+    assert writer.flush() == 3
+    assert batches == [2, 1]
+    assert changed == [dict((user_id, (14.0, 20.5)) for user_id in users)]
+    user = db.users.find_one({'_id': users[0]})
+    assert float(user['latitude']) == 14.0
+    assert user['location'] == {'type': 'Point', 'coordinates': [20.5, 14.0]}
+    assert positions.get(users[2]) == (14.0, 20.5)
+    assert writer.flush() == 0 and len(changed) == 1
+
+    writer = MoveWriter(db.users, max_staleness=0.01)
+    writer.start()
+    writer.move(users[0], 1.0, 2.0)
+    writer.stop()
+    assert not len(writer)
+    assert db.users.find_one({'_id': users[0]})['location'] == {
+        'type': 'Point', 'coordinates': [2.0, 1.0]}
+
+
+def test_pair_statistics():
+    random = np.random.RandomState(0)
+    latitudes = random.uniform(-80, 80, 50)
+    longitudes = random.uniform(-180, 180, 50)
+    lat, lon, cos = to_radians(latitudes, longitudes)
+    matrix = haversine(lat[:, np.newaxis], lon[:, np.newaxis],
+                       cos[:, np.newaxis], lat, lon, cos)
+    pairs = matrix[np.triu_indices(50, 1)]
+    result = pair_statistics(latitudes, longitudes, tile_size=7)
+    assert result['users'] == 50
+    assert result['pairs'] == len(pairs) == 50 * 49 // 2
+    assert np.isclose(result['mean'], pairs.mean())
+    assert np.isclose(result['std'], pairs.std())
+    assert result['min'] == pairs.min() and result['max'] == pairs.max()
+    # London to Paris
+    assert abs(pair_statistics([51.5074, 48.8566],
+                               [-0.1278, 2.3522])['max'] - 343.5) < 1
+    assert pair_statistics([1.0], [2.0])['pairs'] == 0
+
+    edges = histogram_edges(10, log=True)
+    assert len(edges) == 12 and edges[0] == 0 and edges[1] == 1
+    assert np.isclose(edges[-1], MAX_DISTANCE_KM)
+    summary = pair_summary(latitudes, longitudes, edges, tile_size=7)
+    assert summary['mean'] == result['mean']
+    histogram = summary['histogram']
+    assert histogram['counts'] == np.histogram(pairs, edges)[0].tolist()
+    assert histogram['cumulative'][-1] == len(pairs)
+    histogram = pair_summary(latitudes, longitudes, [0, 1000, 5000],
+                             tile_size=7)['histogram']
+    assert histogram['cumulative'] == [(pairs <= 1000).sum(),
+                                       (pairs <= 5000).sum()]
+    assert histogram['over'] == (pairs > 5000).sum()
+    with pytest.raises(ValueError):
+        histogram_edges(5, low=0, log=True)
+
+    calls = []
+    summaries = SummaryCache()
+
+    def compute(edges):
+        calls.append(edges)
+        return pair_summary(latitudes, longitudes, edges)
+    assert summaries.get(1, None, compute) is summaries.get(1, None, compute)
+    summaries.get(1, (0, 10), compute)
+    summaries.get(2, None, compute)
+    assert calls == [None, (0, 10), None]
+    # Only the most recently used bin layouts are kept
+    summaries = SummaryCache(max_entries=2)
+    for edges in [(0, 1), (0, 2), (0, 1), (0, 3), (0, 1), (0, 2)]:
+        summaries.get(1, edges, compute)
+    assert calls[3:] == [(0, 1), (0, 2), (0, 3), (0, 2)]
+    assert len(summaries.summaries) == 2
+
+
+def test_proximity_queries(monkeypatch):
+    random = np.random.RandomState(1)
+    latitudes = np.degrees(np.arcsin(random.uniform(-1, 1, 300)))
+    longitudes = random.uniform(-180, 180, 300)
+    # A tight cluster, duplicates and the poles
+    latitudes[:40] = 40 + random.normal(0, 0.01, 40)
+    longitudes[:40] = -3 + random.normal(0, 0.01, 40)
+    latitudes[40:44], longitudes[40:44] = latitudes[0], longitudes[0]
+    latitudes[44:46] = 90, -90
+    lat, lon, cos = to_radians(latitudes, longitudes)
+    matrix = haversine(lat[:, np.newaxis], lon[:, np.newaxis],
+                       cos[:, np.newaxis], lat, lon, cos)
+    rows, columns = np.triu_indices(300, 1)
+    pairs = matrix[rows, columns]
+    for radius in (0, 1, 100, 2000, 30000):
+        found = {}
+        for i, j, km in iter_pairs_within(latitudes, longitudes, radius):
+            assert (i < j).all()
+            found.update(zip(zip(i.tolist(), j.tolist()), km.tolist()))
+        near = pairs <= radius
+        assert sorted(found) == sorted(zip(rows[near].tolist(),
+                                           columns[near].tolist()))
+        assert np.allclose([found[pair] for pair in sorted(found)],
+                           pairs[near], atol=1e-6)
+
+    i, j, km = closest_pairs(latitudes, longitudes, 100)
+    assert np.allclose(km, np.sort(pairs)[:100], atol=1e-6)
+    assert np.allclose(km, matrix[i, j], atol=1e-6)
+    assert len(closest_pairs(latitudes[:3], longitudes[:3], 10)[2]) == 3
+    assert len(closest_pairs([1.0], [2.0], 10)[2]) == 0
+
+    # Crowded cubes are cut into batches of about BATCH_PAIRS
+    monkeypatch.setattr(proximity, 'BATCH_PAIRS', 500)
+    grid = proximity.SpatialGrid(proximity.unit_vectors(latitudes,
+                                                        longitudes),
+                                 proximity.km_to_chord(100))
+    batches = list(grid.candidate_pairs())
+    assert max(len(i) for i, j in batches) <= 500
+    found = [zip(i.tolist(), j.tolist())
+             for i, j, km in iter_pairs_within(latitudes, longitudes, 100)]
+    assert sorted(sum(found, [])) == sorted(zip(rows[pairs <= 100].tolist(),
+                                                columns[pairs <= 100].tolist()))
+
+
+def test_load_compressed_inputs(tmpdir):
+    csv_filename = _here + '/data/S-O-1k.csv'
+    with open(csv_filename, 'rb') as f:
+        data = f.read()
+    gz_filename = str(tmpdir.join('S-O-1k.csv.gz'))
+    with gzip.open(gz_filename, 'wb') as f:
+        f.write(data)
+    bz2_filename = str(tmpdir.join('S-O-1k.csv.bz2'))
+    with bz2.BZ2File(bz2_filename, 'wb') as f:
+        f.write(data)
+    zip_filename = str(tmpdir.join('surveys.zip'))
+    with zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as f:
+        f.writestr('2017/S-O-1k.csv', data)
+        f.writestr('2017/S-O-head.csv', '\n'.join(data.split('\n')[:11]))
+
+    expected = load_dataset_to_dict(csv_filename)
+    assert load_dataset_to_dict(bz2_filename) == expected
+    dataset = open_dataset(db, load_dataset(gz_filename, db, chunk_rows=300,
+                                            job_id='gz'))
+    assert dataset.document['name'] == 'S-O-1k.csv'
+    assert dataset.column(7).tolist() == expected['columns'][7]
+
+    ds_ids = load_datasets(zip_filename, db)
+    names = [open_dataset(db, ds_id).document['name'] for ds_id in ds_ids]
+    assert names == ['S-O-1k.csv', 'S-O-head.csv']
+    assert open_dataset(db, ds_ids[1]).num_rows == 10
+    with pytest.raises(ValueError):
+        load_dataset(zip_filename, db)
+
+    shape, = scan_csv(bz2_filename, [RowShapeVisitor()], processes=2)
+    assert shape.result()['num_rows'] == 999
+
+    # Old Mac line endings read the same plain or gzipped
+    cr_filename = str(tmpdir.join('cr.csv'))
+    with open(cr_filename, 'wb') as f:
+        f.write(data.replace('\n', '\r'))
+    with gzip.open(cr_filename + '.gz', 'wb') as f:
+        f.write(data.replace('\n', '\r'))
+    assert load_dataset_to_dict(cr_filename) == expected
+    assert load_dataset_to_dict(cr_filename + '.gz') == expected
+
+
+def test_dictionary_column():
+    column = DictionaryColumn(["Red", "green"])
+    assert column("Red") == 1
+    assert column("red") is None
+    assert column("") is None
+    assert column.add("blue") == 3
+    assert column("blue") == 3
+    assert column[2] == "green"
+    assert column[3] == "blue"
+
+
+def test_load_dataset_dictionary_encodes_strings(tmpdir):
+    csv_file = tmpdir.join('colours.csv')
+    rows = [['FavouriteColour', 'Comment']]
+    for i in range(100):
+        rows.append([['Red', 'Green', 'Blue', ''][i % 4],
+                     'Comment number {}'.format(i)])
+    csv_file.write('\n'.join(','.join(row) for row in rows) + '\n')
+
+    plain = load_dataset_to_dict(str(csv_file), dictionary_encode=False)
+    data = load_dataset_to_dict(str(csv_file))
+    # Low cardinality column is encoded, unique comments are not
+    assert data['dictionaries'] == [
+        {'column': 0, 'labels': ['Blue', 'Green', 'Red']}]
+    assert data['columns'][0][:4] == [3, 2, 1, None]
+    assert data['columns'][1] == plain['columns'][1]
+
+    column_types = get_column_types(data)
+    assert isinstance(column_types[0], DictionaryColumn)
+    # Lossless
+    assert ([column_types[0][code] for code in data['columns'][0]] ==
+            plain['columns'][0])
+
+    dataset = open_dataset(db, load_dataset(str(csv_file), db, chunk_rows=10))
+    assert isinstance(dataset.column_type('FavouriteColour'), DictionaryColumn)
+    assert dataset.column('FavouriteColour').tolist() == data['columns'][0]
+    assert dataset.column('Comment').tolist() == plain['columns'][1]
+
+
+def test_infer_column_types(tmpdir):
+    csv_file = tmpdir.join('wave1.csv')
+    rows = [['Respondent', 'Score', 'Smoker', 'Team', 'Tools', 'ZipCode',
+             'Comment', 'HoursPerWeek']]
+    for i in range(100):
+        rows.append([str(i + 1), '{}.5'.format(i % 7), ['yes', 'No', ''][i % 3],
+                     ['red', 'blue', 'NA'][i % 3],
+                     ['vim; git', 'git', 'emacs;git;make'][i % 3],
+                     '{:05d}'.format(i), 'Comment number {}'.format(i),
+                     'lots' if i == 5 else str(i % 40)])
+    csv_file.write('\n'.join(','.join(row) for row in rows) + '\n')
+
+    sample = sample_csv(str(csv_file), sample_rows=50)
+    assert sample['num_rows'] == 50
+    specs, conflicts = resolve_schema(sample)
+    assert [spec['type'] for spec in specs] == [
+        'int', 'float', 'boolean', 'enum', 'set', 'str', 'str', 'rule']
+    assert specs[2]['labels'] == ['No', 'yes']
+    assert specs[3]['items'] == ['blue', 'red']
+    assert specs[4]['items'] == ['emacs', 'git', 'make', 'vim']
+    assert conflicts == [{'column': 7, 'header': 'HoursPerWeek',
+                          'rule': 'IntColumn', 'proposed': 'str',
+                          'rejected': 1}]
+
+    db.column_schemas.drop()
+    dataset = open_dataset(db, load_dataset(str(csv_file), db, chunk_rows=30,
+                                            infer_types=True))
+    assert dataset.dtype('Respondent') == np.dtype('<i8')
+    assert dataset.column('Smoker').tolist()[:3] == [True, False, None]
+    assert dataset.column('Team').tolist()[:3] == [2, 1, None]
+    assert dataset.column_type('Team')[2] == 'red'
+    tools = dataset.column('Tools').tolist()
+    assert dataset.column_type('Tools')[tools[2]] == 'emacs; git; make'
+    assert dataset.column('HoursPerWeek').tolist()[4:7] == [4, None, 6]
+
+    # The schema is cached by headers and reused for the next wave
+    schema, = db.column_schemas.find()
+    assert schema['columns'] == specs
+    assert schema['sample_rows'] == 100
+    csv_file.copy(tmpdir.join('wave2.csv'))
+    db.column_schemas.update_one({'_id': schema['_id']},
+                                 {'$set': {'columns': specs[:3] + [
+                                     {'type': 'str'}] + specs[4:]}})
+    dataset = open_dataset(db, load_dataset(str(tmpdir.join('wave2.csv')),
+                                            db, infer_types=True))
+    assert isinstance(dataset.column_type('Team'), DictionaryColumn)
+    team = dataset.column_type('Team')
+    assert [team[code] for code in dataset.column('Team').tolist()[:3]] == [
+        'red', 'blue', 'NA']
+
 def test_select_with_filter():
     """Provide a test to answer this question:
        "For women, how does formal education affect salary (adjusted)?"
@@ -140,31 +986,25 @@ def test_select_with_filter():
 
     ds_id = load_dataset(csv_filename, db)
 
-    dataset = db.datasets.find({'_id': ds_id})[0]
-    headers = dataset['headers']
-    columns = dataset['columns']
+    dataset = open_dataset(db, ds_id)
 
-    gender_col = columns[headers.index('Combined Gender')]
-    salary_col = columns[headers.index('SalaryAdjusted')]
-    education_col = columns[headers.index('FormalEducation')]
+    gender_col = dataset.column('Combined Gender')
+    salary_col = dataset.column('SalaryAdjusted')
+    education_col = dataset.column('FormalEducation')
     female_code = CATEGORY_GENDER('female')
     assert female_code is not None
 
-    def _generate_data():
-        for gender, salary, education in itertools.izip(gender_col,
-                                                        salary_col,
-                                                        education_col):
-            if gender != female_code:
-                continue
-            if salary is None:
-                continue
-            yield education, salary
-
-    print(gender_col.count(female_code), "female developers in the dataset.")
-    data_array = np.rec.array(np.fromiter(
-        _generate_data(),
+    # Missing values are masked, so no per-row None filtering is needed
+    is_female = (gender_col == female_code).filled(False)
+    selected = (is_female &
+                ~np.ma.getmaskarray(salary_col) &
+                ~np.ma.getmaskarray(education_col))
+
+    print(is_female.sum(), "female developers in the dataset.")
+    data_array = np.rec.fromarrays(
+        [education_col.data[selected], salary_col.data[selected]],
         dtype=[('education', 'i4'), ('salary', 'f8')],
-    ), copy=False)
+    )
     data_array.sort()
     # Sanity check
     print(len(data_array), "female developers reported salary.")
@@ -174,8 +1014,7 @@ def test_select_with_filter():
     x_range = np.arange(data_array.education.min(), data_array.education.max() + 1)
     x_lowest = x_range[0]
     x_highest = x_range[-1]
-    labels = [CATEGORY_FORMAL_EDUCATION[i]
-              for i in xrange(x_lowest, x_highest + 1)]
+    labels = CATEGORY_FORMAL_EDUCATION.decode(x_range).tolist()
     x_labels = ['\n'.join(textwrap.wrap(label, width=25)) for label in labels]
     x_labels.insert(0, '')  # required by matplotlib, I don't know why
 
@@ -208,6 +1047,103 @@ def test_select_with_filter():
     plt.close(fig)
 
 
+def test_load_dataset_metrics():
+    metrics.reset()
+    metrics.enable()
+    try:
+        load_dataset(_here + '/data/S-O-1k.csv', db)
+    finally:
+        metrics.enable(False)
+    text = metrics.render()
+    assert 'cr_load_rows_total 999' in text
+    assert 'cr_load_cells_total{column_type="CategoryColumn"}' in text
+    for stage in ('resolve', 'parse', 'convert', 'insert'):
+        assert 'cr_load_stage_seconds_count{{stage="{}"}}'.format(stage) in text
+
+
+def test_metrics_disabled_is_noop():
+    metrics.reset()
+    metrics.inc('cr_load_rows_total', 5)
+    with metrics.timer('cr_load_stage_seconds', stage='parse'):
+        pass
+    assert metrics.render() == '\n'
+
+    # The Mongo listener is always registered and follows the switch
+    class Event(object):
+        command_name = 'find'
+        command = {'find': 'users'}
+
+    listener = CommandMetrics()
+    listener.started(Event())
+    assert metrics.render() == '\n'
+    metrics.enable()
+    try:
+        listener.started(Event())
+    finally:
+        metrics.enable(False)
+    assert 'cr_mongo_commands_total{command="find"} 1' in metrics.render()
+
+
+def test_helper_csv_command(capsys):
+    helper.main(['--timings', 'scan_csv_rows', _here + '/data/S-O-1k.csv'])
+    out, err = capsys.readouterr()
+    result = json.loads(out)
+    assert result['num_rows'] == 999
+    assert result['shortest_row'] == result['longest_row'] == 415
+    assert 'startup:' in err
+    assert not helper.COMMANDS['scan_csv_rows'][1]
+    assert helper.COMMANDS['list_datasets'][1]
+
+
+def test_scan_csv_single_pass():
+    csv_filename = _here + '/data/S-O-1k.csv'
+
+    def _visitors():
+        return [RowShapeVisitor([1, 500, 999]), ValueCountVisitor(),
+                SetItemVisitor(['WantWorkLanguage']), EncodedSizeVisitor(),
+                SetItemVisitor()]
+
+    serial = [v.result() for v in scan_csv(csv_filename, _visitors())]
+    parallel = [v.result()
+                for v in scan_csv(csv_filename, _visitors(), processes=3)]
+    assert serial == parallel
+
+    shape, counts, set_items, size, all_set_items = serial
+    assert shape['num_rows'] == 999
+    with open(csv_filename, 'rU') as f:
+        rows = list(csv.reader(f))
+    assert shape['specific_rows'] == [rows[1], rows[500], rows[999]]
+    # Items only ever chosen alone are found without naming the column
+    assert (all_set_items['WantWorkLanguage'] ==
+            set_items['WantWorkLanguage'])
+    assert sum(counts['Country'].values()) == 999
+    assert 'Python' in set_items['WantWorkLanguage']
+
+    # The estimate is exact for the single document dataset
+    data = load_dataset_to_dict(csv_filename, dictionary_encode=False)
+    data['_id'] = ObjectId()
+    assert size['total'] == len(bson.BSON.encode(data))
+
+
+def test_plan_storage():
+    visitor, = scan_csv(_here + '/data/S-O-1k.csv', [ColumnProfileVisitor()])
+    plan = plan_storage(visitor.result())
+    assert plan['num_rows'] == 999
+    assert plan['totals']['recommended'] < plan['totals']['bson']
+    for column in plan['columns']:
+        encodings = column['encodings']
+        assert encodings[column['recommended']] == min(encodings.values())
+    gender, = [c for c in plan['columns'] if c['header'] == 'Combined Gender']
+    assert gender['distinct'] == 4
+    assert plan['layouts']['bson']['layout'] == 'single_document'
+
+    big_columns = [10 * 2**20, 12 * 2**20]
+    assert plan_layout(big_columns, 1000)['layout'] == 'document_per_column'
+    layout = plan_layout([40 * 2**20], 1000)
+    assert layout['layout'] == 'row_chunks'
+    assert layout['largest_document'] < MONGO_DOCUMENT_LIMIT
+
+
 def _test_load_large_dataset_with_benchmark():
     """notes for later: ignore me"""
 